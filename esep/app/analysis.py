@@ -20,86 +20,126 @@ Introduction:
 -------------------------------------------------------------------------------
 """
 
+from pathlib import Path
+
 import numpy as np
 
 from ESEP.esep.physics.base import speed
 from ESEP.esep.plot.horizonal_distribution import HorizontalDistribution
-from ESEP.esep.reader.unstructured import FvcomReader
+from ESEP.esep.reader.aggregate import TemporalAggregates
+from ESEP.esep.reader.unstructured import CaseSet
 from ESEP.esep.utils import interpolate
-from ESEP.esep.utils.hpc import SegmentOperate
-from ESEP.esep.utils.timer import TimeUtil
-from ESEP.esep.utils.unstructured import nodes2elems, construct_mask
+from ESEP.esep.utils.unstructured import nodes2elems
+from ESEP.esep.utils.vertical import check_depth
 
 
 class Analysis:
-    fvcom_ls = []
-    case_ls = []
     fvcom_mask = None
 
-    def __init__(self, cases, time_period=None, lon_rng=None, lat_rng=None, z=None, interp_space=0.1):
-        for case_name, fp_ls in cases.items():
-            self.case_ls.append(cases)
-            self.fvcom_ls.append(FvcomReader(fp_ls))
+    def __init__(self, cases, time_period=None, lon_rng=None, lat_rng=None, z=None, interp_space=0.1, save_dir=None,
+                 margin=0.1, use_aggregates=True, z_ref=None):
+        check_depth(z, z_ref)
+        # 各算例共用一套网格，网格只加载一次，变量并发读取
+        self.case_set = CaseSet(cases)
+        self.fvcom = self.case_set.mesh
+        self.save_dir = Path('.') if save_dir is None else Path(save_dir)
+        for case_name in self.case_set.names:
+            self.save_dir.joinpath(case_name).mkdir(parents=True, exist_ok=True)
 
         self.time_period = time_period
         self.lon_rng = lon_rng
         self.lat_rng = lat_rng
         self.z = z
+        # z_ref 为 'surface'/'bottom' 时 z 为距水面/床面的距离(m)，各层按水位与水深插值到该深度
+        self.z_ref = z_ref
         self.interp_space = interp_space
+        # 区域子网格在区域外扩展的范围(度)
+        self.margin = margin
+        # 时间平均优先由时间聚合文件计算，见 build_aggregates
+        self.use_aggregates = use_aggregates
+        self.aggregates = [TemporalAggregates(reader) for reader in self.case_set.readers]
+
+    def build_aggregates(self, var_names=None, levels=('daily', 'monthly')):
+        """Build the temporal aggregates of every case, see TemporalAggregates.build"""
+        for aggregates in self.aggregates:
+            aggregates.build(var_names, levels)
+
+    def _regrid_selection(self, var_name):
+        """The regridder of the region, the selection of var_name to read and its interpolator"""
+        loc_range = [self.lon_rng[0], self.lon_rng[-1], self.lat_rng[0], self.lat_rng[-1]]
+        # 后续插值、掩膜与读取都只在区域子网格上进行，各算例按子网格的索引映射读取
+        region = self.fvcom.subset(loc_range, self.margin)
+        # 网格点直接在模型三角形中定位，节点变量按重心坐标插值，定位不到的网格点即为模型区域外
+        regridder = interpolate.TriangleRegridder.cached(region.lon, region.lat, region.tri, loc_range,
+                                                         self.interp_space, region.grid_cache)
+        self.fvcom_mask = regridder.mask
+        if 'node' in self.fvcom.ds[var_name].dimensions:
+            return regridder, {'nodes': region.node_idx[regridder.nodes]}, regridder
+        # 三角剖分与插值权重只计算一次，整个 (case, time, nele) 数据块一次稀疏矩阵乘完成插值
+        interpolator = interpolate.GridInterpolator.cached(region.lonc, region.latc, loc_range, self.interp_space)
+        return regridder, {'cells': region.cell_idx}, interpolator
 
     def _horizontal_distribution_extract_data(self, var_name):
-        lon_grid, lat_grid = None, None
-        for fvcom in self.fvcom_ls:
-            fvcom.variables([var_name])
-            lonc = fvcom.lonc[:]
-            latc = fvcom.latc[:]
-            cell_idx = np.where(
-                np.logical_and(np.logical_and(lonc <= self.lon_rng[-1] + 0.1, lonc >= self.lon_rng[0] - 0.1),
-                               np.logical_and(latc <= self.lat_rng[-1] + 0.1, latc >= self.lat_rng[0] - 0.1)))[0]
-            var_data = getattr(fvcom, var_name)[:]
-
-            # 确保var为二维数据，(time，nele)
-            dims = getattr(fvcom, var_name).dimensions
-            if 'node' in dims:
-                var_data = nodes2elems(var_data, fvcom.tri)
-            var_data = var_data[..., cell_idx]
-
-            if len(dims) == 3:
-                # TODO: 这里的 z 需要确定用index，还是气压，还是什么来确定
-                if self.z is None:
-                    var_data = np.nanmean(var_data, axis=1)
-                elif isinstance(self.z, list):
-                    var_data = np.nanmean(var_data[:, self.z, :], axis=1)
-                else:
-                    var_data = var_data[:, self.z, :]
-
-            if len(np.shape(var_data)) < 2:
-                var_data = np.expand_dims(var_data, axis=1)
-
-            if self.time_period is not None and 'time' in dims:
-                time_idx, _ = TimeUtil().extract_common_time_idx(fvcom.time_bj, self.time_period)
-                var_data = var_data[time_idx]
-
-            if len(np.shape(var_data)) < 2:
-                var_data = np.expand_dims(var_data, axis=0)
-
-            lon = fvcom.lonc[cell_idx].data
-            lat = fvcom.latc[cell_idx].data
-            loc_range = [self.lon_rng[0], self.lon_rng[-1], self.lat_rng[0], self.lat_rng[-1]]
-            args = (lon, lat, loc_range, self.interp_space, 'linear')
-            tmp = SegmentOperate(var_data, 100, interpolate.station2grid, 1, False, *args).value
-            lon_grid, lat_grid = tmp[0, :2]
-            if self.fvcom_mask is None or np.shape(self.fvcom_mask) != np.shape(lon_grid):
-                self.fvcom_mask, self.domain_polygon = construct_mask(fvcom.lon, fvcom.lat, fvcom.tri, lon_grid,
-                                                                      lat_grid)
-            interp_var_data = tmp[:, 2]
-            interp_var_data[:, self.fvcom_mask] = np.nan
-        return lon_grid, lat_grid, interp_var_data
+        """ 提取各算例的水平分布数据
+
+        Returns:
+            tuple: lon_grid, lat_grid and the interpolated data stacked as (case, time, lat, lon)
+        """
+        regridder, selection, interpolator = self._regrid_selection(var_name)
+
+        # 只读取所需的时间、层次与网格，避免读入整个变量
+        dims = self.fvcom.ds[var_name].dimensions
+
+        # 确保var为三维数据，(case，time，node/nele)
+        if len(dims) == 3 and self.z_ref is not None:
+            times = [None] * len(self.case_set) if self.time_period is None else \
+                self.case_set.time_index(self.time_period)
+            var_data = np.stack([reader.read_z(var_name, [self.z], self.z_ref, time=time_idx, **selection)[:, 0]
+                                 for reader, time_idx in zip(self.case_set.readers, times)])
+        else:
+            var_data = self.case_set.read(var_name, layer=self.z, time_period=self.time_period, **selection)
+
+        if len(dims) == 3 and self.z_ref is None and not isinstance(self.z, (int, np.integer)):
+            # TODO: 这里的 z 需要确定用index，还是气压，还是什么来确定
+            var_data = np.nanmean(var_data, axis=2)
+
+        if 'time' not in dims:
+            var_data = np.expand_dims(var_data, axis=1)
+
+        interp_var_data = interpolator(var_data)
+        interp_var_data[:, :, self.fvcom_mask] = np.nan
+        return regridder.lon_grid, regridder.lat_grid, interp_var_data
+
+    def _time_mean_extract_data(self, var_name):
+        """ 提取各算例时间平均的水平分布数据
+
+        有时间聚合文件时按所选时段由最粗的聚合计算时间平均，只读取少量数据；没有聚合时
+        读取原始输出后求平均。
+
+        Returns:
+            tuple: lon_grid, lat_grid and the time mean stacked as (case, lat, lon)
+        """
+        dims = self.fvcom.ds[var_name].dimensions
+        if not self.use_aggregates or 'time' not in dims or (len(dims) == 3 and self.z_ref is not None) or \
+                not any(agg.available(var_name) for agg in self.aggregates):
+            lon, lat, data = self._horizontal_distribution_extract_data(var_name)
+            return lon, lat, np.nanmean(data, axis=1)
+
+        regridder, selection, interpolator = self._regrid_selection(var_name)
+        times = [None] * len(self.aggregates) if self.time_period is None else \
+            self.case_set.time_index(self.time_period)
+        var_data = np.stack([agg.time_mean(var_name, time_idx, layer=self.z, **selection)
+                             for agg, time_idx in zip(self.aggregates, times)])
+        if len(dims) == 3 and not isinstance(self.z, (int, np.integer)):
+            var_data = np.nanmean(var_data, axis=1)
+
+        interp_var_data = interpolator(var_data)
+        interp_var_data[:, self.fvcom_mask] = np.nan
+        return regridder.lon_grid, regridder.lat_grid, interp_var_data
 
     def domain(self, level=None, with_edge=True, with_depth=False, add_features_func=None, *args, **kwargs):
-        self.fvcom.variables(['h'])
-        tri = np.transpose(self.fvcom.tri[:]).T
-        depth = nodes2elems(np.squeeze(self.fvcom.h[:]), tri)
+        tri = self.fvcom.tri
+        depth = nodes2elems(np.squeeze(self.fvcom.read('h')), tri)
         cb_label = '水深[m]'
         kwargs['edgecolor'] = 'yellow'
         if not with_depth:
@@ -121,42 +161,43 @@ class Analysis:
 
     def cum_erosion(self, level=np.linspace(-1, 1, 51), add_features_func=None, *args, **kwargs):
         lon, lat, data = self._horizontal_distribution_extract_data('bot_dthck')
-        data = np.nansum(data, axis=0)
-        draw_manager = HorizontalDistribution(lon, lat)
+        data = np.nansum(data, axis=1)
         if add_features_func is not None:
             HorizontalDistribution.add_features = add_features_func
-        draw_manager.contourf(data, level, self.lon_rng, self.lat_rng, self.save_dir.joinpath('冲淤累积图'), '冲淤[m]',
-                              *args, **kwargs)
+        for case_name, case_data in zip(self.case_set.names, data):
+            draw_manager = HorizontalDistribution(lon, lat)
+            draw_manager.contourf(case_data, level, self.lon_rng, self.lat_rng,
+                                  self.save_dir.joinpath(case_name, '冲淤累积图'), '冲淤[m]', *args, **kwargs)
 
     def current(self, scale=40, add_features_func=None, *args, **kwargs):
-        lon, lat, u = self._horizontal_distribution_extract_data('u')
-        _, _, v = self._horizontal_distribution_extract_data('v')
-        u, v = np.nanmean(u, axis=0), np.nanmean(v, axis=0)
+        lon, lat, u = self._time_mean_extract_data('u')
+        _, _, v = self._time_mean_extract_data('v')
 
-        draw_manager = HorizontalDistribution(lon, lat)
         if add_features_func is not None:
             HorizontalDistribution.add_features = add_features_func
-        draw_manager.quiver(u, v, scale, self.lon_rng, self.lat_rng, self.save_dir.joinpath('流场水平分布图'), qk_u=1, *args,
-                            **kwargs)
+        for case_name, case_u, case_v in zip(self.case_set.names, u, v):
+            draw_manager = HorizontalDistribution(lon, lat)
+            draw_manager.quiver(case_u, case_v, scale, self.lon_rng, self.lat_rng,
+                                self.save_dir.joinpath(case_name, '流场水平分布图'), qk_u=1, *args, **kwargs)
 
     def speed(self, level=np.linspace(0, 1, 51), add_features_func=None, *args, **kwargs):
-        lon, lat, u = self._horizontal_distribution_extract_data('u')
-        _, _, v = self._horizontal_distribution_extract_data('v')
-        u, v = np.nanmean(u, axis=0), np.nanmean(v, axis=0)
+        lon, lat, u = self._time_mean_extract_data('u')
+        _, _, v = self._time_mean_extract_data('v')
         cs = speed(u, v)
 
-        draw_manager = HorizontalDistribution(lon, lat)
         if add_features_func is not None:
             HorizontalDistribution.add_features = add_features_func
-        draw_manager.contourf(cs, level, self.lon_rng, self.lat_rng, self.save_dir.joinpath('流速水平分布图'), '流速[m/s]',
-                              *args, **kwargs)
+        for case_name, case_cs in zip(self.case_set.names, cs):
+            draw_manager = HorizontalDistribution(lon, lat)
+            draw_manager.contourf(case_cs, level, self.lon_rng, self.lat_rng,
+                                  self.save_dir.joinpath(case_name, '流速水平分布图'), '流速[m/s]', *args, **kwargs)
 
     def ssc(self, ssc_name='ssc0', level=np.linspace(0, 3, 51), add_features_func=None, *args, **kwargs):
-        lon, lat, data = self._horizontal_distribution_extract_data(ssc_name)
-        draw_manager = HorizontalDistribution(lon, lat)
-        data = np.nanmean(data, axis=0)
+        lon, lat, data = self._time_mean_extract_data(ssc_name)
 
         if add_features_func is not None:
             HorizontalDistribution.add_features = add_features_func
-        draw_manager.contourf(data, level, self.lon_rng, self.lat_rng, self.save_dir.joinpath('含沙量水平分布图'), '含沙量[g/l]',
-                              *args, **kwargs)
+        for case_name, case_data in zip(self.case_set.names, data):
+            draw_manager = HorizontalDistribution(lon, lat)
+            draw_manager.contourf(case_data, level, self.lon_rng, self.lat_rng,
+                                  self.save_dir.joinpath(case_name, '含沙量水平分布图'), '含沙量[g/l]', *args, **kwargs)
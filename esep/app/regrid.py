@@ -0,0 +1,268 @@
+# -*- coding:utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+
+                 Project Name : ESEP
+
+                    File Name : regrid.py
+
+                   Start Date : 2022-04-17 14:10
+
+                  Contributor : D.CW
+
+                        Email : dengchuangwu@gmail.com
+
+-------------------------------------------------------------------------------
+Introduction:
+
+FVCOM 输出转换为等经纬度网格产品
+
+插值权重(区域子网格上的重心坐标/三角剖分)只计算一次，按时间块流式读取模式输出，
+各时间块的插值在线程池中并行，同时在处理中的时间块数有上限，内存占用与总时长无关。
+结果写为压缩分块的 netCDF，或输出路径以 .zarr 结尾时写为 zarr(需安装 zarr)。
+
+netCDF-C 不是线程安全的，写 netCDF 时读写都在主线程进行，只有插值并行；写 zarr 时
+下一个时间块在后台线程预读，各时间块由工作线程插值并直接写入。
+
+    python -m ESEP.esep.app.regrid a.nc b.nc -o grid.nc --var u v zeta --range 121 123 30 32 --space 0.01
+
+-------------------------------------------------------------------------------
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import netCDF4 as nc
+import numpy as np
+
+from ESEP.esep.reader.unstructured import FvcomReader
+from ESEP.esep.utils import interpolate
+
+LAYER_DIMS = ('siglay', 'siglev')
+
+
+class _NetCDFWriter:
+    thread_safe = False
+
+    def __init__(self, fp, complevel):
+        self.ds = nc.Dataset(fp, 'w', format='NETCDF4')
+        self.complevel = complevel
+
+    def dimension(self, name, size):
+        if name not in self.ds.dimensions:
+            self.ds.createDimension(name, size)
+
+    def variable(self, name, dims, dtype, chunks=None, attrs=None, data=None):
+        fill_value = np.float32(np.nan) if np.dtype(dtype).kind == 'f' else None
+        var = self.ds.createVariable(name, dtype, dims, zlib=self.complevel > 0, complevel=max(self.complevel, 1),
+                                     chunksizes=chunks, fill_value=fill_value)
+        var.setncatts(attrs or {})
+        if data is not None:
+            var[:] = data
+
+    def write(self, name, key, data):
+        self.ds[name][key] = data
+
+    def close(self):
+        if self.ds.isopen():
+            self.ds.close()
+
+
+class _ZarrWriter:
+    thread_safe = True
+
+    def __init__(self, fp, complevel):
+        import zarr
+        from numcodecs import Blosc
+
+        self.group = zarr.open_group(os.fspath(fp), mode='w')
+        self.compressor = Blosc(cname='zstd', clevel=complevel, shuffle=Blosc.SHUFFLE) if complevel > 0 else None
+        self.sizes = {}
+
+    def dimension(self, name, size):
+        self.sizes[name] = size
+
+    def variable(self, name, dims, dtype, chunks=None, attrs=None, data=None):
+        shape = tuple(self.sizes[dim] for dim in dims)
+        fill_value = np.nan if np.dtype(dtype).kind == 'f' else None
+        arr = self.group.create_dataset(name, shape=shape, chunks=chunks or shape or True, dtype=dtype,
+                                        compressor=self.compressor, fill_value=fill_value)
+        # xarray 读取 zarr 时由该属性得到维度名
+        arr.attrs.update(dict(attrs or {}, _ARRAY_DIMENSIONS=list(dims)))
+        if data is not None:
+            arr[...] = data
+
+    def write(self, name, key, data):
+        self.group[name][key] = data
+
+    def close(self):
+        pass
+
+
+def regrid(files, dst, var_names, loc_range, det_grid=0.1, layers=None, time_period=None, margin=0.1,
+           time_chunk: int = 24, workers: int = None, complevel: int = 4) -> Path:
+    """ Interpolate FVCOM variables to an equally spaced grid and write them out chunk by chunk
+
+    Node variables are interpolated in the triangles of the mesh, element variables linearly between the element
+    centres; grid points outside the model domain are NaN. Every output variable has the dimensions
+    (time, [layer,] lat, lon) with one time step and layer per chunk.
+
+    Args:
+        files: The path (or list of paths) of the FVCOM output
+        dst: The output path, '*.zarr' writes a zarr store and any other path a netCDF file
+        var_names: The variables to interpolate
+        loc_range: The range of the grid, (lon_min, lon_max, lat_min, lat_max)
+        det_grid: The spacing of the grid
+        layers: The indices of the siglay/siglev layers kept, None for all
+        time_period: (start, end) in Beijing time, None for all the time steps
+        margin (float): The margin in degrees of the sub-mesh read around loc_range
+        time_chunk (int): The number of time steps read and interpolated at once
+        workers (int): The number of interpolation threads, defaults to the number of CPUs
+        complevel (int): The compression level, 0 disables compression
+
+    Returns:
+        Path: The path of the output
+
+    """
+    dst = Path(dst)
+    workers = workers or os.cpu_count() or 1
+    var_names = [var_names] if isinstance(var_names, str) else list(var_names)
+    fvcom = FvcomReader(files)
+    region = fvcom.subset(loc_range, margin)
+    regridder = interpolate.TriangleRegridder.cached(region.lon, region.lat, region.tri, loc_range, det_grid,
+                                                     region.grid_cache)
+    time_bj = np.asarray(fvcom.time_bj, dtype='datetime64[ms]')
+    time_idx = np.arange(time_bj.size)
+    if time_period is not None:
+        start, end = (np.datetime64(t, 'ms') for t in time_period)
+        time_idx = np.flatnonzero((time_bj >= start) & (time_bj <= end))
+    ny, nx = regridder.shape
+
+    zarr_out = dst.suffix == '.zarr'
+    # 先写到临时路径，完成后再替换，失败时不留下不完整的产品
+    if zarr_out:
+        tmp_fp = tempfile.mkdtemp(suffix='.zarr', dir=dst.parent)
+        writer = _ZarrWriter(tmp_fp, complevel)
+    else:
+        fd, tmp_fp = tempfile.mkstemp(suffix='.nc', dir=dst.parent)
+        os.close(fd)
+        writer = _NetCDFWriter(tmp_fp, complevel)
+    try:
+        writer.dimension('time', time_idx.size)
+        writer.dimension('lat', ny)
+        writer.dimension('lon', nx)
+        writer.variable('time', ('time',), 'i8', attrs={'units': 'milliseconds since 1970-01-01 00:00:00 +08:00'},
+                        data=time_bj[time_idx].astype(np.int64))
+        writer.variable('lat', ('lat',), 'f8', attrs={'units': 'degrees_north'}, data=regridder.lat_grid[:, 0])
+        writer.variable('lon', ('lon',), 'f8', attrs={'units': 'degrees_east'}, data=regridder.lon_grid[0])
+        writer.variable('mask', ('lat', 'lon'), 'i1', attrs={'long_name': 'outside the model domain'},
+                        data=regridder.mask.astype(np.int8))
+
+        layer_dims = set()
+        for var_name in var_names:
+            var = fvcom.ds[var_name]
+            dims = var.dimensions
+            if 'node' in dims:
+                selection = {'nodes': region.node_idx[regridder.nodes]}
+                interpolator = regridder
+            else:
+                selection = {'cells': region.cell_idx}
+                interpolator = interpolate.GridInterpolator.cached(region.lonc, region.latc, loc_range, det_grid)
+            layer_dim = next((dim for dim in dims if dim in LAYER_DIMS), None)
+            out_dims, chunks = ['lat', 'lon'], [ny, nx]
+            layer_sel = None
+            if layer_dim is not None:
+                layer_sel = np.arange(len(fvcom.ds.dimensions[layer_dim])) if layers is None else \
+                    np.atleast_1d(layers)
+                if layer_dim not in layer_dims:
+                    layer_dims.add(layer_dim)
+                    writer.dimension(layer_dim, layer_sel.size)
+                    writer.variable('{0}_index'.format(layer_dim), (layer_dim,), 'i4', data=layer_sel,
+                                    attrs={'long_name': 'index of the {0} layer'.format(layer_dim)})
+                out_dims, chunks = [layer_dim] + out_dims, [1] + chunks
+            if 'time' in dims:
+                out_dims, chunks = ['time'] + out_dims, [1] + chunks
+            attrs = {attr: var.getncattr(attr) for attr in ('long_name', 'units') if attr in var.ncattrs()}
+            writer.variable(var_name, tuple(out_dims), 'f4', chunks=chunks, attrs=attrs)
+
+            if 'time' not in dims:
+                data = interpolator(fvcom.read(var_name, layer=layer_sel, **selection))
+                data[..., regridder.mask] = np.nan
+                writer.write(var_name, Ellipsis, data.astype(np.float32))
+                continue
+            _stream(fvcom, var_name, interpolator, regridder.mask, writer, time_idx, time_chunk, workers,
+                    layer=layer_sel, **selection)
+        writer.close()
+        if zarr_out and dst.exists():
+            shutil.rmtree(dst)
+        os.replace(tmp_fp, dst)
+    finally:
+        if os.path.exists(tmp_fp):
+            if zarr_out:
+                shutil.rmtree(tmp_fp)
+            else:
+                writer.close()
+                os.remove(tmp_fp)
+    return dst
+
+
+def _stream(fvcom, var_name, interpolator, mask, writer, time_idx, time_chunk, workers, **selection):
+    """Read time blocks, interpolate them in the pool and write them, with at most workers + 1 blocks in flight"""
+    def _interpolate(out_key, block):
+        data = interpolator(block)
+        data[..., mask] = np.nan
+        data = data.astype(np.float32)
+        if writer.thread_safe:
+            writer.write(var_name, out_key, data)
+            return None
+        return out_key, data
+
+    def _finish(future):
+        result = future.result()
+        if result is not None:
+            writer.write(var_name, *result)
+
+    pending = deque()
+    position = 0
+    blocks = fvcom.iter_chunks(var_name, time_chunk, time=time_idx, prefetch=writer.thread_safe, **selection)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _, block in blocks:
+            out_key = slice(position, position + block.shape[0])
+            position += block.shape[0]
+            pending.append(pool.submit(_interpolate, out_key, block))
+            while len(pending) > workers:
+                _finish(pending.popleft())
+        while pending:
+            _finish(pending.popleft())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Interpolate FVCOM output to an equally spaced grid')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('-o', '--output', required=True, help="netCDF file, or zarr store when it ends with '.zarr'")
+    parser.add_argument('--var', nargs='+', required=True)
+    parser.add_argument('--range', nargs=4, type=float, required=True, metavar=('LON_MIN', 'LON_MAX', 'LAT_MIN',
+                                                                                   'LAT_MAX'))
+    parser.add_argument('--space', type=float, default=0.1, help='grid spacing in degrees')
+    parser.add_argument('--layers', nargs='*', type=int, help='siglay/siglev indices, default all')
+    parser.add_argument('--start', help='Beijing time, e.g. 2021-07-01T00:00')
+    parser.add_argument('--end', help='Beijing time')
+    parser.add_argument('--time-chunk', type=int, default=24)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--complevel', type=int, default=4)
+    args = parser.parse_args(argv)
+
+    time_period = None
+    if args.start or args.end:
+        time_period = [np.datetime64(args.start or '1900-01-01', 'ms'), np.datetime64(args.end or '2200-01-01', 'ms')]
+    files = args.files[0] if len(args.files) == 1 else args.files
+    print(regrid(files, args.output, args.var, args.range, args.space, args.layers, time_period,
+                 time_chunk=args.time_chunk, workers=args.workers, complevel=args.complevel))
+
+
+if __name__ == '__main__':
+    main()
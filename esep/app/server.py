@@ -0,0 +1,290 @@
+# -*- coding:utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+
+                 Project Name : ESEP
+
+                    File Name : server.py
+
+                   Start Date : 2022-04-15 10:30
+
+                  Contributor : D.CW
+
+                        Email : dengchuangwu@gmail.com
+
+-------------------------------------------------------------------------------
+Introduction:
+
+常驻的模式数据提取服务
+
+服务进程保留已打开的 FvcomReader 及其网格缓存、空间索引与插值权重，客户端通过
+Unix socket 或本机 TCP 端口发送提取请求(站点序列、平面分布、区域平均)，服务端以
+numpy 数组返回结果，省去每次启动进程、打开文件与重建索引的开销。
+
+消息格式：8 字节大端长度 + JSON 头，随后依次为头中 arrays 所列各数组的 np.save
+字节流(不允许 pickle)。
+
+    python -m ESEP.esep.app.server /tmp/esep.sock
+
+-------------------------------------------------------------------------------
+"""
+import argparse
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import traceback
+
+import numpy as np
+
+from ESEP.esep.app.verification import extract_horizontal_distribution
+from ESEP.esep.reader.unstructured import FvcomReader
+from ESEP.esep.utils.spatial import SphericalIndex
+from ESEP.esep.utils.timer import TimeUtil
+from ESEP.esep.utils.unstructured import bbox_index
+
+_HEADER = struct.Struct('>Q')
+
+
+def _recv_exact(sock, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(min(size - len(buf), 1 << 20))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def send_message(sock, header: dict, arrays: dict = None):
+    """Send a JSON header followed by numpy arrays"""
+    payloads = []
+    header = dict(header, arrays=[])
+    for name, arr in (arrays or {}).items():
+        buf = io.BytesIO()
+        np.save(buf, np.ma.filled(arr, np.nan) if np.ma.isMaskedArray(arr) else np.asarray(arr), allow_pickle=False)
+        header['arrays'].append([name, buf.tell()])
+        payloads.append(buf.getvalue())
+    raw = json.dumps(header).encode('utf-8')
+    sock.sendall(_HEADER.pack(len(raw)) + raw)
+    for payload in payloads:
+        sock.sendall(payload)
+
+
+def recv_message(sock) -> tuple:
+    """Receive a message sent by send_message, returns (header, arrays)"""
+    size, = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    header = json.loads(_recv_exact(sock, size).decode('utf-8'))
+    if not isinstance(header, dict):
+        raise ValueError('The header must be a JSON object')
+    arrays = {name: np.load(io.BytesIO(_recv_exact(sock, nbytes)), allow_pickle=False)
+              for name, nbytes in header.pop('arrays', [])}
+    return header, arrays
+
+
+def _time_period(time_period):
+    return None if time_period is None else [np.datetime64(t, 'ms') for t in time_period]
+
+
+class ExtractionService:
+    """ Extractions on warm readers
+
+    Readers are opened once per set of files and kept with everything they cache (grid, time, spatial index,
+    interpolation weights). netCDF-C is not thread-safe, so requests are served one at a time.
+    """
+
+    def __init__(self):
+        self.readers = {}
+        self.lock = threading.Lock()
+
+    def reader(self, files) -> FvcomReader:
+        key = json.dumps(files)
+        if key not in self.readers:
+            self.readers[key] = FvcomReader(files)
+        return self.readers[key]
+
+    def _time_idx(self, fvcom, var_name, time_period):
+        if time_period is None or 'time' not in fvcom.ds[var_name].dimensions:
+            return None
+        return TimeUtil().extract_common_time_idx(fvcom.time_bj, _time_period(time_period))[0]
+
+    def station(self, files, var_name, lon, lat, time_period=None, layer=None) -> dict:
+        """Series at the nearest cells or nodes of the stations, data (time, [layer,] station)"""
+        fvcom = self.reader(files)
+        on_nodes = 'node' in fvcom.ds[var_name].dimensions
+        index = SphericalIndex.cached(fvcom.lon, fvcom.lat) if on_nodes else SphericalIndex.cached(fvcom.lonc,
+                                                                                                    fvcom.latc)
+        dist, idx = index.query(np.atleast_1d(lon), np.atleast_1d(lat))
+        idx = idx[:, 0]
+        time_idx = self._time_idx(fvcom, var_name, time_period)
+        selection = {'nodes': idx} if on_nodes else {'cells': idx}
+        data = fvcom.read(var_name, time=time_idx, layer=layer, **selection)
+        time = fvcom.time_bj if time_idx is None else fvcom.time_bj[time_idx]
+        return {'data': data, 'time': time, 'index': idx, 'distance': dist[:, 0]}
+
+    def map(self, files, var_name, lon_rng, lat_rng, time_period=None, layer=None, interp_space=0.1,
+            margin=0.1) -> dict:
+        """Horizontal distribution on an equally spaced grid, see extract_horizontal_distribution"""
+        fvcom = self.reader(files)
+        loc_range = [lon_rng[0], lon_rng[-1], lat_rng[0], lat_rng[-1]]
+        lon_grid, lat_grid, data, mask = extract_horizontal_distribution(fvcom, var_name, loc_range,
+                                                                         _time_period(time_period), layer,
+                                                                         interp_space, margin)
+        return {'lon': lon_grid, 'lat': lat_grid, 'data': data, 'mask': mask}
+
+    def regional_mean(self, files, var_name, lon_rng, lat_rng, time_period=None, layer=None) -> dict:
+        """Area-weighted mean over the cells or nodes inside the box, data (time, [layer])"""
+        fvcom = self.reader(files)
+        region = fvcom.subset([lon_rng[0], lon_rng[-1], lat_rng[0], lat_rng[-1]])
+        if 'node' in fvcom.ds[var_name].dimensions:
+            idx = bbox_index(region.lon, region.lat, lon_rng, lat_rng, 0)
+            weights = np.asarray(region.topology.node_area)[idx]
+            selection = {'nodes': idx}
+        else:
+            idx = bbox_index(region.lonc, region.latc, lon_rng, lat_rng, 0)
+            weights = np.asarray(region.topology.elem_area)[idx]
+            selection = {'cells': idx}
+        time_idx = self._time_idx(fvcom, var_name, time_period)
+        data = region.read(var_name, time=time_idx, layer=layer, **selection)
+        valid = ~np.isnan(data)
+        weight = np.sum(valid * weights, axis=-1)
+        # 某时刻区域内无有效值时为 NaN
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(weight > 0, np.nansum(data * weights, axis=-1) / weight, np.nan)
+        time = fvcom.time_bj if time_idx is None else fvcom.time_bj[time_idx]
+        return {'data': mean, 'time': time}
+
+    def handle(self, method: str, params: dict) -> dict:
+        if method == 'ping':
+            return {}
+        if method not in ('station', 'map', 'regional_mean'):
+            raise ValueError('unknown method {0}'.format(method))
+        with self.lock:
+            return getattr(self, method)(**params)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                header, _ = recv_message(self.connection)
+            except (ConnectionError, OSError):
+                return
+            except ValueError as e:
+                # 头不是合法的 JSON 对象时无法得知其后是否还有数组，回复错误后关闭连接，不尝试重新同步
+                send_message(self.connection, {'ok': False, 'error': repr(e), 'traceback': traceback.format_exc()})
+                return
+            try:
+                arrays = self.server.service.handle(header['method'], header.get('params', {}))
+                send_message(self.connection, {'ok': True}, arrays)
+            except Exception as e:
+                send_message(self.connection, {'ok': False, 'error': repr(e), 'traceback': traceback.format_exc()})
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address, service: ExtractionService = None):
+    """ Create the server, address is the path of a Unix socket or a (host, port) tuple
+
+    Only bind TCP servers to localhost, the protocol has no authentication.
+    """
+    if isinstance(address, (tuple, list)):
+        server = _TCPServer(tuple(address), _Handler)
+    else:
+        if os.path.exists(address):
+            # 只删除残留的 socket，路径写错时不能删掉普通文件
+            if not stat.S_ISSOCK(os.stat(address).st_mode):
+                raise FileExistsError('{0} exists and is not a socket'.format(address))
+            os.remove(address)
+        server = _UnixServer(os.fspath(address), _Handler)
+    server.service = service or ExtractionService()
+    return server
+
+
+def serve(address):
+    with make_server(address) as server:
+        try:
+            server.serve_forever()
+        finally:
+            if not isinstance(address, (tuple, list)) and os.path.exists(address):
+                os.remove(address)
+
+
+class ExtractionClient:
+    """ Thin client of the extraction server, keeps one connection open
+
+    Args:
+        address: The path of the Unix socket or a (host, port) tuple
+
+    """
+
+    def __init__(self, address):
+        if isinstance(address, (tuple, list)):
+            self.sock = socket.create_connection(tuple(address))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(os.fspath(address))
+
+    def request(self, method: str, **params) -> dict:
+        send_message(self.sock, {'method': method, 'params': params})
+        header, arrays = recv_message(self.sock)
+        if not header.get('ok'):
+            raise RuntimeError('{0}\n{1}'.format(header.get('error'), header.get('traceback', '')))
+        return arrays
+
+    @staticmethod
+    def _files(files):
+        return [os.fspath(fp) for fp in files] if isinstance(files, (list, tuple)) else os.fspath(files)
+
+    @staticmethod
+    def _period(time_period):
+        return None if time_period is None else [str(np.datetime64(t, 'ms')) for t in time_period]
+
+    def station(self, files, var_name, lon, lat, time_period=None, layer=None) -> dict:
+        return self.request('station', files=self._files(files), var_name=var_name, lon=np.ravel(lon).tolist(),
+                            lat=np.ravel(lat).tolist(), time_period=self._period(time_period), layer=layer)
+
+    def map(self, files, var_name, lon_rng, lat_rng, time_period=None, layer=None, interp_space=0.1,
+            margin=0.1) -> dict:
+        return self.request('map', files=self._files(files), var_name=var_name, lon_rng=list(lon_rng),
+                            lat_rng=list(lat_rng), time_period=self._period(time_period), layer=layer,
+                            interp_space=interp_space, margin=margin)
+
+    def regional_mean(self, files, var_name, lon_rng, lat_rng, time_period=None, layer=None) -> dict:
+        return self.request('regional_mean', files=self._files(files), var_name=var_name, lon_rng=list(lon_rng),
+                            lat_rng=list(lat_rng), time_period=self._period(time_period), layer=layer)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve ESEP extractions from warm FVCOM readers')
+    parser.add_argument('address', help='path of the Unix socket, or localhost:port')
+    args = parser.parse_args(argv)
+    address = args.address
+    if ':' in address and os.path.sep not in address:
+        host, port = address.rsplit(':', 1)
+        address = (host, int(port))
+    serve(address)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,10 +29,11 @@ from ESEP.esep.plot.time_series import TimeSeries
 from ESEP.esep.reader.get_obs_data import get_obs_data, get_tide_station_info, get_obs_tide_data, get_obs_data_sediment
 from ESEP.esep.reader.unstructured import FvcomReader
 from ESEP.esep.utils import interpolate
-from ESEP.esep.utils.hpc import SegmentOperate
+from ESEP.esep.utils.mesh import MeshGradient
 from ESEP.esep.utils.spatial import find_nearest, CoordinateTransform
 from ESEP.esep.utils.timer import TimeUtil
-from ESEP.esep.utils.unstructured import nodes2elems, construct_mask
+from ESEP.esep.utils.unstructured import nodes2elems, bbox_index
+from ESEP.esep.utils.vertical import check_depth
 
 
 class Verification:
@@ -51,36 +52,26 @@ class TimeSeriesVerify(Verification):
         self.spring_tide = spring_tide
 
     def time_series_single_point_current(self, obs_coordinates):
-        level_num = self.fvcom.ds.dimensions['siglev'].size
-        elevation_levels = {
-            'surface': 0,
-            'middle': int(level_num / 2),
-            'bottom': -1,
-            'verticalMean': slice(level_num),
-        }
+        # 与观测报表各列对应的相对水深，垂线平均按各层厚度加权
+        elevation_levels = ['surface', '0.2H', '0.4H', '0.6H', '0.8H', 'bottom', 'verticalMean']
         obs_fp = './OBS_DATA/HangZhouWan_C_5.xls'
-        self.fvcom.variables(['u', 'v'])
         station_dict = find_nearest(obs_coordinates, (self.fvcom.lonc, self.fvcom.latc),
-                                    (self.fvcom.lon, self.fvcom.lat))
+                                    (self.fvcom.lon, self.fvcom.lat), cache=self.fvcom.grid_cache)
+        # 所有站点所在单元的全部层次一次读取，各站点各层次一次插值
+        cell_ids = [sta_val['cell_id'][0] for sta_val in station_dict.values()]
+        profiles = self.fvcom.station_profiles(['u', 'v'], cells=cell_ids, levels=elevation_levels[:-1])
 
-        for sta_info, lev_info in product(station_dict.items(), elevation_levels.items()):
-            station_name, sta_val = sta_info
-            lev_name, lev_idx = lev_info
+        for (sta_idx, station_name), lev_name in product(enumerate(station_dict), elevation_levels):
             draw_manager = TimeSeries(station_name)
             tmp_dir = self.save_dir.joinpath('current', '{0}_{1}'.format(station_name, lev_name))
             tmp_dir.mkdir(parents=True, exist_ok=True)
 
+            ucur_data = profiles['u'][lev_name][:, sta_idx]
+            vcur_data = profiles['v'][lev_name][:, sta_idx]
+            model_dir, model_cs = CoordinateTransform().uv2ocean(ucur_data, vcur_data)
             for tt_idx, tt_name, time_seg in zip([0, 1], ['小潮', '大潮'], [self.neap_tide, self.spring_tide]):
                 obs_cs_data, obs_dir_data, obs_time, obs_depth = get_obs_data(obs_fp, station_name, lev_name,
                                                                               merge=False, tt_idx=tt_idx)
-                cell_idx = sta_val['cell_id'][0]
-                if lev_name == 'verticalMean':
-                    ucur_data = np.nanmean(self.fvcom.u[:, lev_idx, cell_idx], axis=-1)
-                    vcur_data = np.nanmean(self.fvcom.v[:, lev_idx, cell_idx], axis=-1)
-                else:
-                    ucur_data = self.fvcom.u[:, lev_idx, cell_idx]
-                    vcur_data = self.fvcom.v[:, lev_idx, cell_idx]
-                model_dir, model_cs = CoordinateTransform().uv2ocean(ucur_data, vcur_data)
                 obs_idx, model_idx = TimeUtil().extract_common_time_idx(obs_time, self.fvcom.time_bj, time_seg[0],
                                                                         time_seg[1])
                 obs = (obs_cs_data[obs_idx], obs_dir_data[obs_idx])
@@ -93,7 +84,7 @@ class TimeSeriesVerify(Verification):
         obs_coordinate, obs_fp = get_tide_station_info('./OBS_DATA/1 、潮位/')
         self.fvcom.variables(['h', 'zeta'])
         station_dict = find_nearest(obs_coordinate, cell_lonlat=(self.fvcom.lonc, self.fvcom.latc),
-                                    node_lonlat=(self.fvcom.lon, self.fvcom.lat))
+                                    node_lonlat=(self.fvcom.lon, self.fvcom.lat), cache=self.fvcom.grid_cache)
         # --------------------------------------------------------------------------------------------------------------
         for j, sta_info in enumerate(station_dict.items()):
             station_name, sta_val = sta_info
@@ -123,12 +114,13 @@ class TimeSeriesVerify(Verification):
         lev_name = 'verticalMean'
         obs_fp = './OBS_DATA/3、含沙量/吴泾电厂等容量绿色煤电异地新建工程含沙量观测记录报表.xls'
         # --------------------------------------------------------------------------------------------------------------
-        self.fvcom.variables([sed_name])
         station_dict = find_nearest(obs_coordinates, cell_lonlat=(self.fvcom.lonc, self.fvcom.latc),
-                                    node_lonlat=(self.fvcom.lon, self.fvcom.lat))
+                                    node_lonlat=(self.fvcom.lon, self.fvcom.lat), cache=self.fvcom.grid_cache)
+        node_ids = [sta_val['node_id'][0] for sta_val in station_dict.values()]
+        profiles = self.fvcom.station_profiles(sed_name, nodes=node_ids, levels=[])[sed_name]
 
         # --------------------------------------------------------------------------------------------------------------
-        for station_name, sta_val in station_dict.items():
+        for sta_idx, station_name in enumerate(station_dict):
             name = station_name_mapping[station_name]
             tmp_dir = self.save_dir.joinpath('sediment', '{0}_{1}'.format(name, lev_name))
             tmp_dir.mkdir(parents=True, exist_ok=True)
@@ -138,76 +130,152 @@ class TimeSeriesVerify(Verification):
                 obs_data, obs_time, obs_depth = get_obs_data_sediment(obs_fp, station_name, lev_name, merge=False,
                                                                       tt_idx=tt_idx)
 
-                model_data = np.nanmean(getattr(self.fvcom, sed_name)[:, :, sta_val['node_id'][0]], axis=-1)
+                model_data = profiles[lev_name][:, sta_idx]
                 obs_idx, model_idx = TimeUtil().extract_common_time_idx(obs_time, self.fvcom.time_bj, time_seg[0],
                                                                         time_seg[1])
                 draw_manager.sediment(obs_time[obs_idx], self.fvcom.time_bj[model_idx], obs_data[obs_idx],
                                       model_data[model_idx], tmp_dir.joinpath(tt_name))
 
 
+def extract_horizontal_distribution(fvcom: FvcomReader, var_name, loc_range, time_period=None, z=None,
+                                    interp_space=0.1, margin=0.1, z_ref=None) -> tuple:
+    """ 提取变量在等经纬度网格上的水平分布
+
+    Args:
+        fvcom (FvcomReader): The reader of the model output
+        var_name (str): The name of the variable
+        loc_range: (lon_min, lon_max, lat_min, lat_max)
+        time_period: (start, end) in Beijing time, None for all the time steps
+        z: The selection of the layers, averaged unless it is an int; with z_ref, the depth in meters
+        interp_space (float): The spacing of the grid
+        margin (float): The margin of the region sub-mesh in degrees
+        z_ref (str): None, or 'surface'/'bottom' for z measured below the surface or above the bed
+
+    Returns:
+        tuple: lon_grid, lat_grid, the data (time, lat, lon) and the out-of-domain mask (lat, lon)
+    """
+    check_depth(z, z_ref)
+    # 后续插值、掩膜与读取都只在区域子网格上进行
+    region = fvcom.subset(loc_range, margin)
+    # 网格点直接在模型三角形中定位，节点变量按重心坐标插值，定位不到的网格点即为模型区域外
+    regridder = interpolate.TriangleRegridder.cached(region.lon, region.lat, region.tri, loc_range, interp_space,
+                                                     region.grid_cache)
+
+    # 只读取所需的时间、层次与网格，避免读入整个变量
+    dims = fvcom.ds[var_name].dimensions
+    time_idx = None
+    if time_period is not None and 'time' in dims:
+        time_idx, _ = TimeUtil().extract_common_time_idx(fvcom.time_bj, time_period)
+
+    # 确保var为二维数据，(time，node/nele)
+    if 'node' in dims:
+        selection = {'nodes': regridder.nodes}
+        interpolator = regridder
+    else:
+        selection = {}
+        # 三角剖分与插值权重只计算一次，整个 (time, nele) 数据块一次稀疏矩阵乘完成插值
+        interpolator = interpolate.GridInterpolator.cached(region.lonc, region.latc, loc_range, interp_space)
+
+    if len(dims) == 3 and z_ref is not None:
+        # 按水位与水深换算各层深度，插值到距水面(床面)固定距离处
+        var_data = region.read_z(var_name, [z], z_ref, time=time_idx, **selection)[:, 0]
+    else:
+        var_data = region.read(var_name, time=time_idx, layer=z, **selection)
+
+    if len(dims) == 3 and z_ref is None and not isinstance(z, (int, np.integer)):
+        # TODO: 这里的 z 需要确定用index，还是气压，还是什么来确定
+        var_data = np.nanmean(var_data, axis=1)
+
+    if 'time' not in dims:
+        var_data = np.expand_dims(var_data, axis=0)
+
+    interp_var_data = interpolator(var_data)
+    interp_var_data[:, regridder.mask] = np.nan
+    return regridder.lon_grid, regridder.lat_grid, interp_var_data, regridder.mask
+
+
 class HorizDistVerify(Verification):
     fvcom_mask = None
 
     def __init__(self, case_name, save_dir, fp_ls, time_period=None, lon_rng=None, lat_rng=None, z=None,
-                 interp_space=0.1):
+                 interp_space=0.1, margin=0.1, z_ref=None):
+        check_depth(z, z_ref)
         super(HorizDistVerify, self).__init__(case_name, save_dir, fp_ls)
         self.time_period = time_period
         self.lon_rng = lon_rng
         self.lat_rng = lat_rng
         self.z = z
+        # z_ref 为 'surface'/'bottom' 时 z 为距水面/床面的距离(m)
+        self.z_ref = z_ref
         self.interp_space = interp_space
+        # 区域子网格在区域外扩展的范围(度)
+        self.margin = margin
 
     def _horizontal_distribution_extract_data(self, var_name):
-        self.fvcom.variables([var_name])
-        lonc = self.fvcom.lonc[:]
-        latc = self.fvcom.latc[:]
-        cell_idx = np.where(
-            np.logical_and(np.logical_and(lonc <= self.lon_rng[-1] + 0.1, lonc >= self.lon_rng[0] - 0.1),
-                           np.logical_and(latc <= self.lat_rng[-1] + 0.1, latc >= self.lat_rng[0] - 0.1)))[0]
-        var_data = getattr(self.fvcom, var_name)[:]
-
-        # 确保var为二维数据，(time，nele)
-        dims = getattr(self.fvcom, var_name).dimensions
-        if 'node' in dims:
-            var_data = nodes2elems(var_data, self.fvcom.tri)
-        var_data = var_data[..., cell_idx]
-
-        if len(dims) == 3:
-            # TODO: 这里的 z 需要确定用index，还是气压，还是什么来确定
-            if self.z is None:
-                var_data = np.nanmean(var_data, axis=1)
-            elif isinstance(self.z, list):
-                var_data = np.nanmean(var_data[:, self.z, :], axis=1)
-            else:
-                var_data = var_data[:, self.z, :]
+        loc_range = [self.lon_rng[0], self.lon_rng[-1], self.lat_rng[0], self.lat_rng[-1]]
+        lon_grid, lat_grid, interp_var_data, self.fvcom_mask = extract_horizontal_distribution(
+            self.fvcom, var_name, loc_range, self.time_period, self.z, self.interp_space, self.margin, self.z_ref)
+        return lon_grid, lat_grid, interp_var_data
 
-        if len(np.shape(var_data)) < 2:
-            var_data = np.expand_dims(var_data, axis=1)
+    def _gradient_extract_data(self, field, ssc_name='ssc0'):
+        """ 提取涡度、散度或含沙量梯度的水平分布
 
-        if self.time_period is not None and 'time' in dims:
-            time_idx, _ = TimeUtil().extract_common_time_idx(self.fvcom.time_bj, self.time_period)
-            var_data = var_data[time_idx]
+        只读取区域内单元及其梯度模板用到的单元(节点)，梯度算子对整个 (time, ncol) 数据块一次稀疏矩阵乘
 
-        if len(np.shape(var_data)) < 2:
-            var_data = np.expand_dims(var_data, axis=0)
+        Args:
+            field (str): 'vorticity', 'divergence' or 'ssc_gradient'
+            ssc_name (str): The name of the ssc variable used by 'ssc_gradient'
 
-        lon = self.fvcom.lonc[cell_idx].data
-        lat = self.fvcom.latc[cell_idx].data
+        Returns:
+            tuple: lon_grid, lat_grid and the interpolated field (time, lat, lon)
+        """
         loc_range = [self.lon_rng[0], self.lon_rng[-1], self.lat_rng[0], self.lat_rng[-1]]
-        args = (lon, lat, loc_range, self.interp_space, 'linear')
-        tmp = SegmentOperate(var_data, 100, interpolate.station2grid, 1, False, *args).value
-        lon_grid, lat_grid = tmp[0, :2]
-        if self.fvcom_mask is None or np.shape(self.fvcom_mask) != np.shape(lon_grid):
-            self.fvcom_mask, self.domain_polygon = construct_mask(self.fvcom.lon, self.fvcom.lat, self.fvcom.tri,
-                                                                  lon_grid, lat_grid)
-        interp_var_data = tmp[:, 2]
-        interp_var_data[:, self.fvcom_mask] = np.nan
-        return lon_grid, lat_grid, interp_var_data
+        region = self.fvcom.subset(loc_range, self.margin)
+        regridder = interpolate.TriangleRegridder.cached(region.lon, region.lat, region.tri, loc_range,
+                                                         self.interp_space, region.grid_cache)
+        self.fvcom_mask = regridder.mask
+        # 梯度模板包含共用节点的相邻单元，在外扩两倍 margin 的子网格上计算，区域外扩 margin 内单元的模板完整
+        stencil_region = self.fvcom.subset(loc_range, 2 * self.margin)
+        cell_idx = bbox_index(stencil_region.lonc, stencil_region.latc, self.lon_rng, self.lat_rng, self.margin,
+                              stencil_region.grid_cache)
+
+        var_names = ['u', 'v'] if field in ('vorticity', 'divergence') else [ssc_name]
+        on_nodes = field == 'ssc_gradient'
+        operator, columns = stencil_region.gradient.stencil(cell_idx, on_nodes)
+
+        grads = []
+        for var_name in var_names:
+            dims = self.fvcom.ds[var_name].dimensions
+            time_idx = None
+            if self.time_period is not None and 'time' in dims:
+                time_idx, _ = TimeUtil().extract_common_time_idx(self.fvcom.time_bj, self.time_period)
+            selection = {'nodes': columns} if on_nodes else {'cells': columns}
+            if len(dims) == 3 and self.z_ref is not None:
+                var_data = stencil_region.read_z(var_name, [self.z], self.z_ref, time=time_idx, **selection)[:, 0]
+            else:
+                var_data = stencil_region.read(var_name, time=time_idx, layer=self.z, **selection)
+            if len(dims) == 3 and self.z_ref is None and not isinstance(self.z, (int, np.integer)):
+                var_data = np.nanmean(var_data, axis=1)
+            if 'time' not in dims:
+                var_data = np.expand_dims(var_data, axis=0)
+            grads.append(stencil_region.gradient.apply(operator, var_data))
+
+        if field == 'vorticity':
+            data = MeshGradient.curl(*grads)
+        elif field == 'divergence':
+            data = MeshGradient.div(*grads)
+        else:
+            data = speed(*grads[0])
+
+        interpolator = interpolate.GridInterpolator.cached(stencil_region.lonc[cell_idx],
+                                                           stencil_region.latc[cell_idx], loc_range, self.interp_space)
+        interp_data = interpolator(data)
+        interp_data[:, self.fvcom_mask] = np.nan
+        return regridder.lon_grid, regridder.lat_grid, interp_data
 
     def domain(self, level=None, with_edge=True, with_depth=False, add_features_func=None, *args, **kwargs):
-        self.fvcom.variables(['h'])
-        tri = np.transpose(self.fvcom.tri[:]).T
-        depth = nodes2elems(np.squeeze(self.fvcom.h[:]), tri)
+        tri = self.fvcom.tri
+        depth = nodes2elems(np.squeeze(self.fvcom.read('h')), tri)
         cb_label = '水深[m]'
         kwargs['edgecolor'] = 'yellow'
         if not with_depth:
@@ -269,6 +337,33 @@ class HorizDistVerify(Verification):
         draw_manager.contourf(data, level, self.lon_rng, self.lat_rng, self.save_dir.joinpath('含沙量水平分布图'), '含沙量[g/l]',
                               *args, **kwargs)
 
+    def vorticity(self, level=np.linspace(-1e-3, 1e-3, 51), add_features_func=None, *args, **kwargs):
+        lon, lat, data = self._gradient_extract_data('vorticity')
+        data = np.nanmean(data, axis=0)
+        draw_manager = HorizontalDistribution(lon, lat)
+        if add_features_func is not None:
+            HorizontalDistribution.add_features = add_features_func
+        draw_manager.contourf(data, level, self.lon_rng, self.lat_rng, self.save_dir.joinpath('涡度水平分布图'), '涡度[1/s]',
+                              *args, **kwargs)
+
+    def divergence(self, level=np.linspace(-1e-3, 1e-3, 51), add_features_func=None, *args, **kwargs):
+        lon, lat, data = self._gradient_extract_data('divergence')
+        data = np.nanmean(data, axis=0)
+        draw_manager = HorizontalDistribution(lon, lat)
+        if add_features_func is not None:
+            HorizontalDistribution.add_features = add_features_func
+        draw_manager.contourf(data, level, self.lon_rng, self.lat_rng, self.save_dir.joinpath('散度水平分布图'), '散度[1/s]',
+                              *args, **kwargs)
+
+    def ssc_gradient(self, ssc_name='ssc0', level=np.linspace(0, 1e-3, 51), add_features_func=None, *args, **kwargs):
+        lon, lat, data = self._gradient_extract_data('ssc_gradient', ssc_name)
+        data = np.nanmean(data, axis=0)
+        draw_manager = HorizontalDistribution(lon, lat)
+        if add_features_func is not None:
+            HorizontalDistribution.add_features = add_features_func
+        draw_manager.contourf(data, level, self.lon_rng, self.lat_rng, self.save_dir.joinpath('含沙量梯度水平分布图'),
+                              '含沙量梯度[g/l/m]', *args, **kwargs)
+
 
 class TimeSeriesAniVerify(TimeSeriesVerify):
     def animation_cum_erosion(self):
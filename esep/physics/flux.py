@@ -0,0 +1,185 @@
+# -*- coding:utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+
+                 Project Name : ESEP
+
+                    File Name : flux.py
+
+                   Start Date : 2022-04-20 15:20
+
+                  Contributor : D.CW
+
+                        Email : dengchuangwu@gmail.com
+
+-------------------------------------------------------------------------------
+Introduction:
+
+断面通量
+
+断面线在与网格边的交点处切分，每一段位于单一单元内；各段的长度 dl、法向 n、所在单元
+与段端点、中点的重心权重只计算一次并保存到网格缓存，层厚 dz = -diff(siglev) * (h + zeta)
+中只有 zeta 随时间变化。按时间块读取 u、v、zeta 与含沙量，沿段按 Simpson 公式积分，
+整块一次求和得到
+
+    Q = sum(u·n * dz * dl)          流量(m^3/s)
+    F = sum(u·n * c * dz * dl)      输沙率(c 为 kg/m^3 时为 kg/s)
+
+正方向为沿断面线前进方向的右侧。transport 按时间积分得到净通量、正/负向通量，
+按潮周日分段时正向通量即为各潮周期的纳潮量(断面线方向使涨潮为正时)。
+
+    section = SectionFlux(fvcom, [[121.9, 31.0], [122.1, 31.2]])
+    rslt = section.series(sediment=['ssc0'])
+    prism = transport(rslt['discharge'], rslt['time'], 'tidal')['positive']
+
+-------------------------------------------------------------------------------
+"""
+import numpy as np
+from pygeos import Geometry, get_coordinates
+from scipy import sparse
+
+from ESEP.esep.reader.aggregate import bin_starts
+from ESEP.esep.reader.base import time_blocks
+from ESEP.esep.utils import hpc
+from ESEP.esep.utils.mesh import section_cuts
+from ESEP.esep.utils.unstructured import apply_operator
+
+# Simpson 公式在段起点、中点与终点的权重
+SIMPSON = np.array([1, 4, 1]) / 6
+
+
+class SectionFlux:
+    """ Water discharge and sediment flux through a section of an FVCOM output
+
+    Args:
+        reader (FvcomReader): The reader of the output
+        polyline: The vertices of the section as an array of shape (n, 2) of lon, lat, or a pygeos LineString
+
+    """
+
+    def __init__(self, reader, polyline):
+        self.reader = reader
+        vertices = get_coordinates(polyline) if isinstance(polyline, Geometry) else np.asarray(polyline, dtype=float)
+        cuts = reader.grid_cache.fetch('section-flux',
+                                       lambda: section_cuts(reader.lon, reader.lat, reader.topology, vertices[:, 0],
+                                                            vertices[:, 1]), key=vertices)
+        for name, arr in cuts.items():
+            setattr(self, name, np.asarray(arr))
+
+        # 各段所在单元与三角形的节点，只读取这些单元与节点
+        self.cells, self.cell_pos = np.unique(self.elem, return_inverse=True)
+        corner = np.asarray(reader.tri)[self.elem]
+        self.nodes = np.unique(corner)
+        # 节点值到各段起点、中点与终点的插值，第 3 * i + j 行为第 i 段的第 j 个点
+        rows = np.repeat(np.arange(3 * self.elem.size), 3)
+        cols = np.searchsorted(self.nodes, np.repeat(corner, 3, axis=0)).ravel()
+        self.node_operator = sparse.csr_matrix((self.weights.ravel(), (rows, cols)),
+                                               shape=(3 * self.elem.size, self.nodes.size))
+        self.h = self._points(reader.read('h', nodes=self.nodes))
+        # 各层占水深的比例 (layer, piece, point)
+        self.dsigma = -np.diff(self._points(reader.read('siglev', nodes=self.nodes)), axis=0)
+
+    def _points(self, data) -> np.ndarray:
+        """Node data (..., nodes) at the start, middle and end of the pieces, (..., piece, 3)"""
+        points = apply_operator(self.node_operator, data).astype(np.float64)
+        return np.reshape(points, points.shape[:-1] + (self.elem.size, 3))
+
+    def _blocks(self, n_time, time, time_chunk, sediment):
+        for key in time_blocks(n_time, time, time_chunk):
+            data = {name: self.reader.read(name, time=key, cells=self.cells) for name in ('u', 'v')}
+            data['zeta'] = self.reader.read('zeta', time=key, nodes=self.nodes)
+            for name, on_nodes in sediment.items():
+                if on_nodes:
+                    data[name] = self.reader.read(name, time=key, nodes=self.nodes)
+                else:
+                    data[name] = self.reader.read(name, time=key, cells=self.cells)
+            yield key, data
+
+    def iter_chunks(self, time=None, time_chunk: int = 24, sediment=()):
+        """ The fluxes block by block along time, the next block is read in a background thread
+
+        Args:
+            time: The selection of the time dimension, None, a slice or a sequence of indices
+            time_chunk (int): The number of time steps of each block
+            sediment: The names of the concentrations on siglay whose fluxes are wanted, e.g. ['ssc0']
+
+        Yields:
+            tuple: (time_key, fluxes); fluxes holds the 'discharge' (m^3/s), the wet cross-section 'area' (m^2) and
+            the flux of every sediment variable, each of shape (time,)
+
+        """
+        sediment = [sediment] if isinstance(sediment, str) else list(sediment)
+        # 迭代期间后台线程在读取，文件信息须在开始前取得(netCDF-C 不是线程安全的)
+        sediment = {name: 'node' in self.reader.ds[name].dimensions for name in sediment}
+        n_time = self.reader.ds['u'].shape[0]
+        for key, data in hpc.prefetch(self._blocks(n_time, time, time_chunk, sediment)):
+            u = data['u'][..., self.cell_pos].astype(np.float64)
+            v = data['v'][..., self.cell_pos].astype(np.float64)
+            # 单元内流速为常数，层厚与节点上的含沙量沿段线性变化，Simpson 公式对其乘积精确
+            un = (u * self.nx + v * self.ny) * self.dl
+            depth = np.maximum(self.h + self._points(data['zeta']), 0)
+            fluxes = {'discharge': np.nansum(un * np.einsum('lpj,tpj,j->tlp', self.dsigma, depth, SIMPSON),
+                                             axis=(1, 2)),
+                      'area': np.einsum('tpj,j,p->t', depth, SIMPSON, self.dl)}
+            for name, on_nodes in sediment.items():
+                if on_nodes:
+                    conc = np.einsum('lpj,tpj,tlpj,j->tlp', self.dsigma, depth, self._points(data[name]), SIMPSON)
+                else:
+                    conc = data[name][..., self.cell_pos] * np.einsum('lpj,tpj,j->tlp', self.dsigma, depth, SIMPSON)
+                fluxes[name] = np.nansum(un * conc, axis=(1, 2))
+            yield key, fluxes
+
+    def series(self, time=None, time_chunk: int = 24, sediment=()) -> dict:
+        """ The discharge and sediment flux time series through the section
+
+        Args:
+            time: The selection of the time dimension, None, a slice or a sequence of indices
+            time_chunk (int): The number of time steps read at once
+            sediment: The names of the concentrations on siglay whose fluxes are wanted, e.g. ['ssc0']
+
+        Returns:
+            dict: 'time' (Beijing time) and the series of shape (time,), see iter_chunks
+
+        """
+        n_time = self.reader.ds['u'].shape[0]
+        time_idx = np.arange(n_time)[slice(None) if time is None else time]
+        if not np.size(time_idx):
+            raise ValueError('No time step is selected')
+        blocks = [fluxes for _, fluxes in self.iter_chunks(time, time_chunk, sediment)]
+        rslt = {'time': np.atleast_1d(np.asarray(self.reader.time_bj)[time_idx])}
+        rslt.update({name: np.concatenate([block[name] for block in blocks]) for name in blocks[0]})
+        return rslt
+
+
+def transport(series, time, level: str = None) -> dict:
+    """ Integrate a flux series over time, the trapezoidal rule
+
+    Args:
+        series: The flux of shape (time,), e.g. the discharge in m^3/s or the sediment flux in kg/s
+        time: The times of the series (datetime64)
+        level (str): None integrates the whole series, 'daily', 'tidal' or 'monthly' integrates every bin of
+            reader.aggregate.bin_starts
+
+    Returns:
+        dict: 'start' of every bin, the 'net', 'positive' and 'negative' transport (e.g. m^3 or kg) of every bin;
+        with the discharge and tidal bins the positive (or negative) transport is the tidal prism
+
+    """
+    series = np.asarray(series, dtype=np.float64)
+    time = np.asarray(time, dtype='datetime64[ms]')
+    seconds = (time - time[0]).astype(np.float64) / 1000 if time.size else np.zeros(0)
+    # 梯形积分中各时刻的权重(s)：前后各半个时间步
+    weight = np.zeros(seconds.size)
+    if seconds.size > 1:
+        step = np.diff(seconds)
+        weight[:-1] += step / 2
+        weight[1:] += step / 2
+    amount = np.nan_to_num(series) * weight
+
+    starts = np.full(time.size, time[0] if time.size else np.datetime64('NaT', 'ms')) if level is None else \
+        bin_starts(time, level)
+    start, bins = np.unique(starts, return_inverse=True)
+    return {'start': start,
+            'net': np.bincount(bins, weights=amount, minlength=start.size),
+            'positive': np.bincount(bins, weights=np.maximum(amount, 0), minlength=start.size),
+            'negative': np.bincount(bins, weights=np.minimum(amount, 0), minlength=start.size)}
@@ -19,17 +19,17 @@ Introduction:
                                                                               
 --------------------------------------------------------------------------------
 """
-import PyFVCOM as pf
 import netCDF4 as nc
 import numpy as np
 
 from ESEP.esep.plot import plot as plt
 from ESEP.esep.plot.base import tripcolor, cbar_kw_default
-from ESEP.esep.utils import nodes2elems
+from ESEP.esep.reader.sms import read_sms_mesh
+from ESEP.esep.utils.unstructured import nodes2elems
 
 
 def sms2dm(filepath, save_path, **kwargs):
-    tri, nodes, lon, lat, zeta, types, node_strings = pf.grid.read_sms_mesh(filepath, nodestrings=True)
+    tri, nodes, lon, lat, zeta, types, node_strings = read_sms_mesh(filepath, nodestrings=True)
     zeta = nodes2elems(zeta, tri)
 
     open_boundaries = []
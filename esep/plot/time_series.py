@@ -28,6 +28,7 @@ import numpy as np
 
 from ESEP.esep.plot import plot as _plt
 from ESEP.esep.plot.base import tripcolor, cbar_kw_default
+from ESEP.esep.utils.timer import TimeUtil
 
 
 def plot(filepath, save_path, var_name, time, lev=None, **kwargs):
@@ -44,7 +45,7 @@ def _data_read(filepath, var_name, time_str, lev):
     lon = ds_vars.get('lon')[:]
     lat = ds_vars.get('lat')[:]
     tri = np.transpose(ds_vars.get('nv')[:]) - 1
-    time_idx = _time_proc(ds_vars, time_str)
+    time_idx = _time_proc(ds, time_str)
 
     data = ds_vars.get(var_name)
     cbar_xlabel = ''.join([data.long_name, '[', data.units, ']'])
@@ -55,10 +56,13 @@ def _data_read(filepath, var_name, time_str, lev):
     return lon, lat, tri, data, cbar_xlabel
 
 
-def _time_proc(ds_vars, time_str):
-    time = [datetime.strptime(x.tobytes().decode(), '%Y-%m-%dT%H:%M:%S.%f') for x in ds_vars.get('Times')[:]]
-    time_sel = datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S')
-    return time.index(time_sel)
+def _time_proc(ds, time_str):
+    time = TimeUtil.char_time(ds.filepath(), 'Times', ds)
+    time_sel = np.datetime64(datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S'))
+    time_idx = np.flatnonzero(time == time_sel)
+    if not time_idx.size:
+        raise ValueError('{0} is not in the Times of {1}'.format(time_str, ds.filepath()))
+    return int(time_idx[0])
 
 
 def _h_dist(lon, lat, tri, data, cbar_xlabel=None, cbar_rng=None, cbar_position=None, figure_kwargs=None,
@@ -86,7 +90,7 @@ class TimeSeries:
         if add_zero:
             self.ax.hlines(0, -9E99, 9E99, linestyles='--', colors='black')
         self.ax.set_xticks(xticks)
-        self.ax.set_xticklabels([x.strftime('%d-%H:%M') for x in xticks])
+        self.ax.set_xticklabels([x.strftime('%d-%H:%M') for x in np.asarray(xticks).astype('datetime64[ms]').tolist()])
         if add_xlabel:
             self.ax.set_xlabel('时间', fontsize=16)
 
@@ -103,10 +107,11 @@ class TimeSeries:
         self.ax.legend(loc='upper right', fontsize=12)
 
     def _save_fig(self, save_path):
-        self.fig.savefig(save_path, fomart='png', bbox_inches='tight', pad_inches=0.1)
+        self.fig.savefig(save_path, format='png', bbox_inches='tight', pad_inches=0.1)
         self.ax.cla()
 
     def sediment(self, obs_time, model_time, obs, model, save_path):
+        obs_time, model_time = TimeUtil.to_datetime64(obs_time), TimeUtil.to_datetime64(model_time)
         obs_invl = np.round(np.size(obs_time) / self.min_num_data).astype(int)
         model_invl = np.round(np.size(model_time) / self.min_num_data).astype(int)
         if not model_invl or not obs_invl:
@@ -117,6 +122,7 @@ class TimeSeries:
         self._save_fig(save_path)
 
     def depth(self, obs_time, model_time, obs, model, save_path):
+        obs_time, model_time = TimeUtil.to_datetime64(obs_time), TimeUtil.to_datetime64(model_time)
         obs_invl = np.round(np.size(obs_time) / self.min_num_data).astype(int)
         model_invl = np.round(np.size(model_time) / self.min_num_data).astype(int)
         if not model_invl or not obs_invl:
@@ -128,6 +134,7 @@ class TimeSeries:
         self._save_fig(save_path)
 
     def cs_dir(self, obs_time, model_time, obs, model, save_path):
+        obs_time, model_time = TimeUtil.to_datetime64(obs_time), TimeUtil.to_datetime64(model_time)
         obs_invl = np.round(np.size(obs_time) / self.min_num_data).astype(int)
         model_invl = np.round(np.size(model_time) / self.min_num_data).astype(int)
         if not model_invl or not obs_invl:
@@ -0,0 +1,326 @@
+# -*- coding:utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+
+                 Project Name : ESEP
+
+                    File Name : aggregate.py
+
+                   Start Date : 2022-04-16 09:20
+
+                  Contributor : D.CW
+
+                        Email : dengchuangwu@gmail.com
+
+-------------------------------------------------------------------------------
+Introduction:
+
+FVCOM 输出的时间聚合金字塔
+
+一次顺序读取模式输出，按北京时间写出逐日、逐潮周期(太阴日 24h50m)与逐月的均值、
+最大值与最小值聚合文件(逐月由逐日聚合得到)。聚合文件保存在缓存目录下，以源文件的
+签名为键，源文件改写后自动失效。
+
+求某时间段的时间平均时，依次用能完整落入时间段的最粗一级聚合覆盖所选时刻，剩余
+时刻再用次一级聚合，最后才读取原始输出，按各部分的时刻数加权得到平均值。
+
+-------------------------------------------------------------------------------
+"""
+import os
+import tempfile
+from pathlib import Path
+
+import netCDF4 as nc
+import numpy as np
+
+from ESEP.esep.reader.base import hyperslab_read
+from ESEP.esep.utils.cache import default_cache_dir, key_hash
+from ESEP.esep.utils.utils import file_signature
+
+# 由粗到细，值为聚合的来源，None 表示原始输出
+LEVELS = {'monthly': 'daily', 'tidal': None, 'daily': None}
+# 太阴日，两个 M2 周期
+TIDAL_DAY = np.timedelta64(89428, 's')
+DIM_ALIAS = {'time': 'time', 'siglay': 'layer', 'siglev': 'layer', 'nele': 'cells', 'node': 'nodes'}
+
+
+def bin_starts(time, level: str) -> np.ndarray:
+    """The start (datetime64[ms]) of the bin of every time step"""
+    time = np.asarray(time, dtype='datetime64[ms]')
+    if level == 'daily':
+        return time.astype('datetime64[D]').astype('datetime64[ms]')
+    if level == 'monthly':
+        return time.astype('datetime64[M]').astype('datetime64[ms]')
+    if level == 'tidal':
+        period = TIDAL_DAY.astype('timedelta64[ms]')
+        return time[0] + (time - time[0]) // period * period
+    raise ValueError('Unknown aggregate level {0}'.format(level))
+
+
+def aggregate_variables(ds) -> list:
+    """The float variables of an FVCOM output varying in time on the nodes or elements"""
+    return [name for name, var in ds.variables.items()
+            if var.dimensions and var.dimensions[0] == 'time' and {'node', 'nele'} & set(var.dimensions)
+            and np.issubdtype(var.dtype, np.floating)]
+
+
+def _bin_runs(bins: np.ndarray) -> list:
+    """(bin, start, stop) of the runs of equal consecutive bins"""
+    edges = np.flatnonzero(np.diff(bins)) + 1
+    starts = np.concatenate([[0], edges])
+    stops = np.concatenate([edges, [bins.size]])
+    return [(int(bins[start]), int(start), int(stop)) for start, stop in zip(starts, stops)]
+
+
+class _Accumulator:
+    """Weighted running mean, max and min of the current bin, flushed to the output when the bin changes"""
+
+    def __init__(self, out_vars):
+        self.out_vars = out_vars
+        self.bin = None
+
+    def add(self, bin_id, weights, mean, maxv, minv):
+        if bin_id != self.bin:
+            self.flush()
+            self.bin = bin_id
+            self.sum = self.weight = self.max = self.min = None
+        valid = ~np.isnan(mean)
+        w = np.where(valid, np.reshape(weights, (-1,) + (1,) * (mean.ndim - 1)), 0)
+        part_sum, part_weight = np.sum(np.where(valid, mean, 0) * w, axis=0), np.sum(w, axis=0)
+        # 全为 NaN 的网格点保持 NaN，不产生警告
+        part_max = np.max(np.where(valid, maxv, -np.inf), axis=0)
+        part_min = np.min(np.where(valid, minv, np.inf), axis=0)
+        if self.sum is None:
+            self.sum, self.weight, self.max, self.min = part_sum, part_weight, part_max, part_min
+        else:
+            self.sum += part_sum
+            self.weight += part_weight
+            np.maximum(self.max, part_max, out=self.max)
+            np.minimum(self.min, part_min, out=self.min)
+
+    def flush(self):
+        if self.bin is None:
+            return
+        empty = self.weight == 0
+        mean = self.sum / np.where(empty, 1, self.weight)
+        for values, out in zip((mean, self.max, self.min), self.out_vars):
+            out[self.bin] = np.where(empty, np.nan, values)
+        self.bin = None
+
+
+class TemporalAggregates:
+    """ The temporal aggregates of an FVCOM output
+
+    Args:
+        reader (FvcomReader): The reader of the output
+        cache_dir: The cache directory, defaults to the reader's cache directory
+
+    """
+
+    def __init__(self, reader, cache_dir=None):
+        self.reader = reader
+        cache_dir = reader.cache_dir if cache_dir is None else cache_dir
+        files = reader.fp if isinstance(reader.fp, list) else [reader.fp]
+        self.key = key_hash([file_signature(fp) for fp in files])
+        self.root = Path(default_cache_dir() if cache_dir is None else cache_dir).joinpath('aggregate')
+        self._datasets = {}
+
+    def path(self, level: str) -> Path:
+        return self.root.joinpath('{0}.{1}.nc'.format(self.key, level))
+
+    def dataset(self, level: str):
+        """The opened aggregate file of a level, None if it has not been built"""
+        if level not in self._datasets:
+            fp = self.path(level)
+            self._datasets[level] = nc.Dataset(fp) if fp.is_file() else None
+        return self._datasets[level]
+
+    def available(self, var_name) -> list:
+        """The built levels holding var_name, coarse first"""
+        return [level for level in LEVELS if self.dataset(level) is not None
+                and var_name in self.dataset(level).variables]
+
+    def build(self, var_names=None, levels=('daily', 'monthly'), time_chunk: int = 24) -> dict:
+        """ Stream through the output once per level and write the aggregate files
+
+        Args:
+            var_names: The variables to aggregate, defaults to every float variable varying in time on the mesh
+            levels: Among 'daily', 'tidal' and 'monthly'; monthly is built from daily when daily is built too
+            time_chunk (int): The number of time steps read at once
+
+        Returns:
+            dict: key is the level, value is the path of its aggregate file
+
+        """
+        unknown = set(levels) - set(LEVELS)
+        if unknown:
+            raise ValueError('Unknown aggregate levels {0}'.format(sorted(unknown)))
+        var_names = aggregate_variables(self.reader.ds) if var_names is None else list(var_names)
+        # 先建细的一级，粗的一级从已建的细一级聚合
+        paths = {}
+        for level in sorted(levels, key=lambda lv: LEVELS[lv] is not None):
+            parent = LEVELS[level]
+            source = parent if parent is not None and (parent in paths or self.dataset(parent) is not None) else None
+            paths[level] = self._build_level(level, source, var_names, time_chunk)
+        return paths
+
+    def _build_level(self, level, source, var_names, time_chunk) -> Path:
+        time = np.asarray(self.reader.time_bj, dtype='datetime64[ms]')
+        starts = bin_starts(time, level)
+        step_bin = np.concatenate([[0], np.cumsum(starts[1:] != starts[:-1])])
+        first = np.flatnonzero(np.concatenate([[True], step_bin[1:] != step_bin[:-1]]))
+        count = np.diff(np.concatenate([first, [time.size]]))
+
+        src = self.reader.ds
+        fp = self.path(level)
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_fp = tempfile.mkstemp(suffix='.nc', dir=fp.parent)
+        os.close(fd)
+        old = self._datasets.pop(level, None)
+        if old is not None:
+            old.close()
+        try:
+            with nc.Dataset(tmp_fp, 'w', format='NETCDF4') as dst:
+                dst.setncatts({'level': level, 'source': source or 'output'})
+                dst.createDimension('time', None)
+                time_var = dst.createVariable('time', 'i8', ('time',))
+                time_var.units = 'milliseconds since 1970-01-01 00:00:00 +08:00'
+                time_var.long_name = 'start of the bin, Beijing time'
+                time_var[:] = starts[first].astype(np.int64)
+                dst.createVariable('first', 'i8', ('time',))[:] = first
+                dst.createVariable('count', 'i8', ('time',))[:] = count
+                for var_name in var_names:
+                    var = src[var_name]
+                    for dim in var.dimensions[1:]:
+                        if dim not in dst.dimensions:
+                            dst.createDimension(dim, len(src.dimensions[dim]))
+                    chunks = [1] + list(var.shape[1:])
+                    out_vars = [dst.createVariable(name, 'f4', var.dimensions, zlib=True, complevel=1,
+                                                   chunksizes=chunks, fill_value=np.float32(np.nan))
+                                for name in (var_name, var_name + '_max', var_name + '_min')]
+                    for out, stat in zip(out_vars, ('mean', 'max', 'min')):
+                        out.setncatts({attr: var.getncattr(attr) for attr in ('long_name', 'units')
+                                       if attr in var.ncattrs()})
+                        out.cell_methods = 'time: {0}'.format(stat)
+                    self._reduce(var_name, source, step_bin, out_vars, time_chunk)
+            os.replace(tmp_fp, fp)
+        finally:
+            if os.path.exists(tmp_fp):
+                os.remove(tmp_fp)
+        return fp
+
+    def _reduce(self, var_name, source, step_bin, out_vars, time_chunk):
+        acc = _Accumulator(out_vars)
+        if source is None:
+            # 主线程同时写聚合文件，不能在后台线程预读(netCDF-C 不是线程安全的)
+            for time_key, block in self.reader.iter_chunks(var_name, time_chunk, prefetch=False):
+                block = np.asarray(block, dtype=np.float32)
+                bins = step_bin[time_key]
+                for bin_id, start, stop in _bin_runs(bins):
+                    part = block[start:stop]
+                    acc.add(bin_id, np.ones(stop - start), part, part, part)
+        else:
+            # 细一级的每个聚合时段完全落在粗一级的某个时段内，以时刻数为权重
+            ds = self.dataset(source)
+            src_bin = step_bin[ds['first'][:]]
+            src_count = ds['count'][:]
+            for start in range(0, src_bin.size, time_chunk):
+                stop = min(start + time_chunk, src_bin.size)
+                mean, maxv, minv = (np.ma.filled(ds[name][start:stop], np.nan)
+                                    for name in (var_name, var_name + '_max', var_name + '_min'))
+                for bin_id, run_start, run_stop in _bin_runs(src_bin[start:stop]):
+                    acc.add(bin_id, src_count[start:stop][run_start:run_stop], mean[run_start:run_stop],
+                            maxv[run_start:run_stop], minv[run_start:run_stop])
+        acc.flush()
+
+    def _usable(self, level, remaining):
+        """The bins of a level whose time steps are all remaining and their counts, None if it does not fit"""
+        ds = self.dataset(level)
+        first, count = ds['first'][:], ds['count'][:]
+        if count.sum() != remaining.size:
+            return None
+        cum = np.concatenate([[0], np.cumsum(remaining)])
+        return cum[first + count] - cum[first] == count, count
+
+    def plan(self, var_name, time_idx) -> list:
+        """ Cover the time steps with the coarsest aggregates
+
+        Monthly bins are unions of daily bins and are used first; tidal and daily bins do not nest, so of the two the
+        level covering more of the remaining steps is used first.
+
+        Args:
+            var_name (str): The name of the variable
+            time_idx: The indices of the time steps of the output
+
+        Returns:
+            list: (level, indices of its bins) for every level used, then (None, indices of the remaining steps)
+
+        """
+        remaining = np.zeros(len(self.reader.time_bj), dtype=bool)
+        remaining[time_idx] = True
+        plan = []
+        candidates = self.available(var_name)
+        while candidates:
+            options = []
+            for level in candidates:
+                fit = self._usable(level, remaining)
+                if fit is not None and fit[0].any():
+                    options.append((level,) + fit)
+            if not options:
+                break
+            nested = [opt for opt in options if LEVELS[opt[0]] is not None]
+            level, usable, count = nested[0] if nested else max(options, key=lambda opt: opt[2][opt[1]].sum())
+            plan.append((level, np.flatnonzero(usable)))
+            remaining &= ~np.repeat(usable, count)
+            candidates.remove(level)
+        plan.append((None, np.flatnonzero(remaining)))
+        return plan
+
+    def time_mean(self, var_name, time_idx=None, layer=None, cells=None, nodes=None, time_chunk: int = 24):
+        """ The mean of a variable over some time steps, read from the aggregates where possible
+
+        Args:
+            var_name (str): The name of the variable
+            time_idx: The indices of the time steps of the output, None for all
+            layer: The selection of the siglay/siglev dimension
+            cells: The selection of the nele dimension
+            nodes: The selection of the node dimension
+            time_chunk (int): The number of time steps read at once from the output
+
+        Returns:
+            np.ndarray: The mean without the time dimension, NaN is ignored
+
+        """
+        if time_idx is None:
+            time_idx = np.arange(len(self.reader.time_bj))
+        selection = {'layer': layer, 'cells': cells, 'nodes': nodes}
+        total = weight = None
+
+        def _add(data, weights):
+            nonlocal total, weight
+            valid = ~np.isnan(data)
+            w = np.where(valid, np.reshape(weights, (-1,) + (1,) * (data.ndim - 1)), 0)
+            part_sum, part_weight = np.sum(np.where(valid, data, 0) * w, axis=0), np.sum(w, axis=0)
+            total = part_sum if total is None else total + part_sum
+            weight = part_weight if weight is None else weight + part_weight
+
+        for level, idx in self.plan(var_name, time_idx):
+            if not idx.size:
+                continue
+            if level is None:
+                for _, block in self.reader.iter_chunks(var_name, time_chunk, time=idx, **selection):
+                    _add(np.asarray(block, dtype=np.float64), np.ones(block.shape[0]))
+            else:
+                var = self.dataset(level)[var_name]
+                keys = [dict(selection, time=idx).get(DIM_ALIAS.get(dim)) for dim in var.dimensions]
+                _add(np.asarray(hyperslab_read(var, keys), dtype=np.float64), self.dataset(level)['count'][idx])
+        if total is None:
+            raise ValueError('No time step is selected')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weight > 0, total / weight, np.nan)
+
+    def close(self):
+        for ds in self._datasets.values():
+            if ds is not None:
+                ds.close()
+        self._datasets = {}
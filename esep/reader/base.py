@@ -19,21 +19,131 @@ Introduction:
 
 -------------------------------------------------------------------------------
 """
-from datetime import datetime, timedelta
+from itertools import product
 from pathlib import Path
 
 import netCDF4 as nc
 import numpy as np
 
+from ESEP.esep.reader.multifile import MFTimeDataset, build_time_index
+from ESEP.esep.utils.cache import GridCache
+from ESEP.esep.utils import hpc
+from ESEP.esep.utils.decorator import lazy_property
+from ESEP.esep.utils.mesh import MeshGradient, MeshTopology
+from ESEP.esep.utils.utils import idx2slices
+
+
+def _normalize_key(key, size: int, max_gap: int) -> tuple:
+    """Convert the selection of one dimension to hyperslab blocks
+
+    Args:
+        key: None, int, slice, boolean mask or sequence of indices
+        size (int): The length of the dimension
+        max_gap (int): The largest gap bridged by a single block
+
+    Returns:
+        tuple: (blocks, take, drop); blocks is the list of slices to read, take is the index array that restores the
+        requested order from the concatenated blocks (None if not needed) and drop tells whether the dimension is
+        removed from the result like numpy does for integer keys
+
+    """
+    if key is None:
+        return [slice(0, size)], None, False
+    if isinstance(key, (int, np.integer)):
+        if not -size <= key < size:
+            raise IndexError('index {0} is out of bounds for size {1}'.format(key, size))
+        key = int(key) % size
+        return [slice(key, key + 1)], None, True
+    if isinstance(key, slice):
+        start, stop, step = key.indices(size)
+        if step == 1:
+            return [slice(start, max(start, stop))], None, False
+        key = np.arange(start, stop, step)
+
+    idx = np.asarray(key)
+    if idx.dtype == bool:
+        if idx.size != size:
+            raise IndexError('boolean index did not match the size {0}'.format(size))
+        idx = np.flatnonzero(idx)
+    idx = np.where(idx < 0, idx + size, idx).astype(np.int64).ravel()
+    if idx.size and (idx.min() < 0 or idx.max() >= size):
+        raise IndexError('index is out of bounds for size {0}'.format(size))
+
+    uniq, inverse = np.unique(idx, return_inverse=True)
+    blocks = idx2slices(uniq, max_gap)
+    starts = np.array([blk.start for blk in blocks], dtype=np.int64)
+    lengths = np.array([blk.stop - blk.start for blk in blocks], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    block_id = np.searchsorted(starts, uniq, side='right') - 1
+    take = (offsets[block_id] + uniq - starts[block_id])[inverse]
+    if take.size == lengths.sum() and np.array_equal(take, np.arange(take.size)):
+        take = None
+    return blocks, take, False
+
+
+def hyperslab_read(var, keys, max_gap: int = 16) -> np.ndarray:
+    """Read an orthogonal selection of a netCDF variable with the fewest hyperslab requests
+
+    Every dimension is split into contiguous blocks and only the cartesian product of those blocks is read, so the
+    whole variable is never materialised. Missing values of float variables are returned as NaN.
+
+    Args:
+        var: netCDF4.Variable or any object that supports slicing with a tuple of slices
+        keys: The selection of each dimension, see _normalize_key
+        max_gap (int): The largest gap of unused items bridged by one request
+
+    Returns:
+        np.ndarray: The selected data, dimensions selected by an integer are removed
+
+    """
+    shape = var.shape
+    keys = list(keys) + [None] * (len(shape) - len(keys))
+    normalized = [_normalize_key(key, size, max_gap) for key, size in zip(keys, shape)]
+
+    dtype = np.dtype(var.dtype)
+    out_shape = tuple(sum(blk.stop - blk.start for blk in blocks) for blocks, _, _ in normalized)
+    out = np.empty(out_shape, dtype=dtype)
+    if out.size:
+        dst_ls = []
+        for blocks, _, _ in normalized:
+            lengths = np.array([blk.stop - blk.start for blk in blocks], dtype=np.int64)
+            dst_ls.append([slice(int(o), int(o + n)) for o, n in zip(np.cumsum(lengths) - lengths, lengths)])
+        for src, dst in zip(product(*[blocks for blocks, _, _ in normalized]), product(*dst_ls)):
+            block = var[src]
+            if np.ma.isMaskedArray(block):
+                block = block.filled(np.nan) if dtype.kind == 'f' else block.data
+            out[dst] = block
+
+    for axis, (_, take, _) in enumerate(normalized):
+        if take is not None:
+            out = np.take(out, take, axis=axis)
+    drop = tuple(0 if is_drop else slice(None) for _, _, is_drop in normalized)
+    return out[drop]
+
 
 class ModelBaseReader:
     time_name = None
 
     def __init__(self, fp):
-        self.ds = nc.MFDataset(fp) if isinstance(fp, list) else nc.Dataset(fp)
-        self.lon = self.ds['lon'][:]
-        self.lat = self.ds['lat'][:]
-        self.time = self.ds[self.time_name][:]
+        self.fp = fp
+        # 多文件时按时间维虚拟拼接，只在读取时打开所需的文件
+        self.ds = MFTimeDataset(fp, self.time_name) if isinstance(fp, list) else nc.Dataset(fp)
+
+    # 打开文件只读取文件头，坐标与时间在首次访问时读取
+    @lazy_property
+    def lon(self):
+        return self.ds['lon'][:]
+
+    @lazy_property
+    def lat(self):
+        return self.ds['lat'][:]
+
+    @lazy_property
+    def time(self):
+        return self._read_time()
+
+    def _read_time(self):
+        return self.ds[self.time_name][:]
 
     def variables(self, variables_name: list):
         for var_name in variables_name:
@@ -41,14 +151,165 @@ class ModelBaseReader:
 
 
 class UnstructuredReaderModel(ModelBaseReader):
-    def __init__(self, fp):
-        super(UnstructuredReaderModel, self).__init__(fp)
-        self.time = np.array([datetime.strptime(x.tobytes().decode(), '%Y-%m-%dT%H:%M:%S.%f') for x in self.time])
-        self.time_bj = np.array([x + timedelta(hours=8) for x in self.time])
-        self.lonc = self.ds['lonc'][:]
-        self.latc = self.ds['latc'][:]
+    # 网格缓存根目录，None 时使用 ESEP_CACHE_DIR 或 ~/.cache/esep
+    cache_dir = None
+
+    @lazy_property
+    def grid_cache(self) -> GridCache:
+        """网格派生信息(区域掩膜、检索结果等)的磁盘缓存，相同网格的算例共用
+
+        文件签名到网格哈希的对应关系另存一份，再次打开同一文件时不必读取网格
+        """
+        fp = self.fp[0] if isinstance(self.fp, list) else self.fp
+        return GridCache.from_file(fp, self._read_mesh, self.cache_dir)
+
+    def _read_mesh(self) -> tuple:
         # 减去1是将 node ID 转为python中的 node index
-        self.tri = np.transpose(self.ds['nv'][:]) - 1
+        return self.ds['lon'][:], self.ds['lat'][:], np.transpose(self.ds['nv'][:]) - 1
+
+    @lazy_property
+    def _mesh(self) -> dict:
+        mesh = self.grid_cache.load('mesh')
+        if mesh is None:
+            mesh = dict(zip(('lon', 'lat', 'tri'), self._read_mesh()))
+        # 首次读文件得到掩码数组，读缓存得到 memmap，统一为 ndarray
+        return {name: np.asarray(np.ma.getdata(arr)) for name, arr in mesh.items()}
+
+    @lazy_property
+    def _centres(self) -> dict:
+        def _build():
+            return {'lonc': self.ds['lonc'][:], 'latc': self.ds['latc'][:]}
+
+        try:
+            centres = self.grid_cache.fetch('centres', _build)
+        except OSError:
+            centres = _build()
+        return {name: np.asarray(np.ma.getdata(arr)) for name, arr in centres.items()}
+
+    @lazy_property
+    def topology(self) -> MeshTopology:
+        """邻接关系、边与面积，首次访问时构建并保存到网格缓存"""
+        return MeshTopology.from_mesh(self.lon, self.lat, self.tri, self.grid_cache)
+
+    @lazy_property
+    def gradient(self) -> MeshGradient:
+        """梯度、涡度与散度算子"""
+        return MeshGradient(self.lon, self.lat, self.tri, self.topology, self.grid_cache)
+
+    @lazy_property
+    def lon(self):
+        return self._mesh['lon']
+
+    @lazy_property
+    def lat(self):
+        return self._mesh['lat']
+
+    @lazy_property
+    def tri(self):
+        return self._mesh['tri']
+
+    @lazy_property
+    def lonc(self):
+        return self._centres['lonc']
+
+    @lazy_property
+    def latc(self):
+        return self._centres['latc']
+
+    def _read_time(self):
+        # 字符型时间按文件矢量化解码，与各文件的时间长度一起缓存到磁盘
+        if isinstance(self.ds, MFTimeDataset):
+            return self.ds.time
+        return build_time_index([self.fp], 'time', self.time_name)['time']
+
+    @lazy_property
+    def time_bj(self):
+        """北京时间，首次访问时才计算"""
+        return self.time + np.timedelta64(8, 'h')
+
+    # 变量维度名与 read 中选择参数的对应关系
+    dim_alias = {
+        'time': 'time',
+        'siglay': 'layer',
+        'siglev': 'layer',
+        'nele': 'cells',
+        'node': 'nodes',
+    }
+
+    def read(self, var_name, time=None, layer=None, cells=None, nodes=None, max_gap=16) -> np.ndarray:
+        """Read a subset of a variable without loading the whole variable
+
+        Each selection may be None (the whole dimension), an int, a slice, a boolean mask or a sequence of indices.
+        Selections that do not apply to the dimensions of the variable are ignored. The selection is turned into the
+        smallest set of netCDF hyperslab reads and the result keeps the requested order of indices.
+
+        Args:
+            var_name (str): The name of the variable
+            time: The selection of the time dimension
+            layer: The selection of the siglay/siglev dimension
+            cells: The selection of the nele dimension
+            nodes: The selection of the node dimension
+            max_gap (int): The largest gap of unused items read in one request instead of two
+
+        Returns:
+            np.ndarray: The selected data, float missing values are NaN
+
+        """
+        var = self.ds[var_name]
+        selection = {'time': time, 'layer': layer, 'cells': cells, 'nodes': nodes}
+        keys = [selection.get(self.dim_alias.get(dim)) for dim in var.dimensions]
+        return hyperslab_read(var, keys, max_gap)
+
+    def iter_chunks(self, var_name, time_chunk: int = 24, time=None, layer=None, cells=None, nodes=None,
+                    prefetch: bool = True, max_gap: int = 16):
+        """Read a variable block by block along the time dimension
+
+        The next block is read in a background thread while the caller processes the current one, so at most three
+        blocks are alive at once: the one held by the caller, one queued and one being read. Do not read from this
+        reader in other threads while iterating, netCDF-C is not thread-safe.
+
+        Args:
+            var_name (str): The name of the variable, it must have the time dimension
+            time_chunk (int): The number of time steps of each block
+            time: The selection of the time dimension, None, a slice or a sequence of indices
+            layer: The selection of the siglay/siglev dimension
+            cells: The selection of the nele dimension
+            nodes: The selection of the node dimension
+            prefetch (bool): Read the next block in a background thread
+            max_gap (int): See read
+
+        Yields:
+            tuple: (time_key, data); time_key is the slice of time indices of the block, or their index array when
+            time is not a contiguous selection, and data is the block as returned by read
+
+        """
+        dims = self.ds[var_name].dimensions
+        if 'time' not in dims:
+            raise ValueError('{0} has no time dimension'.format(var_name))
+        n_time = self.ds[var_name].shape[dims.index('time')]
+
+        def _blocks():
+            for key in time_blocks(n_time, time, time_chunk):
+                yield key, self.read(var_name, time=key, layer=layer, cells=cells, nodes=nodes, max_gap=max_gap)
+
+        return hpc.prefetch(_blocks()) if prefetch else _blocks()
+
+
+def time_blocks(n_time: int, time=None, time_chunk: int = 24):
+    """ Split a selection of the time dimension into blocks of time_chunk steps
+
+    Yields:
+        The slice of every block when the selection is contiguous, otherwise the index array of the block
+
+    """
+    time_idx = np.arange(n_time)[slice(None) if time is None else time]
+    if np.ndim(time_idx) == 0:
+        time_idx = np.atleast_1d(time_idx)
+    contiguous = time_idx.size > 0 and np.all(np.diff(time_idx) == 1)
+    time_chunk = max(1, int(time_chunk))
+    for start in range(0, time_idx.size, time_chunk):
+        idx = time_idx[start:start + time_chunk]
+        yield slice(int(idx[0]), int(idx[-1]) + 1) if contiguous else idx
 
 
 class NormalReader:
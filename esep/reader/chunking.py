@@ -0,0 +1,316 @@
+# -*- coding:utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+
+                 Project Name : ESEP
+
+                    File Name : chunking.py
+
+                   Start Date : 2022-04-14 09:40
+
+                  Contributor : D.CW
+
+                        Email : dengchuangwu@gmail.com
+
+-------------------------------------------------------------------------------
+Introduction:
+
+FVCOM 输出文件的分块(chunk)布局检查与重新分块
+
+站点时间序列读取 u[:, lev, cell] 与水平分布读取 u[t] 的访问方向相反，默认按时间
+分块的文件读取站点序列时要解压文件中的每个分块。这里提供：
+    inspect_chunking -- 各变量的分块与两种访问方式各需读取的分块数
+    benchmark -- 实测站点与平面两种读取方式的耗时
+    recommend_chunks -- 按访问方式给出分块大小
+    rechunk -- 按指定布局重写文件或写出副本
+
+python -m ESEP.esep.reader.chunking {inspect,benchmark,rechunk} ...
+
+-------------------------------------------------------------------------------
+"""
+import argparse
+import os
+import tempfile
+import time as timer
+from itertools import product
+from pathlib import Path
+
+import netCDF4 as nc
+import numpy as np
+
+PATTERNS = ('station', 'map', 'balanced')
+# 分块目标大小，netCDF/HDF5 建议分块在 1MB 左右
+TARGET_CHUNK_BYTES = 2 ** 20
+
+
+def _chunks_touched(shape, chunks, selection) -> int:
+    """The number of chunks touched by reading selection, a tuple of (start, stop) for every dimension"""
+    total = 1
+    for size, chunk, (start, stop) in zip(shape, chunks, selection):
+        stop = min(stop, size)
+        total *= (stop - 1) // chunk - start // chunk + 1 if stop > start else 0
+    return total
+
+
+def _access_selection(dims, shape, pattern) -> tuple:
+    # station: 单个网格点的全部时间与层次；map: 单个时刻的全部网格点与层次
+    selection = []
+    for dim, size in zip(dims, shape):
+        if dim == 'time':
+            selection.append((0, size) if pattern == 'station' else (0, 1))
+        elif dim in ('node', 'nele'):
+            selection.append((0, 1) if pattern == 'station' else (0, size))
+        else:
+            selection.append((0, size))
+    return tuple(selection)
+
+
+def _chunking(var):
+    """The chunk sizes of a variable, 'contiguous' also for the variables of netCDF3 files"""
+    chunking = var.chunking()
+    return 'contiguous' if chunking is None else chunking
+
+
+def inspect_chunking(fp, var_names=None) -> dict:
+    """ The chunk layout of the variables and the chunks touched by station and map reads
+
+    Args:
+        fp: The path of the netCDF file
+        var_names: The names of the variables, default all the variables on the node or nele dimension
+
+    Returns:
+        dict: {var_name: {'dimensions', 'shape', 'chunking', 'compression', 'station_chunks', 'map_chunks'}}; a
+        contiguous variable is counted as one chunk
+
+    """
+    info = {}
+    with nc.Dataset(fp) as ds:
+        for name in var_names or [n for n, v in ds.variables.items() if {'node', 'nele'} & set(v.dimensions)]:
+            var = ds[name]
+            chunking = _chunking(var)
+            chunks = var.shape if chunking == 'contiguous' else chunking
+            info[name] = {
+                'dimensions': var.dimensions,
+                'shape': var.shape,
+                'chunking': chunking,
+                'compression': var.filters(),
+                'station_chunks': _chunks_touched(var.shape, chunks,
+                                                  _access_selection(var.dimensions, var.shape, 'station')),
+                'map_chunks': _chunks_touched(var.shape, chunks, _access_selection(var.dimensions, var.shape, 'map')),
+            }
+    return info
+
+
+def benchmark(fp, var_name, n_read: int = 5, seed: int = 0) -> dict:
+    """ Time station reads (one grid point, all time steps) and map reads (one time step, all grid points)
+
+    The chunk cache is reset before every read, so each read pays the decompression of the chunks it touches.
+
+    Args:
+        fp: The path of the netCDF file
+        var_name (str): The name of a variable on the (time, [layer,] node/nele) dimensions
+        n_read (int): The number of random reads of each kind
+        seed (int): The seed of the random grid points and time steps
+
+    Returns:
+        dict: The mean seconds of a station read and of a map read
+
+    """
+    rng = np.random.default_rng(seed)
+    result = {}
+    with nc.Dataset(fp) as ds:
+        var = ds[var_name]
+        dims = var.dimensions
+        for pattern in ('station', 'map'):
+            elapsed = []
+            for _ in range(n_read):
+                key = []
+                for dim, size in zip(dims, var.shape):
+                    if dim == 'time' and pattern == 'map':
+                        key.append(int(rng.integers(size)))
+                    elif dim in ('node', 'nele') and pattern == 'station':
+                        key.append(int(rng.integers(size)))
+                    else:
+                        key.append(slice(None))
+                # netCDF3 文件没有分块缓存
+                if not ds.data_model.startswith('NETCDF3'):
+                    cache_size, cache_nelems, cache_preemption = var.get_var_chunk_cache()
+                    var.set_var_chunk_cache(0, cache_nelems, cache_preemption)
+                    var.set_var_chunk_cache(cache_size, cache_nelems, cache_preemption)
+                start = timer.perf_counter()
+                var[tuple(key)]
+                elapsed.append(timer.perf_counter() - start)
+            result[pattern] = float(np.mean(elapsed))
+    return result
+
+
+def recommend_chunks(dims, shape, itemsize: int, pattern: str = 'station',
+                     target_bytes: int = TARGET_CHUNK_BYTES) -> list:
+    """ Chunk sizes of a variable for an access pattern
+
+    station keeps the whole time dimension in a chunk and splits the grid, map keeps one time step and the whole
+    grid, balanced splits both so that either read touches a moderate number of chunks. Other dimensions (layers)
+    are never split.
+
+    Args:
+        dims: The dimension names of the variable
+        shape: The shape of the variable
+        itemsize (int): The size in bytes of one value
+        pattern (str): 'station', 'map' or 'balanced'
+        target_bytes (int): The wanted size of a chunk
+
+    Returns:
+        list: The chunk size of every dimension
+
+    """
+    if pattern not in PATTERNS:
+        raise ValueError('pattern must be one of {0}'.format(PATTERNS))
+    dims, shape = list(dims), [max(int(size), 1) for size in shape]
+    chunks = list(shape)
+    time_axis = dims.index('time') if 'time' in dims else None
+    grid_axis = next((i for i, dim in enumerate(dims) if dim in ('node', 'nele')), None)
+    other = int(np.prod([size for i, size in enumerate(shape) if i not in (time_axis, grid_axis)])) * itemsize
+    budget = max(target_bytes // max(other, 1), 1)
+
+    if time_axis is not None and grid_axis is not None:
+        n_time, n_grid = shape[time_axis], shape[grid_axis]
+        if pattern == 'station':
+            chunks[time_axis] = n_time
+            chunks[grid_axis] = min(n_grid, max(budget // n_time, 1))
+        elif pattern == 'map':
+            chunks[time_axis] = 1
+            chunks[grid_axis] = min(n_grid, budget)
+        else:
+            side = max(int(np.sqrt(budget)), 1)
+            chunks[time_axis] = min(n_time, side)
+            chunks[grid_axis] = min(n_grid, max(budget // chunks[time_axis], 1))
+    elif grid_axis is not None:
+        chunks[grid_axis] = min(shape[grid_axis], budget)
+    elif time_axis is not None:
+        chunks[time_axis] = min(shape[time_axis], budget)
+    return chunks
+
+
+def _copy_variable(src_var, dst_var, memory_bytes: int):
+    """ Copy a variable in blocks aligned with the source chunks, so every source chunk is decompressed only once
+
+    The leading dimension is split first, in multiples of its source chunk size, and the next dimensions only while
+    a block is still larger than memory_bytes. The destination chunk cache gets the same budget, so destination
+    chunks filled by several blocks are compressed as few times as possible.
+    """
+    shape = src_var.shape
+    if not shape:
+        dst_var.assignValue(src_var.getValue())
+        return
+    if not np.prod(shape):
+        return
+    chunking = _chunking(src_var)
+    src_chunks = [1] * len(shape) if chunking == 'contiguous' else [int(c) for c in chunking]
+    itemsize = src_var.dtype.itemsize
+    block = list(shape)
+    for axis, chunk in enumerate(src_chunks):
+        nbytes = int(np.prod(block)) * itemsize
+        if nbytes <= memory_bytes:
+            break
+        # 该维之外一个块的字节数，按源分块大小的整数倍切分
+        other = nbytes // block[axis]
+        block[axis] = min(max(memory_bytes // (other * chunk), 1) * chunk, shape[axis])
+    if hasattr(dst_var, 'set_var_chunk_cache'):
+        _, cache_nelems, cache_preemption = dst_var.get_var_chunk_cache()
+        dst_var.set_var_chunk_cache(max(memory_bytes, 1), cache_nelems, cache_preemption)
+    for start in product(*[range(0, size, step) for size, step in zip(shape, block)]):
+        key = tuple(slice(strt, min(strt + step, size)) for strt, step, size in zip(start, block, shape))
+        dst_var[key] = src_var[key]
+
+
+def rechunk(src, dst=None, pattern: str = 'station', var_names=None, chunk_sizes: dict = None, complevel: int = 1,
+            target_bytes: int = TARGET_CHUNK_BYTES, memory_bytes: int = 2 ** 29) -> Path:
+    """ Rewrite an FVCOM output file with another chunk layout
+
+    Variables on the node or nele dimension (or var_names) get the chunks of recommend_chunks (or chunk_sizes);
+    the other variables are copied with their own layout. Data are copied in blocks of about memory_bytes aligned
+    with the source chunks.
+
+    Args:
+        src: The path of the file
+        dst: The path of the copy; None writes a companion file '<name>.<pattern>.nc' next to src, and dst == src
+            rewrites the file in place
+        pattern (str): 'station', 'map' or 'balanced', see recommend_chunks
+        var_names: The variables to rechunk
+        chunk_sizes (dict): {var_name: chunk sizes} overriding the recommendation
+        complevel (int): The zlib compression level, 0 disables compression
+        target_bytes (int): The wanted size of a chunk
+        memory_bytes (int): The size of the blocks copied at once
+
+    Returns:
+        Path: The path of the written file
+
+    """
+    src = Path(src)
+    dst = src.with_suffix('.{0}.nc'.format(pattern)) if dst is None else Path(dst)
+    chunk_sizes = chunk_sizes or {}
+    fd, tmp_fp = tempfile.mkstemp(suffix='.nc', dir=dst.parent)
+    os.close(fd)
+    try:
+        with nc.Dataset(src) as ds_in, nc.Dataset(tmp_fp, 'w', format='NETCDF4') as ds_out:
+            ds_out.setncatts({name: ds_in.getncattr(name) for name in ds_in.ncattrs()})
+            for name, dim in ds_in.dimensions.items():
+                ds_out.createDimension(name, None if dim.isunlimited() else len(dim))
+            targets = var_names or [n for n, v in ds_in.variables.items() if {'node', 'nele'} & set(v.dimensions)]
+            for name, var in ds_in.variables.items():
+                chunking = _chunking(var) if var.dimensions else 'contiguous'
+                if name in targets and var.dtype != str:
+                    chunks = chunk_sizes.get(name) or recommend_chunks(var.dimensions, var.shape, var.dtype.itemsize,
+                                                                       pattern, target_bytes)
+                elif chunking != 'contiguous':
+                    chunks = chunking
+                else:
+                    chunks = None
+                # 无限维长度为 0 时不能使用 0 作为分块大小
+                if chunks is not None:
+                    chunks = [max(int(c), 1) for c in chunks]
+                out = ds_out.createVariable(name, var.dtype, var.dimensions, zlib=complevel > 0 and var.dtype != str,
+                                            complevel=max(complevel, 1), chunksizes=chunks,
+                                            fill_value=getattr(var, '_FillValue', None))
+                out.setncatts({attr: var.getncattr(attr) for attr in var.ncattrs() if attr != '_FillValue'})
+                var.set_auto_maskandscale(False)
+                out.set_auto_maskandscale(False)
+                _copy_variable(var, out, memory_bytes)
+        os.replace(tmp_fp, dst)
+    finally:
+        if os.path.exists(tmp_fp):
+            os.remove(tmp_fp)
+    return dst
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect, benchmark and change the chunk layout of FVCOM output')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_inspect = sub.add_parser('inspect', help='show the chunk layout')
+    p_inspect.add_argument('file')
+    p_inspect.add_argument('--var', nargs='*')
+    p_bench = sub.add_parser('benchmark', help='time station and map reads')
+    p_bench.add_argument('file')
+    p_bench.add_argument('var')
+    p_bench.add_argument('-n', type=int, default=5)
+    p_rechunk = sub.add_parser('rechunk', help='write the file with another chunk layout')
+    p_rechunk.add_argument('file')
+    p_rechunk.add_argument('-o', '--output', help="default '<name>.<pattern>.nc'; the input path rewrites in place")
+    p_rechunk.add_argument('-p', '--pattern', choices=PATTERNS, default='station')
+    p_rechunk.add_argument('--var', nargs='*')
+    p_rechunk.add_argument('--complevel', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if args.command == 'inspect':
+        for name, item in inspect_chunking(args.file, args.var).items():
+            print('{0}{1}: chunking={2}, station reads {3} chunks, map reads {4} chunks'.format(
+                name, item['dimensions'], item['chunking'], item['station_chunks'], item['map_chunks']))
+    elif args.command == 'benchmark':
+        result = benchmark(args.file, args.var, args.n)
+        print('station {0:.4f}s, map {1:.4f}s'.format(result['station'], result['map']))
+    else:
+        print(rechunk(args.file, args.output, args.pattern, args.var, complevel=args.complevel))
+
+
+if __name__ == '__main__':
+    main()
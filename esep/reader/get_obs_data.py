@@ -250,10 +250,17 @@ def get_obs_data(filepath, sta_name, lev_name, merge=True, tt_idx=0):
     for idx, dt in enumerate(date_ls):
         data_time_str.append(dt.strftime('%Y-%m-%d') + ' ' + time[idx].strftime('%H:%M'))
         data_time.append(datetime.strptime(data_time_str[idx], '%Y-%m-%d %H:%M'))
+    # 表层、0.2H、0.4H(中层)、0.6H、0.8H、底层与垂线平均，每层流速、流向两列
     if lev_name == 'surface':
         obs_col_idx = 3
-    elif lev_name == 'middle':
+    elif lev_name == '0.2H':
+        obs_col_idx = 5
+    elif lev_name in ('middle', '0.4H'):
         obs_col_idx = 7
+    elif lev_name == '0.6H':
+        obs_col_idx = 9
+    elif lev_name == '0.8H':
+        obs_col_idx = 11
     elif lev_name == 'bottom':
         obs_col_idx = 13
     else:
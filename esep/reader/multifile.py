@@ -0,0 +1,292 @@
+# -*- coding:utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+
+                 Project Name : ESEP
+
+                    File Name : multifile.py
+
+                   Start Date : 2022-04-07 14:30
+
+                  Contributor : D.CW
+
+                        Email : dengchuangwu@gmail.com
+
+-------------------------------------------------------------------------------
+Introduction:
+
+按时间维拼接的多文件虚拟数据集
+
+netCDF4.MFDataset 只支持 NETCDF3/NETCDF4_CLASSIC 格式且打开时会打开全部文件。
+MFTimeDataset 只打开第一个文件读取文件头，各文件的时间长度与时间序列建立一次索引后
+缓存到磁盘，读取变量时只打开与所需时间段重叠的文件，打开的文件句柄由 LRU 管理。
+
+-------------------------------------------------------------------------------
+"""
+import os
+import tempfile
+from collections import OrderedDict
+from pathlib import Path
+
+import netCDF4 as nc
+import numpy as np
+
+from ESEP.esep.utils.cache import default_cache_dir, key_hash
+from ESEP.esep.utils.timer import TimeUtil
+from ESEP.esep.utils.utils import file_signature
+
+# 进程内的文件索引缓存，键为各文件签名
+_index_cache = {}
+
+
+class DatasetPool:
+    """LRU of open netCDF4.Dataset handles, the least recently used handle is closed when the pool is full"""
+
+    def __init__(self, maxsize: int = 8):
+        self.maxsize = maxsize
+        self._handles = OrderedDict()
+
+    def get(self, fp) -> nc.Dataset:
+        ds = self._handles.pop(fp, None)
+        if ds is None:
+            ds = nc.Dataset(fp)
+            while len(self._handles) >= self.maxsize:
+                _, old_ds = self._handles.popitem(last=False)
+                old_ds.close()
+        self._handles[fp] = ds
+        return ds
+
+    def close(self):
+        while self._handles:
+            _, ds = self._handles.popitem(last=False)
+            ds.close()
+
+
+class _Dimension:
+    def __init__(self, name, size, unlimited=False):
+        self.name = name
+        self.size = size
+        self._unlimited = unlimited
+
+    def __len__(self):
+        return self.size
+
+    def isunlimited(self):
+        return self._unlimited
+
+    def __repr__(self):
+        return "<{0}: name = '{1}', size = {2}>".format(type(self).__name__, self.name, self.size)
+
+
+def _decode_time(var) -> np.ndarray:
+    if var.dtype.kind == 'S' or var.dtype == str:
+        return TimeUtil.char2datetime64(var[:])
+    dates = TimeUtil.num_time2datetime(var[:], getattr(var, 'units', None), getattr(var, 'calendar', None))
+    return np.array([str(x) for x in np.ravel(dates)], dtype='datetime64[ms]')
+
+
+def _index_path(key: str) -> Path:
+    return default_cache_dir().joinpath('multifile', '{0}.npz'.format(key))
+
+
+def build_time_index(files: list, time_dim: str = 'time', time_name: str = None) -> dict:
+    """Build (or load) the time index of the files: the time length of every file and the decoded time variable
+
+    The index is cached in memory and on disk, keyed by the path, size and modification time of every file, so files
+    are only opened the first time.
+
+    Args:
+        files (list): The paths of the files in time order
+        time_dim (str): The name of the time dimension
+        time_name (str): The name of the time variable to decode, None to skip
+
+    Returns:
+        dict: {'length': int64 array, 'time': datetime64[ms] array or None}
+
+    """
+    key = key_hash([file_signature(fp) for fp in files], time_dim, time_name)
+    if key in _index_cache:
+        return _index_cache[key]
+
+    index_fp = _index_path(key)
+    try:
+        with np.load(index_fp, allow_pickle=False) as npz:
+            index = {'length': npz['length'], 'time': npz['time'] if time_name is not None else None}
+    except (OSError, KeyError, ValueError):
+        length, time = [], []
+        for fp in files:
+            with nc.Dataset(fp) as ds:
+                length.append(ds.dimensions[time_dim].size)
+                if time_name is not None:
+                    time.append(_decode_time(ds[time_name]))
+        index = {'length': np.array(length, dtype=np.int64),
+                 'time': np.concatenate(time) if time_name is not None else None}
+        try:
+            index_fp.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_fp = tempfile.mkstemp(suffix='.npz', dir=index_fp.parent)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **{k: v for k, v in index.items() if v is not None})
+            os.replace(tmp_fp, index_fp)
+        except OSError:
+            # 缓存目录不可写时只在内存中保留索引
+            pass
+    _index_cache[key] = index
+    return index
+
+
+class MFTimeVariable:
+    """A variable of MFTimeDataset, indexing reads only the files holding the selected time steps"""
+
+    def __init__(self, dataset, name: str):
+        self._dataset = dataset
+        self._master = dataset.master[name]
+        self.name = name
+        self.dimensions = self._master.dimensions
+        self.dtype = self._master.dtype
+        self.ndim = self._master.ndim
+        self._time_axis = self.dimensions.index(dataset.time_dim) if dataset.time_dim in self.dimensions else None
+        shape = list(self._master.shape)
+        if self._time_axis is not None:
+            shape[self._time_axis] = dataset.offsets[-1]
+        self.shape = tuple(shape)
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return getattr(self._master, item)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def ncattrs(self):
+        return self._master.ncattrs()
+
+    def _expand_key(self, key) -> list:
+        key = list(key) if isinstance(key, tuple) else [key]
+        if any(k is Ellipsis for k in key):
+            pos = [k is Ellipsis for k in key].index(True)
+            key = key[:pos] + [slice(None)] * (self.ndim - len(key) + 1) + key[pos + 1:]
+        return key + [slice(None)] * (self.ndim - len(key))
+
+    def __getitem__(self, key):
+        if self._time_axis is None:
+            return self._master[key]
+
+        key = self._expand_key(key)
+        t_axis = self._time_axis
+        time_key = key[t_axis]
+        t_idx = np.arange(self.shape[t_axis])[time_key]
+        scalar = np.ndim(t_idx) == 0
+        t_idx = np.atleast_1d(t_idx)
+        # 输出数组中时间维的位置需扣除其前被整数索引去掉的维度
+        out_axis = t_axis - sum(isinstance(k, (int, np.integer)) for k in key[:t_axis])
+
+        offsets = self._dataset.offsets
+        file_id = np.searchsorted(offsets, t_idx, side='right') - 1
+        breaks = np.flatnonzero(np.diff(file_id)) + 1
+        pieces = []
+        for run in np.split(np.arange(t_idx.size), breaks):
+            if not run.size:
+                continue
+            fid = file_id[run[0]]
+            local = t_idx[run] - offsets[fid]
+            if local.size == 1 or np.all(np.diff(local) == 1):
+                local_key = slice(int(local[0]), int(local[-1]) + 1)
+                take = None
+            else:
+                local_key, take = np.unique(local, return_inverse=True)
+            sub_key = list(key)
+            sub_key[t_axis] = local_key
+            data = self._dataset.handle(fid)[self.name][tuple(sub_key)]
+            if take is not None:
+                data = np.take(data, take, axis=out_axis)
+            pieces.append(data)
+
+        if not pieces:
+            sub_key = list(key)
+            sub_key[t_axis] = slice(0, 0)
+            return self._master[tuple(sub_key)]
+        data = np.ma.concatenate(pieces, axis=out_axis) if len(pieces) > 1 else pieces[0]
+        if scalar:
+            data = np.take(data, 0, axis=out_axis)
+        return data
+
+    def __repr__(self):
+        return '<{0}: {1}{2} {3}>'.format(type(self).__name__, self.name, self.dimensions, self.shape)
+
+
+class MFTimeDataset:
+    """Virtual dataset concatenating files along the time dimension
+
+    Supports NETCDF4/HDF5 files. Only the first file is opened up front; the other files are opened on demand through
+    an LRU of handles when a read needs their time steps. Non-time variables and attributes come from the first file.
+
+    Args:
+        files (list): The paths of the files in time order
+        time_name (str): The name of the time variable, decoded once and cached with the index
+        time_dim (str): The name of the time dimension
+        max_open (int): The maximum number of open file handles
+
+    """
+
+    def __init__(self, files, time_name: str = None, time_dim: str = 'time', max_open: int = 8):
+        self.files = [os.fspath(fp) for fp in files]
+        if not self.files:
+            raise ValueError('No file to aggregate')
+        self.time_dim = time_dim
+        self.time_name = time_name
+        self._pool = DatasetPool(max_open)
+
+        index = build_time_index(self.files, time_dim, time_name)
+        self.offsets = np.concatenate([[0], np.cumsum(index['length'])]).astype(np.int64)
+        self.time = index['time']
+
+        self.master = nc.Dataset(self.files[0])
+        self.dimensions = OrderedDict()
+        for name, dim in self.master.dimensions.items():
+            if name == time_dim:
+                self.dimensions[name] = _Dimension(name, int(self.offsets[-1]), dim.isunlimited())
+            else:
+                self.dimensions[name] = dim
+        self.variables = OrderedDict((name, MFTimeVariable(self, name)) for name in self.master.variables)
+
+    def handle(self, file_id: int) -> nc.Dataset:
+        """The open Dataset of the file_id-th file"""
+        if not file_id:
+            return self.master
+        return self._pool.get(self.files[file_id])
+
+    def files_between(self, start_idx: int, stop_idx: int) -> list:
+        """The ids of the files holding the time steps [start_idx, stop_idx)"""
+        if stop_idx <= start_idx:
+            return []
+        first = np.searchsorted(self.offsets, start_idx, side='right') - 1
+        last = np.searchsorted(self.offsets, stop_idx - 1, side='right') - 1
+        return list(range(int(first), int(last) + 1))
+
+    def __getitem__(self, name):
+        return self.variables[name]
+
+    def __getattr__(self, item):
+        if item.startswith('_') or item == 'master':
+            raise AttributeError(item)
+        return getattr(self.master, item)
+
+    def ncattrs(self):
+        return self.master.ncattrs()
+
+    def filepath(self):
+        return self.files[0]
+
+    def close(self):
+        self._pool.close()
+        self.master.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        return '<{0}: {1} files, {2} time steps>'.format(type(self).__name__, len(self.files), self.offsets[-1])
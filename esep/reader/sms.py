@@ -0,0 +1,114 @@
+# -*- coding:utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+
+                 Project Name : ESEP
+
+                    File Name : sms.py
+
+                   Start Date : 2022-04-13 15:05
+
+                  Contributor : D.CW
+
+                        Email : dengchuangwu@gmail.com
+
+-------------------------------------------------------------------------------
+Introduction:
+
+SMS .2dm 网格文件读取
+
+按记录类型(E3T/ND/NS)用正则一次取出各类记录，再整体转换为 numpy 数组，
+不逐行解析。解析结果按文件签名缓存为 .npz。
+
+-------------------------------------------------------------------------------
+"""
+import os
+import re
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from ESEP.esep.utils.cache import default_cache_dir, key_hash
+from ESEP.esep.utils.utils import file_signature
+
+_E3T = re.compile(rb'^E3T[ \t]+([^\r\n]*)', re.M)
+_ND = re.compile(rb'^ND[ \t]+([^\r\n]*)', re.M)
+_NS = re.compile(rb'^NS[ \t]+([^\r\n]*)', re.M)
+_INT = re.compile(rb'^-?\d+$')
+
+
+def _numbers(lines: list, n_col: int = None) -> np.ndarray:
+    """Parse the numbers of the records, the integer tokens of every line when n_col is None (node strings)"""
+    if not lines:
+        return np.empty(0) if n_col is None else np.empty((0, n_col))
+    if n_col is None:
+        # 节点串末尾可能跟有名称，只保留整数
+        return np.array([tok for line in lines for tok in line.split() if _INT.match(tok)], dtype=np.float64)
+    tokens = b' '.join(lines).split()
+    if len(tokens) != len(lines) * n_col:
+        tokens = [tok for line in lines for tok in line.split()[:n_col]]
+    return np.reshape(np.array(tokens, dtype=np.float64), (len(lines), n_col))
+
+
+def _parse(text: bytes) -> dict:
+    elems = _numbers(_E3T.findall(text), 5)
+    nodes = _numbers(_ND.findall(text), 4)
+
+    node_id = nodes[:, 0].astype(np.int64)
+    order = np.argsort(node_id, kind='stable')
+    node_id = node_id[order]
+    xyz = nodes[order, 1:]
+
+    # 节点编号不一定连续，按编号查找节点位置
+    tri = np.searchsorted(node_id, elems[:, 1:4].astype(np.int64))
+    types = elems[:, 4].astype(np.int64)
+
+    # NS 记录可跨多行，负值为一条节点串的最后一个节点，其后可能跟有名称
+    values = _numbers(_NS.findall(text)).astype(np.int64)
+    ends = np.flatnonzero(values < 0)
+    values = np.searchsorted(node_id, np.abs(values[:ends[-1] + 1] if ends.size else values[:0]))
+    return {'tri': tri, 'nodes': node_id, 'x': xyz[:, 0], 'y': xyz[:, 1], 'z': xyz[:, 2], 'types': types,
+            'nodestring_values': values, 'nodestring_ends': ends + 1}
+
+
+def read_sms_mesh(fp, nodestrings: bool = False, cache: bool = True) -> tuple:
+    """ Read an SMS .2dm triangular mesh
+
+    The same outputs as PyFVCOM.grid.read_sms_mesh.
+
+    Args:
+        fp: The path of the .2dm file
+        nodestrings (bool): Also return the node strings
+        cache (bool): Load the parsed mesh from (and save it to) the cache directory, keyed by the file signature
+
+    Returns:
+        tuple: triangle (nelem, 3) zero-based node indices, nodes (the node ids), x, y, z, types (the material of
+        every element) and, if nodestrings, the list of node strings as zero-based node indices
+
+    """
+    cache_fp = default_cache_dir().joinpath('sms', '{0}.npz'.format(key_hash(file_signature(fp))))
+    mesh = None
+    if cache:
+        try:
+            with np.load(cache_fp, allow_pickle=False) as npz:
+                mesh = {name: npz[name] for name in npz.files}
+        except (OSError, ValueError):
+            mesh = None
+    if mesh is None:
+        mesh = _parse(Path(fp).read_bytes())
+        if cache:
+            try:
+                cache_fp.parent.mkdir(parents=True, exist_ok=True)
+                fd, tmp_fp = tempfile.mkstemp(suffix='.npz', dir=cache_fp.parent)
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, **mesh)
+                os.replace(tmp_fp, cache_fp)
+            except OSError:
+                pass
+
+    out = (mesh['tri'], mesh['nodes'], mesh['x'], mesh['y'], mesh['z'], mesh['types'])
+    if nodestrings:
+        ends = mesh['nodestring_ends']
+        out += (np.split(mesh['nodestring_values'], ends[:-1]) if ends.size else [],)
+    return out
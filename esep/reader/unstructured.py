@@ -19,17 +19,577 @@ Introduction:
 
 -------------------------------------------------------------------------------
 """
+import multiprocessing as mp
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import netCDF4 as nc
+import numpy as np
+from pygeos import Geometry, bounds, buffer, get_coordinates, intersects, polygons, to_wkb
+from scipy import sparse
 
 from ESEP.esep.reader.base import UnstructuredReaderModel
+from ESEP.esep.utils import hpc
+from ESEP.esep.utils.cache import GridCache, default_cache_dir, key_hash
+from ESEP.esep.utils.decorator import lazy_property
+from ESEP.esep.utils.spatial import densify_polyline
+from ESEP.esep.utils.timer import TimeUtil
+from ESEP.esep.utils.utils import file_signature
+from ESEP.esep.utils.unstructured import TriangleLocator, apply_operator, elem2node_operator
+from ESEP.esep.utils.vertical import layer_elevation, relative_depth, sigma_to_z, sigma_to_z_points, vertical_mean
 
 
 class FvcomReader(UnstructuredReaderModel):
     u = None
     v = None
-    lonc = None
-    latc = None
     zeta = None
     h = None
     bot_nthck = None
     bot_dthck = None
     time_name = 'Times'
+
+    def read_z(self, var_name, z_levels, reference: str = 'surface', time=None, cells=None, nodes=None,
+               time_chunk: int = 24) -> np.ndarray:
+        """ Read a sigma-layer variable interpolated to depths below the surface or heights above the bed
+
+        The depths of the layers follow siglay/siglev, h and zeta of every time step, see vertical.sigma_to_z. On
+        elements siglay_center/h_center are used when present, otherwise the mean of the three nodes; zeta is always
+        averaged from the nodes. The variable and zeta are read together block by block along time.
+
+        Args:
+            var_name (str): The name of the variable, on siglay or siglev
+            z_levels: The distances (m, positive) below the surface or above the bed
+            reference (str): 'surface' or 'bottom'
+            time: The selection of the time dimension
+            cells: The selection of the nele dimension
+            nodes: The selection of the node dimension
+            time_chunk (int): The number of time steps interpolated at once
+
+        Returns:
+            np.ndarray: The data of shape (time, level, cells/nodes), NaN below the bed
+
+        """
+        dims = self.ds[var_name].dimensions
+        layer_dim = 'siglev' if 'siglev' in dims else 'siglay'
+        selection, read_column = self._columns('node' in dims, cells, nodes)
+        sigma, h = read_column(layer_dim), read_column('h')
+
+        def _blocks():
+            # 变量与水位在同一线程内读取，netCDF-C 不是线程安全的
+            for time_key, block in self.iter_chunks(var_name, time_chunk, time=time, prefetch=False, **selection):
+                yield block, read_column('zeta', time_key)
+
+        out = [sigma_to_z(block, sigma, h, zeta, z_levels, reference) for block, zeta in hpc.prefetch(_blocks())]
+        return np.concatenate(out)
+
+    def station_profiles(self, var_names, cells=None, nodes=None, levels=('surface', '0.2H', '0.4H', '0.6H', '0.8H',
+                                                                          'bottom'), time=None) -> dict:
+        """ Relative-depth values and thickness-weighted vertical means of sigma-layer variables at stations
+
+        Every variable is gathered in one read over all the layers of all the station cells (or nodes), and the levels
+        of every station are interpolated together, see vertical.relative_depth.
+
+        Args:
+            var_names: The names of the variables, on siglay and all on cells or all on nodes
+            cells: The cells of the stations
+            nodes: The nodes of the stations
+            levels: Names of vertical.RELATIVE_DEPTHS or fractions of the water depth
+            time: The selection of the time dimension
+
+        Returns:
+            dict: {var_name: {level: (time, station), ..., 'verticalMean': (time, station)}}
+
+        """
+        var_names = [var_names] if isinstance(var_names, str) else list(var_names)
+        on_nodes = 'node' in self.ds[var_names[0]].dimensions
+        selection, read_column = self._columns(on_nodes, cells, nodes)
+        siglay, siglev = read_column('siglay'), read_column('siglev')
+        profiles = {}
+        for var_name in var_names:
+            data = self.read(var_name, time=time, **selection)
+            if np.ndim(data) == 2:
+                data = data[np.newaxis]
+            values = relative_depth(data, siglay, levels)
+            profiles[var_name] = {level: values[:, i] for i, level in enumerate(levels)}
+            profiles[var_name]['verticalMean'] = vertical_mean(data, siglev)
+        return profiles
+
+    def extract_points(self, var_name, time, lon, lat, z=None, reference: str = 'surface',
+                       time_chunk: int = 24) -> np.ndarray:
+        """ Sample a variable at scattered (time, lon, lat[, z]) points, e.g. ship surveys or moving moorings
+
+        Every point is located in its triangle (the locator is cached per mesh) and interpolated barycentrically
+        from the three nodes, linearly between the two bracketing time steps and, for sigma-layer variables,
+        linearly in depth at the water column of the point (see vertical.sigma_to_z_points). Element variables are
+        first averaged to the nodes, weighted by the element areas. The points are processed in order of time and
+        only the time steps and nodes (elements) they need are read, time_chunk steps at a time.
+
+        Args:
+            var_name (str): The name of the variable
+            time: The Beijing time of the points
+            lon: The longitude of the points
+            lat: The latitude of the points
+            z: The distance (m, positive) of the points below the surface or above the bed, for sigma-layer variables
+            reference (str): 'surface' or 'bottom'
+            time_chunk (int): The number of time steps read at once
+
+        Returns:
+            np.ndarray: The values of the points, NaN outside the mesh, the time span of the output or the water
+
+        """
+        dims = self.ds[var_name].dimensions
+        layered = 'siglay' in dims or 'siglev' in dims
+        if layered and z is None:
+            raise ValueError('z is needed to sample {0} on {1}'.format(var_name, dims))
+        lon, lat = np.ravel(lon).astype(np.float64), np.ravel(lat).astype(np.float64)
+        time = np.ravel(np.asarray(time, dtype='datetime64[ms]'))
+        z = None if z is None else np.broadcast_to(np.asarray(z, dtype=np.float64), lon.shape)
+        out = np.full(lon.size, np.nan)
+
+        # 空间：所在三角形与重心坐标；时间：前后两个时刻与线性权重
+        tri = np.asarray(self.tri)
+        elem, bary = TriangleLocator.cached(self.lon, self.lat, tri).locate(lon, lat)
+        steps = np.asarray(self.time_bj, dtype='datetime64[ms]')
+        before = np.clip(np.searchsorted(steps, time, side='right') - 1, 0, max(steps.size - 2, 0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t_weight = (time - steps[before]) / (steps[np.minimum(before + 1, steps.size - 1)] - steps[before])
+        t_weight = np.where(steps.size == 1, 0, t_weight)
+        valid = np.flatnonzero((elem >= 0) & (time >= steps[0]) & (time <= steps[-1]))
+        if not valid.size:
+            return out
+        corner = tri[elem]
+        after = np.minimum(before + 1, steps.size - 1)
+        layer_dim = 'siglev' if 'siglev' in dims else 'siglay'
+        to_nodes = None if 'node' in dims else elem2node_operator(self.lon, self.lat, tri)
+
+        # 按前一时刻分块，块内各点需要的时刻为 [块内时刻, 下一个时刻]
+        needed = np.unique(before[valid])
+        for start in range(0, needed.size, time_chunk):
+            block = needed[start:start + time_chunk]
+            pts = valid[np.isin(before[valid], block)]
+            block_steps = np.union1d(block, after[pts])
+            nodes = np.unique(corner[pts])
+            col = np.searchsorted(nodes, corner[pts])
+            if to_nodes is None:
+                data = self.read(var_name, time=block_steps, nodes=nodes)
+            else:
+                operator = to_nodes[nodes]
+                cells = np.unique(operator.indices)
+                operator = operator[:, cells]
+                data = apply_operator(operator, self.read(var_name, time=block_steps, cells=cells))
+            if 'time' not in dims:
+                data = np.broadcast_to(data, (block_steps.size,) + np.shape(data))
+            t0, t1 = np.searchsorted(block_steps, before[pts]), np.searchsorted(block_steps, after[pts])
+            w = bary[pts]
+            w_t = t_weight[pts]
+
+            def _sample(values):
+                # values (time, [layer,] node) -> (point, [layer])
+                values = np.moveaxis(values, -1, 1)
+                v0 = np.einsum('pk,pk...->p...', w, values[t0[:, np.newaxis], col])
+                v1 = np.einsum('pk,pk...->p...', w, values[t1[:, np.newaxis], col])
+                shape = (-1,) + (1,) * (v0.ndim - 1)
+                return v0 + np.reshape(w_t, shape) * (v1 - v0)
+
+            values = _sample(np.ma.filled(data, np.nan) if np.ma.isMaskedArray(data) else np.asarray(data))
+            if layered:
+                sigma = self.read(layer_dim, nodes=nodes)
+                if np.ndim(sigma) == 2:
+                    sigma = np.einsum('pk,lpk->lp', w, sigma[:, col])
+                h = np.einsum('pk,pk->p', w, np.asarray(self.read('h', nodes=nodes))[col])
+                zeta = _sample(np.asarray(self.read('zeta', time=block_steps, nodes=nodes)))
+                values = sigma_to_z_points(values.T, sigma, h, zeta, z[pts], reference)
+            out[pts] = values
+        return out
+
+    def transect(self, polyline, spacing: float):
+        """ A vertical section along a polyline
+
+        Points every spacing meters along the polyline are located in the mesh once; the triangles and barycentric
+        weights are saved in the grid cache per polyline and spacing, and sections are memoised per reader.
+
+        Args:
+            polyline: The vertices as an array of shape (n, 2) of lon, lat, or a pygeos LineString
+            spacing (float): The distance between the section points in meters
+
+        Returns:
+            Transect: The section, read() gives (time, layer, distance) arrays
+
+        """
+        vertices = get_coordinates(polyline) if isinstance(polyline, Geometry) else np.asarray(polyline, dtype=float)
+        key = key_hash(vertices, float(spacing))
+        transects = self.__dict__.setdefault('_transects', {})
+        if key not in transects:
+            def build():
+                lon, lat, distance = densify_polyline(vertices[:, 0], vertices[:, 1], spacing)
+                elem, weights = TriangleLocator.cached(self.lon, self.lat, self.tri).locate(lon, lat)
+                return {'lon': lon, 'lat': lat, 'distance': distance, 'elem': elem, 'weights': weights}
+
+            arrays = self.grid_cache.fetch('transect', build, key=(vertices, float(spacing)))
+            transects[key] = Transect(self, **{name: np.asarray(arr) for name, arr in arrays.items()})
+        return transects[key]
+
+    def _columns(self, on_nodes: bool, cells=None, nodes=None) -> tuple:
+        """ Node variables (siglay, siglev, h, zeta) at the water columns of a node or element selection
+
+        On elements '<name>_center' is read when the output has it, otherwise the mean of the three nodes.
+
+        Returns:
+            tuple: the selection of the columns for read(), and read_column(name, time=None)
+
+        """
+        if on_nodes:
+            columns = np.arange(np.size(self.lon))[slice(None) if nodes is None else nodes]
+
+            def read_column(name, time=None):
+                return self.read(name, time=time, nodes=columns)
+
+            return {'nodes': columns}, read_column
+
+        tri = np.asarray(self.tri)
+        columns = np.arange(len(tri))[slice(None) if cells is None else cells]
+        need = np.unique(tri[columns])
+        corner = np.searchsorted(need, tri[columns])
+
+        def read_column(name, time=None):
+            if name + '_center' in self.ds.variables:
+                return self.read(name + '_center', time=time, cells=columns)
+            data = self.read(name, time=time, nodes=need)
+            # 单元三个节点的平均，不随节点变化的变量(如一维 siglay)原样返回
+            return data[..., corner].mean(axis=-1) if 'node' in self.ds[name].dimensions else data
+
+        return {'cells': columns}, read_column
+
+    def subset(self, region, margin: float = 0.0, cache_file: bool = False):
+        """ A region of the output as a self-contained mesh
+
+        The elements overlapping the region (extended by margin) are kept, with their nodes renumbered. The result is
+        a reader of the sub-mesh whose read() maps its local indices to the indices of this output, so only the
+        region is ever read. Subsets are memoised per region and margin.
+
+        Args:
+            region: (lon_min, lon_max, lat_min, lat_max) or a pygeos polygon
+            margin (float): The margin added around the region in degrees
+            cache_file (bool): Also write the subset of every variable to a netCDF file in the cache directory (once
+                per output and region) and return a reader of that file
+
+        Returns:
+            FvcomSubset or FvcomReader: The reader of the sub-mesh, node_idx and cell_idx map its nodes and elements
+            to this output
+
+        """
+        key = key_hash(region if not isinstance(region, Geometry) else to_wkb(region), float(margin))
+        subsets = self.__dict__.setdefault('_subsets', {})
+        if key not in subsets:
+            subsets[key] = FvcomSubset(self, *subset_index(self.lon, self.lat, self.tri, region, margin))
+        sub = subsets[key]
+        if not cache_file:
+            return sub
+
+        files = self.fp if isinstance(self.fp, list) else [self.fp]
+        subset_fp = Path(default_cache_dir() if self.cache_dir is None else self.cache_dir).joinpath(
+            'subset', '{0}.nc'.format(key_hash([file_signature(fp) for fp in files], key)))
+        if not subset_fp.is_file():
+            subset_fp.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_fp = tempfile.mkstemp(suffix='.nc', dir=subset_fp.parent)
+            os.close(fd)
+            try:
+                sub.to_netcdf(tmp_fp)
+                os.replace(tmp_fp, subset_fp)
+            finally:
+                if os.path.exists(tmp_fp):
+                    os.remove(tmp_fp)
+        reader = type(self)(str(subset_fp))
+        reader.node_idx = reader.ds['node_index'][:]
+        reader.cell_idx = reader.ds['cell_index'][:]
+        return reader
+
+
+def subset_index(lon, lat, tri, region, margin: float = 0.0) -> tuple:
+    """ The nodes and elements of a mesh overlapping a region
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+        region: (lon_min, lon_max, lat_min, lat_max) or a pygeos polygon
+        margin (float): The margin added around the region in degrees
+
+    Returns:
+        tuple: The sorted indices of the nodes and of the elements
+
+    """
+    tri = np.asarray(np.ma.getdata(tri))
+    lon_n, lat_n = np.asarray(np.ma.getdata(lon))[tri], np.asarray(np.ma.getdata(lat))[tri]
+    if isinstance(region, Geometry):
+        region = buffer(region, margin) if margin else region
+        lon_min, lat_min, lon_max, lat_max = bounds(region)
+    else:
+        lon_min, lon_max, lat_min, lat_max = region[0] - margin, region[1] + margin, region[2] - margin, \
+            region[3] + margin
+    # 单元外包框与区域外包框相交
+    cell_idx = np.flatnonzero((lon_n.min(axis=1) <= lon_max) & (lon_n.max(axis=1) >= lon_min) &
+                              (lat_n.min(axis=1) <= lat_max) & (lat_n.max(axis=1) >= lat_min))
+    if isinstance(region, Geometry) and cell_idx.size:
+        triangles = polygons(np.stack([lon_n[cell_idx], lat_n[cell_idx]], axis=-1))
+        cell_idx = cell_idx[intersects(triangles, region)]
+    if not cell_idx.size:
+        raise ValueError('No element of the mesh overlaps the region {0}'.format(region))
+    return np.unique(tri[cell_idx]), cell_idx
+
+
+class FvcomSubset(FvcomReader):
+    """ A region of an FVCOM output as a self-contained mesh, see FvcomReader.subset
+
+    lon, lat, tri (renumbered), lonc, latc and the grid cache belong to the sub-mesh; cells and nodes selections of
+    read() are local indices of the sub-mesh.
+
+    Args:
+        parent (FvcomReader): The reader of the whole output
+        node_idx (np.ndarray): The indices in the parent of the nodes of the sub-mesh
+        cell_idx (np.ndarray): The indices in the parent of the elements of the sub-mesh
+
+    """
+
+    def __init__(self, parent: FvcomReader, node_idx: np.ndarray, cell_idx: np.ndarray):
+        self.parent = parent
+        self.fp = parent.fp
+        self.ds = parent.ds
+        self.cache_dir = parent.cache_dir
+        self.node_idx = np.asarray(node_idx, dtype=np.int64)
+        self.cell_idx = np.asarray(cell_idx, dtype=np.int64)
+
+    @lazy_property
+    def _mesh(self) -> dict:
+        tri = np.searchsorted(self.node_idx, np.asarray(self.parent.tri)[self.cell_idx])
+        return {'lon': np.asarray(self.parent.lon)[self.node_idx], 'lat': np.asarray(self.parent.lat)[self.node_idx],
+                'tri': tri}
+
+    @lazy_property
+    def _centres(self) -> dict:
+        return {'lonc': np.asarray(self.parent.lonc)[self.cell_idx],
+                'latc': np.asarray(self.parent.latc)[self.cell_idx]}
+
+    @lazy_property
+    def grid_cache(self) -> GridCache:
+        return GridCache.from_mesh(self.lon, self.lat, self.tri, self.cache_dir)
+
+    @lazy_property
+    def time(self):
+        return self.parent.time
+
+    def read(self, var_name, time=None, layer=None, cells=None, nodes=None, max_gap=16) -> np.ndarray:
+        cells = self.cell_idx if cells is None else self.cell_idx[cells]
+        nodes = self.node_idx if nodes is None else self.node_idx[nodes]
+        return self.parent.read(var_name, time=time, layer=layer, cells=cells, nodes=nodes, max_gap=max_gap)
+
+    def to_netcdf(self, fp, time_chunk: int = 24):
+        """ Write the subset of every variable to a netCDF file
+
+        nv is renumbered and the variables node_index and cell_index keep the indices of the nodes and elements in
+        the whole output; other connectivity variables (nbe, nbve, ...) keep the numbering of the whole output.
+        Time-dependent variables are copied block by block.
+
+        Args:
+            fp: The path of the file
+            time_chunk (int): The number of time steps copied at once
+
+        """
+        src = self.ds
+        sizes = {'node': self.node_idx.size, 'nele': self.cell_idx.size}
+        with nc.Dataset(fp, 'w', format='NETCDF4') as dst:
+            dst.setncatts({name: src.getncattr(name) for name in src.ncattrs()})
+            for name, dim in src.dimensions.items():
+                dst.createDimension(name, None if dim.isunlimited() else sizes.get(name, len(dim)))
+            for name, var in src.variables.items():
+                fill_value = getattr(var, '_FillValue', None)
+                out = dst.createVariable(name, var.dtype, var.dimensions, zlib=True, fill_value=fill_value)
+                out.setncatts({attr: var.getncattr(attr) for attr in var.ncattrs() if attr != '_FillValue'})
+                if name == 'nv':
+                    out[:] = np.transpose(self.tri) + 1
+                elif 'time' in var.dimensions and var.dimensions[0] == 'time':
+                    for time_key, block in self.iter_chunks(name, time_chunk, prefetch=False):
+                        out[time_key] = block
+                else:
+                    out[:] = self.read(name)
+            dst.createVariable('node_index', 'i8', ('node',))[:] = self.node_idx
+            dst.createVariable('cell_index', 'i8', ('nele',))[:] = self.cell_idx
+
+
+class Transect:
+    """ A vertical section of an FVCOM output along a polyline, see FvcomReader.transect
+
+    Node variables are interpolated barycentrically, element variables are first averaged to the nodes weighted
+    by the element areas; both are one sparse operator from the nodes (elements) read to the section points.
+
+    Args:
+        reader (FvcomReader): The reader of the output
+        lon (np.ndarray): The longitude of the section points
+        lat (np.ndarray): The latitude of the section points
+        distance (np.ndarray): The distance in meters of the points along the polyline
+        elem (np.ndarray): The triangle of every point, -1 outside the mesh
+        weights (np.ndarray): The barycentric weights (n, 3) of the points
+
+    """
+
+    def __init__(self, reader, lon, lat, distance, elem, weights):
+        self.reader = reader
+        self.lon, self.lat, self.distance = lon, lat, distance
+        self.elem, self.weights = elem, weights
+        self.outside = elem < 0
+        corner = np.asarray(reader.tri)[elem[~self.outside]]
+        self.nodes = np.unique(corner)
+        rows = np.repeat(np.flatnonzero(~self.outside), 3)
+        cols = np.searchsorted(self.nodes, corner).ravel()
+        self.node_operator = sparse.csr_matrix((weights[~self.outside].ravel(), (rows, cols)),
+                                               shape=(elem.size, self.nodes.size))
+
+    @lazy_property
+    def _cell_operator(self) -> tuple:
+        to_nodes = elem2node_operator(self.reader.lon, self.reader.lat, self.reader.tri)[self.nodes]
+        cells = np.unique(to_nodes.indices)
+        return (self.node_operator @ to_nodes[:, cells]).tocsr(), cells
+
+    def _selection(self, var_name) -> tuple:
+        if 'node' in self.reader.ds[var_name].dimensions:
+            return self.node_operator, {'nodes': self.nodes}
+        operator, cells = self._cell_operator
+        return operator, {'cells': cells}
+
+    def _apply(self, operator, data) -> np.ndarray:
+        section = apply_operator(operator, data)
+        section[..., self.outside] = np.nan
+        return section
+
+    def iter_chunks(self, var_name, time_chunk: int = 24, time=None, layer=None):
+        """ The section of a variable block by block along time
+
+        Yields:
+            tuple: (time_key, section), see UnstructuredReaderModel.iter_chunks; section is (time, [layer,] distance)
+
+        """
+        operator, selection = self._selection(var_name)
+        for time_key, block in self.reader.iter_chunks(var_name, time_chunk, time=time, layer=layer, **selection):
+            yield time_key, self._apply(operator, block)
+
+    def read(self, var_name, time=None, layer=None, time_chunk: int = 24) -> np.ndarray:
+        """ The section of a variable, streamed time_chunk steps at a time
+
+        Args:
+            var_name (str): The name of the variable
+            time: The selection of the time dimension
+            layer: The selection of the siglay/siglev dimension
+            time_chunk (int): The number of time steps read at once
+
+        Returns:
+            np.ndarray: The section of shape (time, [layer,] distance), NaN outside the mesh
+
+        """
+        if 'time' not in self.reader.ds[var_name].dimensions:
+            operator, selection = self._selection(var_name)
+            return self._apply(operator, self.reader.read(var_name, layer=layer, **selection))
+        out, position = None, 0
+        n_time = self.reader.ds[var_name].shape[0]
+        n_out = np.arange(n_time)[slice(None) if time is None else time].size
+        for _, section in self.iter_chunks(var_name, time_chunk, time, layer):
+            if out is None:
+                out = np.empty((n_out,) + section.shape[1:], dtype=section.dtype)
+            out[position:position + section.shape[0]] = section
+            position += section.shape[0]
+        return out
+
+    def elevation(self, time=None, layer_dim: str = 'siglay') -> np.ndarray:
+        """The elevation (m, positive up) of the layers at the section points, shape (time, layer, distance)"""
+        sigma = self._apply(self.node_operator, self.reader.read(layer_dim, nodes=self.nodes))
+        h = self._apply(self.node_operator, self.reader.read('h', nodes=self.nodes))
+        zeta = self._apply(self.node_operator, self.reader.read('zeta', time=time, nodes=self.nodes))
+        return layer_elevation(sigma, h, np.atleast_2d(zeta))
+
+
+# 进程池中各工作进程打开的 FvcomReader，按文件路径复用
+_case_readers = {}
+
+
+def _read_case(fp, var_name, selection):
+    key = repr(fp)
+    if key not in _case_readers:
+        _case_readers[key] = FvcomReader(fp)
+    return _case_readers[key].read(var_name, **selection)
+
+
+class CaseSet:
+    """Cases sharing one FVCOM mesh
+
+    The mesh is loaded once from the first case and every other case is checked to use the same mesh. The same
+    variable and time window are read from all cases concurrently in a process pool (netCDF-C is not thread-safe)
+    and returned stacked as (case, ...).
+
+    Args:
+        cases (dict): key is the case name, value is the path (or list of paths) of the case output
+        max_workers (int): The number of workers, defaults to min(number of cases, number of CPUs)
+
+    """
+
+    def __init__(self, cases: dict, max_workers: int = None):
+        self._pool = None
+        if not cases:
+            raise ValueError('No case is given')
+        self.names = list(cases)
+        self.files = list(cases.values())
+        self.readers = [FvcomReader(fp) for fp in self.files]
+        self.mesh = self.readers[0]
+        for name, reader in zip(self.names[1:], self.readers[1:]):
+            if reader.grid_cache.mesh_id != self.mesh.grid_cache.mesh_id:
+                raise ValueError('The mesh of case {0} differs from the mesh of case {1}'.format(name, self.names[0]))
+        self.max_workers = max_workers or min(len(self.readers), mp.cpu_count())
+
+    def __len__(self):
+        return len(self.readers)
+
+    def __getitem__(self, name) -> FvcomReader:
+        return self.readers[self.names.index(name)]
+
+    def time_index(self, time_period) -> list:
+        """The indices of the time steps (Beijing time) of every case inside time_period"""
+        return [TimeUtil().extract_common_time_idx(reader.time_bj, time_period)[0] for reader in self.readers]
+
+    def read(self, var_name, time=None, layer=None, cells=None, nodes=None, time_period=None) -> np.ndarray:
+        """Read the same selection of a variable from all cases concurrently
+
+        Args:
+            var_name (str): The name of the variable
+            time: The selection of the time dimension shared by all cases, see FvcomReader.read
+            layer: The selection of the siglay/siglev dimension
+            cells: The selection of the nele dimension
+            nodes: The selection of the node dimension
+            time_period: (start, end) in Beijing time, selects the time steps of every case; overrides time
+
+        Returns:
+            np.ndarray: The data stacked as (case, ...)
+
+        """
+        selection = {'layer': layer, 'cells': cells, 'nodes': nodes}
+        if time_period is not None and 'time' in self.mesh.ds[var_name].dimensions:
+            times = self.time_index(time_period)
+            if len(set(map(len, times))) > 1:
+                raise ValueError('The cases have different numbers of time steps in {0}'.format(time_period))
+        else:
+            times = [time] * len(self.readers)
+
+        if len(self.readers) == 1:
+            return self.readers[0].read(var_name, time=times[0], **selection)[np.newaxis]
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        futures = [self._pool.submit(_read_case, fp, var_name, dict(selection, time=t))
+                   for fp, t in zip(self.files, times)]
+        return np.stack([future.result() for future in futures])
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,207 @@
+# -*- coding:utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+
+                 Project Name : ESEP
+
+                    File Name : cache.py
+
+                   Start Date : 2022-04-06 09:12
+
+                  Contributor : D.CW
+
+                        Email : dengchuangwu@gmail.com
+
+-------------------------------------------------------------------------------
+Introduction:
+
+网格几何信息的磁盘缓存
+
+同一套网格的不同算例共用一份缓存，缓存目录以网格哈希(nv 与经纬度)命名，
+每个缓存项以 .npy 文件保存，再次打开时以内存映射方式读取。
+缓存根目录默认为 ~/.cache/esep，可通过环境变量 ESEP_CACHE_DIR 修改。
+
+-------------------------------------------------------------------------------
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from ESEP.esep.utils.utils import file_signature
+
+CACHE_DIR_ENV = 'ESEP_CACHE_DIR'
+
+
+def default_cache_dir() -> Path:
+    """The root directory of the ESEP caches"""
+    return Path(os.environ.get(CACHE_DIR_ENV, Path.home().joinpath('.cache', 'esep')))
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, (np.ndarray, np.ma.MaskedArray)):
+        arr = np.ascontiguousarray(np.ma.getdata(obj))
+        h.update('{0}{1}'.format(arr.dtype.str, arr.shape).encode())
+        h.update(arr.tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update('{0}{1}'.format(type(obj).__name__, len(obj)).encode())
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, dict):
+        h.update('dict{0}'.format(len(obj)).encode())
+        for key in sorted(obj, key=str):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    else:
+        h.update(repr(obj).encode())
+
+
+def key_hash(*parts) -> str:
+    """Hash of arrays and plain python objects used as the key of a cache entry
+
+    Args:
+        *parts: np.ndarray, list, tuple, dict or objects with a stable repr
+
+    Returns:
+        str: The hex digest
+
+    """
+    h = hashlib.sha1()
+    _update_hash(h, parts)
+    return h.hexdigest()
+
+
+def mesh_hash(lon, lat, tri) -> str:
+    """Hash of an unstructured mesh, built from the connectivity and the node coordinates
+
+    Args:
+        lon (np.ndarray): The longitude of the nodes
+        lat (np.ndarray): The latitude of the nodes
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+
+    Returns:
+        str: The hex digest
+
+    """
+    return key_hash(np.asarray(tri, dtype=np.int64), np.asarray(lon, dtype=np.float64),
+                    np.asarray(lat, dtype=np.float64))
+
+
+class GridCache:
+    """On-disk cache of the products derived from one mesh
+
+    Every entry is a dict of arrays saved as .npy files in its own directory, named by the entry name and the hash
+    of its key. Entries are written atomically and loaded as read-only memory maps.
+    """
+
+    def __init__(self, mesh_id: str, cache_dir=None):
+        self.mesh_id = mesh_id
+        self.root = Path(default_cache_dir() if cache_dir is None else cache_dir).joinpath('grid', mesh_id)
+
+    @classmethod
+    def from_mesh(cls, lon, lat, tri, cache_dir=None):
+        return cls(mesh_hash(lon, lat, tri), cache_dir)
+
+    @classmethod
+    def from_file(cls, fp, read_mesh, cache_dir=None):
+        """The grid cache of the mesh stored in a file
+
+        The mesh hash of the file is remembered in a sidecar keyed by the path, size and modification time of the file,
+        so the mesh is read and hashed only the first time; it is then saved as the entry 'mesh' (lon, lat, tri).
+
+        Args:
+            fp: The path of the file
+            read_mesh: A callable without arguments returning (lon, lat, tri) read from the file
+            cache_dir: The root directory of the caches, default default_cache_dir()
+
+        Returns:
+            GridCache: The cache of the mesh
+
+        """
+        sidecar = Path(default_cache_dir() if cache_dir is None else cache_dir).joinpath(
+            'grid', 'files', '{0}.txt'.format(key_hash(file_signature(fp))))
+        try:
+            cache = cls(sidecar.read_text(encoding='utf-8').strip(), cache_dir)
+            if cache.exists('mesh'):
+                return cache
+        except OSError:
+            pass
+
+        lon, lat, tri = read_mesh()
+        cache = cls.from_mesh(lon, lat, tri, cache_dir)
+        try:
+            cache.save('mesh', {'lon': lon, 'lat': lat, 'tri': np.asarray(tri, dtype=np.int64)})
+            sidecar.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_fp = tempfile.mkstemp(suffix='.txt', dir=sidecar.parent)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(cache.mesh_id)
+            os.replace(tmp_fp, sidecar)
+        except OSError:
+            # 缓存目录不可写时每次打开都重新读取网格
+            pass
+        return cache
+
+    def path(self, name: str, key=None) -> Path:
+        return self.root.joinpath(name if key is None else '{0}-{1}'.format(name, key_hash(key)))
+
+    def exists(self, name: str, key=None) -> bool:
+        return self.path(name, key).joinpath('index.json').is_file()
+
+    def load(self, name: str, key=None, mmap_mode='r'):
+        """Load an entry, returns None if it is not cached"""
+        entry_dir = self.path(name, key)
+        try:
+            with open(entry_dir.joinpath('index.json'), encoding='utf-8') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return None
+        return {arr_name: np.load(entry_dir.joinpath(fn), mmap_mode=mmap_mode, allow_pickle=False)
+                for arr_name, fn in index.items()}
+
+    def save(self, name: str, arrays: dict, key=None) -> dict:
+        """Save a dict of arrays as an entry, an existing entry is replaced"""
+        entry_dir = self.path(name, key)
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(prefix='.{0}-'.format(name), dir=self.root))
+        try:
+            index = {}
+            for idx, (arr_name, arr) in enumerate(arrays.items()):
+                fn = '{0}.npy'.format(idx)
+                np.save(tmp_dir.joinpath(fn), np.ma.getdata(arr), allow_pickle=False)
+                index[arr_name] = fn
+            with open(tmp_dir.joinpath('index.json'), 'w', encoding='utf-8') as f:
+                json.dump(index, f, ensure_ascii=False)
+            if entry_dir.exists():
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # 其他进程已写入同一缓存项
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not self.exists(name, key):
+                raise
+        return arrays
+
+    def fetch(self, name: str, builder, key=None, mmap_mode='r') -> dict:
+        """Load an entry, or build it with builder() and save it when it is not cached
+
+        Args:
+            name (str): The name of the entry
+            builder: A callable without arguments returning a dict of arrays
+            key: Arrays and plain python objects that identify the entry together with the name
+            mmap_mode: The mmap_mode passed to np.load
+
+        Returns:
+            dict: The arrays of the entry
+
+        """
+        arrays = self.load(name, key, mmap_mode)
+        if arrays is None:
+            arrays = self.save(name, builder(), key)
+        return arrays
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
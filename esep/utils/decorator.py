@@ -19,7 +19,7 @@ Introduction:
 
 -------------------------------------------------------------------------------
 """
-from collections import Iterable
+import inspect
 from functools import wraps
 
 import numpy as np
@@ -85,3 +85,25 @@ def skipper(func):
     """
     func.__funskip__ = True
     return func
+
+
+class lazy_property:
+    """ Read-only property whose value is computed on first access and then stored on the instance
+
+    The value is kept in the instance __dict__ under the same name, so later accesses are plain attribute lookups.
+    Deleting the attribute resets it.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
@@ -20,6 +20,8 @@ Introduction:
 -------------------------------------------------------------------------------
 """
 import multiprocessing as mp
+import queue
+import threading
 
 import numpy as np
 
@@ -76,3 +78,57 @@ class SegmentOperate(object):
 
     def _calc(self, data):
         return np.array(self.method(data, *self.args, **self.kwargs))
+
+
+_DONE = object()
+
+
+def prefetch(iterable, depth: int = 1):
+    """ Iterate in a background thread, keeping up to depth items ready ahead of the caller
+
+    The next item is produced (e.g. read from disk) while the caller processes the current one. Exceptions of the
+    producer are raised in the caller; closing the generator stops the producer.
+
+    Args:
+        iterable: The items to produce
+        depth (int): The number of items produced ahead
+
+    Yields:
+        The items of iterable in order
+
+    """
+    buffer = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+        except BaseException as e:
+            _put((_DONE, e))
+            return
+        _put((_DONE, None))
+
+    worker = threading.Thread(target=_produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        worker.join()
@@ -20,7 +20,22 @@ Introduction:
 -------------------------------------------------------------------------------
 """
 import numpy as np
+from scipy import sparse
 from scipy.interpolate import griddata
+from scipy.spatial import Delaunay
+
+from ESEP.esep.utils.cache import GridCache, key_hash
+from ESEP.esep.utils.unstructured import TriangleLocator
+
+# 进程内的插值器缓存，键为源点坐标与目标网格
+_interpolator_cache = {}
+
+
+def regular_grid(loc_range, det_grid=0.1) -> tuple:
+    """Equally spaced longitude and latitude grids covering loc_range, (lon_min,lon_max,lat_min,lat_max)"""
+    lon_min, lon_max, lat_min, lat_max = loc_range
+    return np.meshgrid(np.arange(lon_min, lon_max + det_grid, det_grid),
+                       np.arange(lat_min, lat_max + det_grid, det_grid))
 
 
 def station2grid(data, lon, lat, loc_range, det_grid=0.1, method='linear'):
@@ -45,12 +60,133 @@ def station2grid(data, lon, lat, loc_range, det_grid=0.1, method='linear'):
     points = np.concatenate([lon, lat], axis=1)
 
     # step2:确定插值区域的经纬度网格
-    lon_min, lon_max, lat_min, lat_max = loc_range
-
-    lon_grid, lat_grid = np.meshgrid(np.arange(lon_min, lon_max + det_grid, det_grid),
-                                     np.arange(lat_min, lat_max + det_grid, det_grid))
+    lon_grid, lat_grid = regular_grid(loc_range, det_grid)
 
     # step3:进行网格插值
     grid_data = griddata(points, data, (lon_grid, lat_grid), method=method)[:, :, 0]
 
     return lon_grid, lat_grid, grid_data
+
+
+class GridInterpolator:
+    """Linear interpolation from scattered points to an equally spaced latitude and longitude grid
+
+    The Delaunay triangulation of the points is built once and the barycentric weights are stored as a sparse matrix
+    of shape (grid points, points), so interpolating a whole (time, points) block is one sparse matrix product. The
+    result equals station2grid(..., method='linear'): grid points outside the convex hull are NaN.
+
+    Args:
+        lon: The longitude of the points
+        lat: The latitude of the points
+        loc_range: The range of grids used for interpolation, (lon_min,lon_max,lat_min,lat_max)
+        det_grid: The spacing of interpolation grids
+
+    """
+
+    def __init__(self, lon, lat, loc_range, det_grid=0.1):
+        points = np.stack([np.ravel(np.ma.getdata(lon)), np.ravel(np.ma.getdata(lat))], axis=-1).astype(np.float64)
+        self.lon_grid, self.lat_grid = regular_grid(loc_range, det_grid)
+        self.shape = np.shape(self.lon_grid)
+        self.size = len(points)
+
+        targets = np.stack([self.lon_grid.ravel(), self.lat_grid.ravel()], axis=-1)
+        tri = Delaunay(points)
+        simplex = tri.find_simplex(targets)
+        inside = simplex >= 0
+        # 重心坐标，与 scipy LinearNDInterpolator 的计算方式一致
+        trans = tri.transform[simplex[inside]]
+        bary = np.einsum('ijk,ik->ij', trans[:, :2], targets[inside] - trans[:, 2])
+        weights = np.concatenate([bary, 1 - bary.sum(axis=1, keepdims=True)], axis=1)
+
+        rows = np.repeat(np.flatnonzero(inside), 3)
+        cols = tri.simplices[simplex[inside]].ravel()
+        self.weights = sparse.csr_matrix((weights.ravel(), (rows, cols)), shape=(len(targets), self.size))
+        self.outside = np.reshape(~inside, self.shape)
+
+    @classmethod
+    def cached(cls, lon, lat, loc_range, det_grid=0.1):
+        """The interpolator of the points and the grid, built once per process"""
+        key = key_hash(np.asarray(np.ma.getdata(lon)), np.asarray(np.ma.getdata(lat)), tuple(map(float, loc_range)),
+                       float(det_grid))
+        if key not in _interpolator_cache:
+            _interpolator_cache[key] = cls(lon, lat, loc_range, det_grid)
+        return _interpolator_cache[key]
+
+    def __call__(self, data) -> np.ndarray:
+        """Interpolate data of shape (..., points) to (..., lat, lon)"""
+        data = np.ma.filled(data, np.nan) if np.ma.isMaskedArray(data) else np.asarray(data)
+        if data.dtype.kind != 'f':
+            data = data.astype(np.float64)
+        lead_shape = np.shape(data)[:-1]
+        flat = np.reshape(data, (-1, self.size))
+        grid_data = np.asarray(self.weights @ flat.T).T
+        grid_data[:, self.outside.ravel()] = np.nan
+        return np.reshape(grid_data, lead_shape + self.shape)
+
+
+class TriangleRegridder:
+    """Linear interpolation from the nodes of an unstructured grid to an equally spaced latitude and longitude grid
+
+    Every grid point is located in the triangles of the model grid itself and node values are interpolated with the
+    barycentric weights, stored as a sparse matrix of shape (grid points, nodes). Grid points outside every triangle
+    lie outside the model domain, so the domain mask comes with the weights.
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+        loc_range: The range of grids used for interpolation, (lon_min,lon_max,lat_min,lat_max)
+        det_grid: The spacing of interpolation grids
+        cache (GridCache): The grid cache of the mesh, the located triangles and weights are reused from it
+
+    """
+
+    def __init__(self, lon, lat, tri, loc_range, det_grid=0.1, cache: GridCache = None):
+        self.lon_grid, self.lat_grid = regular_grid(loc_range, det_grid)
+        self.shape = np.shape(self.lon_grid)
+        self.n_node = np.size(lon)
+
+        def build():
+            elem, weights = TriangleLocator.cached(lon, lat, tri).locate(self.lon_grid, self.lat_grid)
+            return {'elem': elem, 'weights': weights}
+
+        if cache is None:
+            located = build()
+        else:
+            located = cache.fetch('triangle_regrid', build, key=(tuple(map(float, loc_range)), float(det_grid)))
+        elem, weights = np.asarray(located['elem']), np.asarray(located['weights'])
+
+        inside = elem >= 0
+        self.mask = np.reshape(~inside, self.shape)
+        # 只需读取插值用到的节点
+        corner = np.asarray(np.ma.getdata(tri))[elem[inside]]
+        self.nodes = np.unique(corner)
+        rows = np.repeat(np.flatnonzero(inside), 3)
+        cols = np.searchsorted(self.nodes, corner).ravel()
+        self.weights = sparse.csr_matrix((weights[inside].ravel(), (rows, cols)),
+                                         shape=(elem.size, self.nodes.size))
+
+    @classmethod
+    def cached(cls, lon, lat, tri, loc_range, det_grid=0.1, cache: GridCache = None):
+        """The regridder of the mesh and the grid, built once per process"""
+        key = key_hash(np.asarray(np.ma.getdata(tri)), np.asarray(np.ma.getdata(lon)),
+                       np.asarray(np.ma.getdata(lat)), tuple(map(float, loc_range)), float(det_grid))
+        if key not in _interpolator_cache:
+            _interpolator_cache[key] = cls(lon, lat, tri, loc_range, det_grid, cache)
+        return _interpolator_cache[key]
+
+    def __call__(self, data) -> np.ndarray:
+        """Interpolate data of shape (..., nodes) to (..., lat, lon)
+
+        The last axis holds either all the nodes of the grid or only self.nodes.
+        """
+        data = np.ma.filled(data, np.nan) if np.ma.isMaskedArray(data) else np.asarray(data)
+        if data.dtype.kind != 'f':
+            data = data.astype(np.float64)
+        if np.shape(data)[-1] == self.n_node and self.n_node != self.nodes.size:
+            data = data[..., self.nodes]
+        lead_shape = np.shape(data)[:-1]
+        flat = np.reshape(data, (-1, self.nodes.size))
+        grid_data = np.asarray(self.weights @ flat.T).T
+        grid_data[:, self.mask.ravel()] = np.nan
+        return np.reshape(grid_data, lead_shape + self.shape)
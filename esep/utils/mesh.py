@@ -0,0 +1,423 @@
+# -*- coding:utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+
+                 Project Name : ESEP
+
+                    File Name : mesh.py
+
+                   Start Date : 2022-04-11 10:20
+
+                  Contributor : D.CW
+
+                        Email : dengchuangwu@gmail.com
+
+-------------------------------------------------------------------------------
+Introduction:
+
+非结构网格拓扑
+
+由 nv 与节点经纬度一次构建节点-单元、单元-单元邻接(CSR)、边、边界边、单元面积与
+控制体面积，保存到网格缓存，同一网格的各工具共用。
+
+梯度算子以稀疏矩阵保存，对 (time, layer, element) 数据块一次稀疏矩阵乘得到梯度、
+涡度与散度。
+
+断面按与网格边的交点切分，每一段位于单一单元内，供断面通量计算。
+
+-------------------------------------------------------------------------------
+"""
+import numpy as np
+from scipy import sparse
+
+from ESEP.esep.utils.cache import GridCache
+from ESEP.esep.utils.decorator import lazy_property
+from ESEP.esep.utils.spatial import EARTH_RADIUS
+from ESEP.esep.utils.unstructured import TriangleLocator, apply_operator, element_areas
+
+# 缓存项名，拓扑结构变化时修改以免读取旧缓存
+_ENTRY = 'topology-v1'
+
+
+def _csr(groups: np.ndarray, values: np.ndarray, n_group: int) -> tuple:
+    """Group values by groups as (ptr, values sorted by group), the members of group i are values[ptr[i]:ptr[i+1]]"""
+    order = np.argsort(groups, kind='stable')
+    ptr = np.concatenate([[0], np.cumsum(np.bincount(groups, minlength=n_group))]).astype(np.int64)
+    return ptr, values[order]
+
+
+def build_topology(lon: np.ndarray, lat: np.ndarray, tri: np.ndarray) -> dict:
+    """ Build the arrays of MeshTopology
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+
+    Returns:
+        dict: The arrays, see MeshTopology
+
+    """
+    tri = np.asarray(np.ma.getdata(tri), dtype=np.int64)
+    n_node, n_elem = np.size(lon), len(tri)
+    elem_id = np.repeat(np.arange(n_elem), 3)
+
+    # 节点 -> 单元
+    node_elem_ptr, node_elem = _csr(tri.ravel(), elem_id, n_node)
+
+    # 单元第 i 条边为第 i 个节点的对边，与 FVCOM 的 nbe 约定一致
+    side = np.stack([np.roll(tri, -1, axis=1), np.roll(tri, -2, axis=1)], axis=-1).reshape(-1, 2)
+    side = np.sort(side, axis=1)
+    edge_key, elem_edges = np.unique(side[:, 0] * n_node + side[:, 1], return_inverse=True)
+    elem_edges = np.reshape(elem_edges, (n_elem, 3))
+    edges = np.stack([edge_key // n_node, edge_key % n_node], axis=-1)
+
+    # 边两侧的单元，边界边只有一侧
+    order = np.argsort(elem_edges.ravel(), kind='stable')
+    edge_sorted = elem_edges.ravel()[order]
+    first = np.searchsorted(edge_sorted, np.arange(len(edges)))
+    counts = np.bincount(edge_sorted, minlength=len(edges))
+    edge_elems = np.full((len(edges), 2), -1, dtype=np.int64)
+    edge_elems[:, 0] = elem_id[order][first]
+    shared = counts > 1
+    edge_elems[shared, 1] = elem_id[order][first[shared] + 1]
+
+    # 单元 -> 单元，跨第 i 条边的相邻单元，-1 为边界
+    pair = edge_elems[elem_edges]
+    elem_neighbours = np.where(pair[..., 0] == np.arange(n_elem)[:, np.newaxis], pair[..., 1], pair[..., 0])
+    has_neighbour = elem_neighbours.ravel() >= 0
+    elem_elem_ptr, elem_elem = _csr(elem_id[has_neighbour], elem_neighbours.ravel()[has_neighbour], n_elem)
+
+    elem_area = element_areas(lon, lat, tri)
+    # 中值对偶控制体：每个单元面积的 1/3 归于其各节点
+    node_area = np.bincount(tri.ravel(), weights=np.repeat(elem_area / 3, 3), minlength=n_node)
+
+    return {
+        'tri': tri,
+        'node_elem_ptr': node_elem_ptr,
+        'node_elem': node_elem,
+        'elem_elem_ptr': elem_elem_ptr,
+        'elem_elem': elem_elem,
+        'elem_neighbours': elem_neighbours,
+        'edges': edges,
+        'edge_elems': edge_elems,
+        'elem_edges': elem_edges,
+        'boundary_edges': np.flatnonzero(~shared),
+        'elem_area': elem_area,
+        'node_area': node_area,
+    }
+
+
+class MeshTopology:
+    """ Connectivity and geometry of an unstructured mesh
+
+    Attributes:
+        tri: (nelem, 3) node indices of every element
+        node_elem_ptr, node_elem: CSR lists of the elements around every node
+        elem_elem_ptr, elem_elem: CSR lists of the elements sharing an edge with every element
+        elem_neighbours: (nelem, 3) the element across the edge opposite to each node, -1 on the boundary
+        edges: (nedge, 2) unique edges as sorted node pairs
+        edge_elems: (nedge, 2) the elements on both sides of every edge, the second is -1 on the boundary
+        elem_edges: (nelem, 3) the edge opposite to each node of every element
+        boundary_edges: the indices of the boundary edges in edges
+        elem_area: the area of every element in m^2
+        node_area: the median-dual control-volume area of every node in m^2
+
+    Args:
+        arrays (dict): The arrays built by build_topology
+
+    """
+
+    def __init__(self, arrays: dict):
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+        self.n_node = len(self.node_elem_ptr) - 1
+        self.n_elem = len(self.tri)
+
+    @classmethod
+    def from_mesh(cls, lon, lat, tri, cache: GridCache = None):
+        """Build the topology, or load it from the grid cache of the mesh"""
+        if cache is None:
+            return cls(build_topology(lon, lat, tri))
+        return cls(cache.fetch(_ENTRY, lambda: build_topology(lon, lat, tri)))
+
+    def elems_of_node(self, node: int) -> np.ndarray:
+        return self.node_elem[self.node_elem_ptr[node]:self.node_elem_ptr[node + 1]]
+
+    def elems_of_elem(self, elem: int) -> np.ndarray:
+        return self.elem_elem[self.elem_elem_ptr[elem]:self.elem_elem_ptr[elem + 1]]
+
+    @property
+    def n_edge(self) -> int:
+        return len(self.edges)
+
+    @property
+    def boundary_nodes(self) -> np.ndarray:
+        return np.unique(self.edges[self.boundary_edges])
+
+
+def _local_xy(lon, lat, lon0, lat0) -> tuple:
+    """Offsets in metres from (lon0, lat0) on the plane tangent at lat0"""
+    dx = EARTH_RADIUS * np.cos(np.deg2rad(lat0)) * np.deg2rad(lon - lon0)
+    dy = EARTH_RADIUS * np.deg2rad(lat - lat0)
+    return dx, dy
+
+
+def element_gradient_operator(lon: np.ndarray, lat: np.ndarray, topology: MeshTopology) -> sparse.csr_matrix:
+    """ Least-squares gradient of element values as a sparse matrix
+
+    The stencil of every element is the elements sharing one of its nodes, weighted by the inverse squared distance
+    of the centroids. Elements whose stencil cannot determine a gradient get NaN.
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        topology (MeshTopology): The topology of the mesh
+
+    Returns:
+        sparse.csr_matrix: Matrix of shape (2 * nelem, nelem), the first nelem rows give d/dx and the others d/dy
+
+    """
+    tri = np.asarray(topology.tri)
+    n_elem = topology.n_elem
+    lon_c = np.asarray(np.ma.getdata(lon), dtype=np.float64)[tri].mean(axis=1)
+    lat_c = np.asarray(np.ma.getdata(lat), dtype=np.float64)[tri].mean(axis=1)
+
+    # 与单元共用节点的全部单元
+    node = tri.ravel()
+    ptr = np.asarray(topology.node_elem_ptr)
+    count = np.diff(ptr)[node]
+    rows = np.repeat(np.repeat(np.arange(n_elem), 3), count)
+    offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    cols = np.asarray(topology.node_elem)[np.repeat(ptr[node], count) + offset]
+    pair = np.unique(rows * n_elem + cols)
+    rows, cols = pair // n_elem, pair % n_elem
+    rows, cols = rows[rows != cols], cols[rows != cols]
+
+    dx, dy = _local_xy(lon_c[cols], lat_c[cols], lon_c[rows], lat_c[rows])
+    w = 1 / (dx ** 2 + dy ** 2)
+    a = np.bincount(rows, weights=w * dx * dx, minlength=n_elem)
+    b = np.bincount(rows, weights=w * dx * dy, minlength=n_elem)
+    c = np.bincount(rows, weights=w * dy * dy, minlength=n_elem)
+    det = a * c - b ** 2
+    valid = det > 1e-10 * np.maximum(a * c, np.finfo(float).tiny)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_det = np.where(valid, 1 / det, 0)
+    cx = w * (c[rows] * dx - b[rows] * dy) * inv_det[rows]
+    cy = w * (a[rows] * dy - b[rows] * dx) * inv_det[rows]
+
+    diag_x = -np.bincount(rows, weights=cx, minlength=n_elem)
+    diag_y = -np.bincount(rows, weights=cy, minlength=n_elem)
+    diag_x[~valid], diag_y[~valid] = np.nan, np.nan
+    elem = np.arange(n_elem)
+    data = np.concatenate([cx, diag_x, cy, diag_y])
+    row_ind = np.concatenate([rows, elem, rows + n_elem, elem + n_elem])
+    col_ind = np.concatenate([cols, elem, cols, elem])
+    return sparse.csr_matrix((data, (row_ind, col_ind)), shape=(2 * n_elem, n_elem))
+
+
+def node_gradient_operator(lon: np.ndarray, lat: np.ndarray, tri: np.ndarray) -> sparse.csr_matrix:
+    """ Gradient of node values on every element, from the linear (P1) interpolation in the triangle
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+
+    Returns:
+        sparse.csr_matrix: Matrix of shape (2 * nelem, nnode), the first nelem rows give d/dx and the others d/dy
+
+    """
+    tri = np.asarray(np.ma.getdata(tri), dtype=np.int64)
+    n_elem = len(tri)
+    lon_n = np.asarray(np.ma.getdata(lon), dtype=np.float64)[tri]
+    lat_n = np.asarray(np.ma.getdata(lat), dtype=np.float64)[tri]
+    x, y = _local_xy(lon_n, lat_n, lon_n.mean(axis=1, keepdims=True), lat_n.mean(axis=1, keepdims=True))
+    x1, x2 = np.roll(x, -1, axis=1), np.roll(x, -2, axis=1)
+    y1, y2 = np.roll(y, -1, axis=1), np.roll(y, -2, axis=1)
+    area2 = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # 形函数 N_i 的梯度
+        gx = (y1 - y2) / area2[:, np.newaxis]
+        gy = (x2 - x1) / area2[:, np.newaxis]
+    rows = np.repeat(np.arange(n_elem), 3)
+    data = np.concatenate([gx.ravel(), gy.ravel()])
+    row_ind = np.concatenate([rows, rows + n_elem])
+    col_ind = np.concatenate([tri.ravel(), tri.ravel()])
+    return sparse.csr_matrix((data, (row_ind, col_ind)), shape=(2 * n_elem, np.size(lon)))
+
+
+def _fetch_csr(cache: GridCache, name: str, builder) -> sparse.csr_matrix:
+    if cache is None:
+        return builder()
+
+    def _build():
+        mat = builder()
+        return {'data': mat.data, 'indices': mat.indices, 'indptr': mat.indptr, 'shape': np.array(mat.shape)}
+
+    entry = cache.fetch(name, _build)
+    return sparse.csr_matrix((np.asarray(entry['data']), np.asarray(entry['indices']), np.asarray(entry['indptr'])),
+                             shape=tuple(entry['shape']))
+
+
+class MeshGradient:
+    """ Horizontal gradient, vorticity and divergence on an unstructured mesh
+
+    The operators are sparse matrices built once per mesh (and stored in its grid cache), so a whole
+    (time, layer, element) block is differentiated with one sparse matrix product.
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+        topology (MeshTopology): The topology of the mesh, built when not given
+        cache (GridCache): The grid cache of the mesh
+
+    """
+
+    def __init__(self, lon, lat, tri, topology: MeshTopology = None, cache: GridCache = None):
+        self.lon, self.lat, self.tri = lon, lat, tri
+        self.topology = MeshTopology.from_mesh(lon, lat, tri, cache) if topology is None else topology
+        self.cache = cache
+        self.n_elem = len(tri)
+
+    @lazy_property
+    def element_operator(self) -> sparse.csr_matrix:
+        """(2 * nelem, nelem) gradient of element values, see element_gradient_operator"""
+        return _fetch_csr(self.cache, 'gradient-element',
+                          lambda: element_gradient_operator(self.lon, self.lat, self.topology))
+
+    @lazy_property
+    def node_operator(self) -> sparse.csr_matrix:
+        """(2 * nelem, nnode) gradient of node values on the elements, see node_gradient_operator"""
+        return _fetch_csr(self.cache, 'gradient-node', lambda: node_gradient_operator(self.lon, self.lat, self.tri))
+
+    def stencil(self, elems, on_nodes: bool = False) -> tuple:
+        """ The operator restricted to some elements
+
+        Args:
+            elems: The indices of the elements where the gradient is wanted
+            on_nodes (bool): Differentiate node values instead of element values
+
+        Returns:
+            tuple: (operator, columns); the operator has shape (2 * len(elems), len(columns)) and is applied to the
+            data of the elements (or nodes) columns, which is all that has to be read
+
+        """
+        elems = np.asarray(elems)
+        operator = self.node_operator if on_nodes else self.element_operator
+        n_row = operator.shape[0] // 2
+        sub = operator[np.concatenate([elems, elems + n_row])]
+        columns = np.unique(sub.indices)
+        return sub[:, columns], columns
+
+    @staticmethod
+    def apply(operator: sparse.spmatrix, data, out: np.ndarray = None) -> tuple:
+        """Apply a gradient operator to data of shape (..., n), returns d/dx and d/dy of shape (..., n_out)"""
+        grad = apply_operator(operator, data, out)
+        n_out = operator.shape[0] // 2
+        return grad[..., :n_out], grad[..., n_out:]
+
+    def element_gradient(self, data) -> tuple:
+        """d/dx and d/dy in unit/m of element values (..., nelem)"""
+        return self.apply(self.element_operator, data)
+
+    def node_gradient(self, data) -> tuple:
+        """d/dx and d/dy in unit/m on the elements of node values (..., nnode)"""
+        return self.apply(self.node_operator, data)
+
+    @staticmethod
+    def curl(u_grad: tuple, v_grad: tuple) -> np.ndarray:
+        """Relative vorticity dv/dx - du/dy from the gradients of u and v"""
+        return v_grad[0] - u_grad[1]
+
+    @staticmethod
+    def div(u_grad: tuple, v_grad: tuple) -> np.ndarray:
+        """Divergence du/dx + dv/dy from the gradients of u and v"""
+        return u_grad[0] + v_grad[1]
+
+    def vorticity(self, u, v) -> np.ndarray:
+        """Relative vorticity (1/s) of element velocities (..., nelem)"""
+        return self.curl(self.element_gradient(u), self.element_gradient(v))
+
+    def divergence(self, u, v) -> np.ndarray:
+        """Divergence (1/s) of element velocities (..., nelem)"""
+        return self.div(self.element_gradient(u), self.element_gradient(v))
+
+
+def section_cuts(lon: np.ndarray, lat: np.ndarray, topology: MeshTopology, line_lon, line_lat) -> dict:
+    """ Split a polyline at the mesh edges it crosses
+
+    Each polyline segment is cut where it crosses an edge of the mesh, so every piece lies in a single element.
+    Lengths and normals are computed on the plane tangent at the middle latitude of each segment.
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        topology (MeshTopology): The topology of the mesh
+        line_lon: The longitude of the polyline vertices
+        line_lat: The latitude of the polyline vertices
+
+    Returns:
+        dict: For every piece inside the mesh, 'lon' and 'lat' of its middle, 'distance' of its middle from the first
+        vertex (m), its length 'dl' (m), the unit normal ('nx', 'ny') to the right of the polyline direction, the
+        'elem' it lies in and the barycentric 'weights' (n, 3, 3) of its start, middle and end; 'edges' are the
+        crossed edges
+
+    """
+    lon = np.asarray(np.ma.getdata(lon), dtype=np.float64)
+    lat = np.asarray(np.ma.getdata(lat), dtype=np.float64)
+    line_lon = np.ravel(line_lon).astype(np.float64)
+    line_lat = np.ravel(line_lat).astype(np.float64)
+    if line_lon.size < 2:
+        raise ValueError('A polyline needs at least two vertices')
+    edges = np.asarray(topology.edges)
+    a_lon, a_lat, b_lon, b_lat = lon[edges[:, 0]], lat[edges[:, 0]], lon[edges[:, 1]], lat[edges[:, 1]]
+
+    pieces, crossed, offset = [], [], 0.0
+    for lon0, lat0, lon1, lat1 in zip(line_lon[:-1], line_lat[:-1], line_lon[1:], line_lat[1:]):
+        # 以线段起点为原点、线段中点纬度的切平面
+        kx, ky = EARTH_RADIUS * np.cos(np.deg2rad((lat0 + lat1) / 2)) * np.pi / 180, EARTH_RADIUS * np.pi / 180
+        dx, dy = kx * (lon1 - lon0), ky * (lat1 - lat0)
+        length = np.hypot(dx, dy)
+        if length == 0:
+            continue
+        # 只检验外包矩形与线段相交的边
+        near = np.flatnonzero((np.maximum(a_lon, b_lon) >= min(lon0, lon1)) &
+                              (np.minimum(a_lon, b_lon) <= max(lon0, lon1)) &
+                              (np.maximum(a_lat, b_lat) >= min(lat0, lat1)) &
+                              (np.minimum(a_lat, b_lat) <= max(lat0, lat1)))
+        ax, ay = kx * (a_lon[near] - lon0), ky * (a_lat[near] - lat0)
+        bx, by = kx * (b_lon[near] - lon0), ky * (b_lat[near] - lat0)
+        ex, ey = bx - ax, by - ay
+        den = dx * ey - dy * ex
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (ax * ey - ay * ex) / den
+            s = (ax * dy - ay * dx) / den
+        hit = (den != 0) & (t >= 0) & (t <= 1) & (s >= 0) & (s <= 1)
+        crossed.append(near[hit])
+
+        # 相邻交点之间的一段位于同一单元内
+        cuts = np.unique(np.concatenate([[0, 1], t[hit]]))
+        t_mid = (cuts[:-1] + cuts[1:]) / 2
+        # 段的起点、中点与终点
+        t_pts = np.stack([cuts[:-1], t_mid, cuts[1:]], axis=-1)
+        pieces.append({'lon': lon0 + t_pts * (lon1 - lon0), 'lat': lat0 + t_pts * (lat1 - lat0),
+                       'distance': offset + t_mid * length, 'dl': np.diff(cuts) * length,
+                       'nx': np.full(t_mid.size, dy / length), 'ny': np.full(t_mid.size, -dx / length)})
+        offset += length
+
+    if not pieces:
+        raise ValueError('The polyline has no length')
+    arrays = {name: np.concatenate([piece[name] for piece in pieces]) for name in pieces[0]}
+    locator = TriangleLocator.cached(lon, lat, topology.tri)
+    elem, _ = locator.locate(arrays['lon'][:, 1], arrays['lat'][:, 1])
+    inside = (elem >= 0) & (arrays['dl'] > 0)
+    arrays = {name: arr[inside] for name, arr in arrays.items()}
+    elem = elem[inside]
+    # 段端点位于边上，按中点所在单元计算重心权重
+    weights = locator.barycentric(np.repeat(elem, 3), arrays['lon'].ravel(), arrays['lat'].ravel())
+    arrays.update(lon=arrays['lon'][:, 1], lat=arrays['lat'][:, 1], elem=elem,
+                  weights=np.reshape(weights, (elem.size, 3, 3)),
+                  edges=np.unique(np.concatenate(crossed)))
+    return arrays
@@ -27,40 +27,173 @@ utils for processing spatial data
 #   vincenty -- Calculate the distance between two points in                   #
 #               Vincenty's formula.                                            #
 #                                                                              #
+#*************************** class: SphericalIndex ****************************#
+#   query -- k nearest points and their great-circle distances.                #
+#   query_radius -- Points within a great-circle radius.                       #
+#                                                                              #
+#******************************** function *************************************#
+#   densify_polyline -- Equally spaced points along a polyline.                #
+#                                                                              #
 """
 import numpy as np
 from pyproj import Geod
+from scipy.spatial import cKDTree
 
 from ESEP.esep.physics.base import speed
+from ESEP.esep.utils.cache import GridCache, key_hash
+
+# pyproj 中 'sphere' 椭球的半径，与 Distance.vincenty 保持一致
+EARTH_RADIUS = 6370997.0
+
+# 进程内的空间索引缓存，键为坐标哈希
+_index_cache = {}
+
+
+def lonlat2xyz(lon, lat) -> np.ndarray:
+    """Convert longitude and latitude in degrees to unit vectors of shape (n, 3)"""
+    lon_rad = np.deg2rad(np.ravel(np.ma.getdata(lon)).astype(np.float64))
+    lat_rad = np.deg2rad(np.ravel(np.ma.getdata(lat)).astype(np.float64))
+    cos_lat = np.cos(lat_rad)
+    return np.stack([cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad)], axis=-1)
+
+
+class SphericalIndex:
+    """KD-tree of points on the unit sphere for nearest and radius queries in great-circle distance
+
+    The chord distance between unit vectors is monotonic with the great-circle distance, so the tree answers exact
+    spherical queries. Use SphericalIndex.cached to build the index of a mesh once per process.
+    """
+
+    def __init__(self, lon, lat):
+        self.size = np.size(lon)
+        self.tree = cKDTree(lonlat2xyz(lon, lat))
+
+    @classmethod
+    def cached(cls, lon, lat):
+        key = key_hash(np.asarray(np.ma.getdata(lon)), np.asarray(np.ma.getdata(lat)))
+        if key not in _index_cache:
+            _index_cache[key] = cls(lon, lat)
+        return _index_cache[key]
+
+    @staticmethod
+    def _chord2arc(chord):
+        return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+    def query(self, lon, lat, k: int = 1) -> tuple:
+        """The k nearest points of every query point
 
+        Args:
+            lon: The longitude of the query points
+            lat: The latitude of the query points
+            k (int): The number of neighbours
 
-def find_nearest(obs_coordinate: dict, cell_lonlat: tuple = None, node_lonlat: tuple = None, radius: int = None):
+        Returns:
+            tuple: distance in meters and index, both of shape (n, k) sorted by distance
+        """
+        k = min(k, self.size)
+        chord, idx = self.tree.query(lonlat2xyz(lon, lat), k=k)
+        chord, idx = np.reshape(chord, (-1, k)), np.reshape(idx, (-1, k))
+        return self._chord2arc(chord), idx
+
+    def query_radius(self, lon, lat, radius: float) -> list:
+        """The points within radius meters of every query point
+
+        Args:
+            lon: The longitude of the query points
+            lat: The latitude of the query points
+            radius (float): The radius to search in meters
+
+        Returns:
+            list: (index, distance in meters) of every query point, index is sorted ascending
+        """
+        xyz = lonlat2xyz(lon, lat)
+        chord_radius = 2 * np.sin(min(radius / EARTH_RADIUS, np.pi) / 2)
+        rslt = []
+        for point, idx in zip(xyz, self.tree.query_ball_point(xyz, chord_radius)):
+            idx = np.sort(np.asarray(idx, dtype=np.int64))
+            dist = self._chord2arc(np.linalg.norm(self.tree.data[idx] - point, axis=-1))
+            inside = dist < radius
+            rslt.append((idx[inside], dist[inside]))
+        return rslt
+
+
+def densify_polyline(lon, lat, spacing: float) -> tuple:
+    """ Points every spacing meters (great-circle) along a polyline, its last vertex included
+
+    Args:
+        lon: The longitude of the vertices
+        lat: The latitude of the vertices
+        spacing (float): The distance between the points in meters
+
+    Returns:
+        tuple: lon, lat and the distance in meters from the first vertex of the points
+
+    """
+    lon, lat = np.ravel(lon).astype(np.float64), np.ravel(lat).astype(np.float64)
+    if lon.size < 2:
+        raise ValueError('A polyline needs at least two vertices')
+    if spacing <= 0:
+        raise ValueError('spacing must be positive')
+    geod = Geod(ellps='sphere')
+    azimuth, _, length = geod.inv(lon[:-1], lat[:-1], lon[1:], lat[1:])
+    vertex_dist = np.concatenate([[0], np.cumsum(length)])
+    distance = np.arange(0, vertex_dist[-1], spacing)
+    distance = np.append(distance, vertex_dist[-1])
+    seg = np.clip(np.searchsorted(vertex_dist, distance, side='right') - 1, 0, length.size - 1)
+    pt_lon, pt_lat, _ = geod.fwd(lon[seg], lat[seg], np.asarray(azimuth)[seg], distance - vertex_dist[seg])
+    return np.asarray(pt_lon), np.asarray(pt_lat), distance
+
+
+def find_nearest(obs_coordinate: dict, cell_lonlat: tuple = None, node_lonlat: tuple = None, radius: int = None,
+                 cache: GridCache = None, k: int = 1):
     """ 以观测点为圆心，检索在距离范围内的 cell 和 node
-        如果指定了检索半径，那么在检索范围内无检索目标则返回None；
-        如果没有指定检索半径，那么返回距离最近的目标
+        如果指定了检索半径，那么在检索范围内无检索目标则返回空数组；
+        如果没有指定检索半径，那么返回距离最近的 k 个目标
+        cell 与 node 的球面空间索引在进程内按网格只建立一次，全部站点一次性矢量化检索
 
     Args:
         obs_coordinate (dict): 观测站点字典，key为站点名，value为站点经纬度元组，(lon,lat)
         cell_lonlat (tuple): cell中点经纬度元组
         node_lonlat (tuple): node经纬度元组
         radius (int): The radius to search in meters
+        cache (GridCache): cell 与 node 所属网格的缓存，相同的站点与检索条件直接读取缓存结果
+        k (int): 未指定检索半径时返回的最近目标个数
 
     Returns:
         观测点字典，key为站点名，value为符合条件的 cell 和 node 组成的字典
     """
-
-    def _find(d1, d2):
-        dist = Distance(d1, d2).vincenty
-        target_id = np.array([np.argmin(dist)]) if radius is None else np.where(dist < radius)[0]
-        return target_id, dist[target_id]
-
-    station_dict = {}
-    for name, cor in obs_coordinate.items():
-        tmp = station_dict[name] = {}
-        if cell_lonlat is not None:
-            tmp['cell_id'], tmp['cell_distance'] = _find(cell_lonlat, cor)
-        if node_lonlat is not None:
-            tmp['node_id'], tmp['node_distance'] = _find(node_lonlat, cor)
+    if cache is not None:
+        def _build():
+            tmp_dict = find_nearest(obs_coordinate, cell_lonlat, node_lonlat, radius, k=k)
+            return {'{0}/{1}'.format(name, item): val for name, sta_val in tmp_dict.items()
+                    for item, val in sta_val.items()}
+
+        key = ({name: tuple(map(float, cor)) for name, cor in obs_coordinate.items()}, cell_lonlat is not None,
+               node_lonlat is not None, radius, k)
+        station_dict = {name: {} for name in obs_coordinate}
+        for entry_name, val in cache.fetch('find_nearest', _build, key=key).items():
+            name, item = entry_name.rsplit('/', 1)
+            station_dict[name][item] = np.array(val)
+        return station_dict
+
+    names = list(obs_coordinate)
+    station_dict = {name: {} for name in names}
+    if not names:
+        return station_dict
+    sta_lon, sta_lat = np.array([obs_coordinate[name] for name in names], dtype=np.float64).T
+
+    for target, lonlat in (('cell', cell_lonlat), ('node', node_lonlat)):
+        if lonlat is None:
+            continue
+        index = SphericalIndex.cached(*lonlat)
+        if radius is None:
+            dist, target_id = index.query(sta_lon, sta_lat, k)
+            found = zip(target_id, dist)
+        else:
+            found = index.query_radius(sta_lon, sta_lat, radius)
+        for name, (target_id, dist) in zip(names, found):
+            station_dict[name]['{0}_id'.format(target)] = target_id
+            station_dict[name]['{0}_distance'.format(target)] = dist
     return station_dict
 
 
@@ -23,14 +23,24 @@ utils for processing time data
 #   get_time -- Get the corresponding sequence of moments from the base time  #
 #               and the interval time list.                                   #
 #   num_time2datetime -- Convert numeric time values to datetime instance.    #
+#   to_datetime64 -- Convert datetime, datetime64 or strings to datetime64.   #
+#   char2datetime64 -- Decode a character time array in one vectorized pass.  #
+#   char_time -- Decode the character time variable of a file with cache.    #
 #-----------------------------------------------------------------------------#
 """
+from collections import OrderedDict
 from datetime import datetime
 from typing import *
 
 import numpy as np
 from dateutil.relativedelta import relativedelta
-from netCDF4 import num2date, Variable
+from netCDF4 import num2date, Dataset, Variable
+
+from ESEP.esep.utils.utils import file_signature
+
+# 以文件签名为键缓存已解码的字符型时间，同一文件只解码一次；只保留最近使用的 CHAR_TIME_CACHE_SIZE 个文件
+CHAR_TIME_CACHE_SIZE = 256
+_char_time_cache = OrderedDict()
 
 
 class TimeUtil:
@@ -105,7 +115,8 @@ class TimeUtil:
     @staticmethod
     def extract_common_time_idx(d1: Union[list, np.ndarray], d2: Union[list, np.ndarray], lim_start=None,
                                 lim_end=None) -> tuple:
-        d1, d2 = np.array(d1), np.array(d2)
+        # 观测多为 datetime，模型 time_bj 为 datetime64，两边统一转为 datetime64 后再比较
+        d1, d2 = TimeUtil.to_datetime64(d1), TimeUtil.to_datetime64(d2)
         start_time = d1[0] if d1[0] > d2[0] else d2[0]
         end_time = d1[-1] if d1[-1] < d2[-1] else d2[-1]
 
@@ -131,9 +142,9 @@ class TimeUtil:
                     end_time = dt
                     break
         if lim_start is not None:
-            start_time = lim_start
+            start_time = TimeUtil.to_datetime64(lim_start)
         if lim_end is not None:
-            end_time = lim_end
+            end_time = TimeUtil.to_datetime64(lim_end)
         obs_idx = np.where(np.logical_and(start_time <= d1, d1 <= end_time))[0]
         model_idx = np.where(np.logical_and(start_time <= d2, d2 <= end_time))[0]
         return obs_idx, model_idx
@@ -219,3 +230,62 @@ class TimeUtil:
         for idx, t in enumerate(time_var_date_fmt):
             time_str_ls[idx] = t.strftime("%Y-%m-%d %H:%M:%SZ")
         return tuple(time_str_ls)
+
+    @staticmethod
+    def to_datetime64(t, unit: str = 'ms') -> np.ndarray:
+        """将 datetime、datetime64 或 ISO 8601 字符串(及其序列)统一转为 datetime64 数组
+
+        Args:
+            t: A time or a sequence of times
+            unit: The unit of the returned datetime64 array
+
+        Returns:
+            datetime64 array of the shape of t
+        """
+        return np.asarray(t, dtype='datetime64[{0}]'.format(unit))
+
+    @staticmethod
+    def char2datetime64(chars, unit: str = 'ms') -> np.ndarray:
+        """将字符型时间数组(如 FVCOM 的 Times)一次性矢量化解码为 datetime64 数组
+
+        Args:
+            chars: 2D character array (time, DateStrLen) or 1D array of ISO 8601 strings,
+                e.g. '2021-01-01T00:00:00.000000'
+            unit: The unit of the returned datetime64 array
+
+        Returns:
+            1D datetime64 array, blank strings are decoded as NaT
+        """
+        chars = np.ma.getdata(chars)
+        if chars.dtype.kind == 'S' and chars.dtype.itemsize == 1 and chars.ndim == 2:
+            chars = np.ascontiguousarray(chars).view('S{0}'.format(chars.shape[1]))[:, 0]
+        time_str = np.char.strip(np.asarray(chars).astype('U'))
+        time_str[time_str == ''] = 'NaT'
+        return time_str.astype('datetime64[{0}]'.format(unit))
+
+    @staticmethod
+    def char_time(fp, time_name: str = 'Times', ds: Dataset = None) -> np.ndarray:
+        """读取并解码文件中的字符型时间变量，结果按文件缓存，文件未改变时不会重复解码
+
+        Args:
+            fp: The path of the netCDF file
+            time_name: The name of the character time variable
+            ds: The opened Dataset of fp, it avoids opening the file again
+
+        Returns:
+            Read-only 1D datetime64[ms] array
+        """
+        key = (file_signature(fp), time_name)
+        time = _char_time_cache.pop(key, None)
+        if time is None:
+            if ds is None:
+                with Dataset(fp) as tmp_ds:
+                    chars = tmp_ds[time_name][:]
+            else:
+                chars = ds[time_name][:]
+            time = TimeUtil.char2datetime64(chars)
+            time.setflags(write=False)
+            while len(_char_time_cache) >= CHAR_TIME_CACHE_SIZE:
+                _char_time_cache.popitem(last=False)
+        _char_time_cache[key] = time
+        return time
@@ -19,68 +19,433 @@ utils for processing unstructured data
 
 -------------------------------------------------------------------------------
 """
+from collections import OrderedDict
+from itertools import chain
+
 import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from pygeos import Geometry, STRtree, from_wkb, linearrings, multipolygons, points, polygons, to_wkb
+
+from ESEP.esep.utils.cache import GridCache, key_hash
+from ESEP.esep.utils.spatial import EARTH_RADIUS
 
-from pygeos import Geometry, multipoints, polygons, STRtree, get_parts, coverage_union_all
+# 进程内的三角形定位器缓存，键为网格哈希
+_locator_cache = {}
+# 进程内的区域掩膜缓存，键为网格(有网格缓存时为 mesh_id)与网格点，只保留最近使用的 MASK_CACHE_SIZE 个
+MASK_CACHE_SIZE = 32
+_mask_cache = OrderedDict()
+# 进程内的节点/单元转换稀疏算子缓存
+_operator_cache = {}
 
 
-def _arr2polygon(coordinate: np.ndarray) -> Geometry:
-    """Compared with shapely，the pygeos maximises CPU performance and is much faster
+def boundary_edges(tri: np.ndarray) -> np.ndarray:
+    """ The edges belonging to a single element, directed so that the element lies on their left
 
     Args:
-        coordinate (np.ndarray): coordinate array; array(lon1,lat1,lon2,lat2,lon3,lat3)
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element, with the
+            nodes of every element in counterclockwise order
 
     Returns:
-        Geometry: coordinate Polygon
+        np.ndarray: Array of shape (nedge, 2), the start and end node of every boundary edge
 
     """
-    return polygons(np.reshape(coordinate, [3, 2]))
+    tri = np.asarray(np.ma.getdata(tri), dtype=np.int64)
+    edges = np.stack([tri, np.roll(tri, -1, axis=1)], axis=-1).reshape(-1, 2)
+    _, inverse, counts = np.unique(np.sort(edges, axis=1), axis=0, return_inverse=True, return_counts=True)
+    return edges[counts[np.ravel(inverse)] == 1]
+
+
+def ccw_tri(lon: np.ndarray, lat: np.ndarray, tri: np.ndarray) -> np.ndarray:
+    """Reorder the nodes of every element counterclockwise, FVCOM stores them clockwise"""
+    tri = np.array(np.ma.getdata(tri), dtype=np.int64)
+    x, y = np.ma.getdata(lon)[tri], np.ma.getdata(lat)[tri]
+    area2 = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+    tri[area2 < 0] = tri[area2 < 0][:, ::-1]
+    return tri
+
+
+def domain_polygon(lon: np.ndarray, lat: np.ndarray, tri: np.ndarray) -> Geometry:
+    """ The polygon of the grid domain built from the boundary edges
+
+    The boundary edges are chained into rings: counterclockwise rings are the shells (open boundary and coast) and
+    clockwise rings are the holes (islands).
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+
+    Returns:
+        Geometry: Polygon, or MultiPolygon when the grid has several disconnected parts
+
+    """
+    xy = np.stack([np.ma.getdata(lon), np.ma.getdata(lat)], axis=-1).astype(np.float64)
+    edges = boundary_edges(ccw_tri(lon, lat, tri))
+    edges = edges[np.argsort(edges[:, 0], kind='stable')]
+    # 各节点出发的边界边在 edges 中的范围，节点可能有多条出边(两部分网格只在一点相接)
+    first = np.searchsorted(edges[:, 0], np.arange(len(xy) + 1))
+    cursor = first[:-1].copy()
+
+    rings = []
+    for start in np.unique(edges[:, 0]):
+        while cursor[start] < first[start + 1]:
+            ring, node = [start], start
+            while True:
+                if cursor[node] >= first[node + 1]:
+                    break
+                nxt = edges[cursor[node], 1]
+                cursor[node] += 1
+                if nxt == start:
+                    break
+                ring.append(nxt)
+                node = nxt
+            if len(ring) >= 3:
+                rings.append(xy[ring])
+
+    def signed_area(ring):
+        return 0.5 * np.sum(ring[:, 0] * np.roll(ring[:, 1], -1) - np.roll(ring[:, 0], -1) * ring[:, 1])
+
+    shells = [ring for ring in rings if signed_area(ring) > 0]
+    holes = [ring for ring in rings if signed_area(ring) <= 0]
+    shell_polygons = np.array([polygons(ring) for ring in shells])
+    shell_holes = [[] for _ in shells]
+    if holes:
+        # 岛屿归入包含它的外边界
+        hole_points = points([ring[0] for ring in holes])
+        hole_id, shell_id = STRtree(shell_polygons).query_bulk(hole_points, predicate='within')
+        for h_id, s_id in zip(hole_id, shell_id):
+            shell_holes[s_id].append(holes[h_id])
+    parts = [polygons(shell, [linearrings(ring) for ring in shell_hole] if shell_hole else None)
+             for shell, shell_hole in zip(shells, shell_holes)]
+    return parts[0] if len(parts) == 1 else multipolygons(parts)
 
 
 def construct_mask(fvcom_lon: np.ndarray, fvcom_lat: np.ndarray, fvcom_tri: np.ndarray, lon: np.ndarray,
-                   lat: np.ndarray) -> tuple:
+                   lat: np.ndarray, cache: GridCache = None, with_polygon: bool = False) -> tuple:
     """Constructs a mask for a list of points which is true for points lying outside the specified fvcom domain and
     false for those within.
 
+    The triangles are built in bulk from the coordinate array and put in an STRtree which is queried by the points,
+    no union of the triangles is needed. Results are cached per mesh and points, in memory for the most recently
+    used ones.
+
     Args:
         fvcom_lon (np.ndarray): The array of the lon positions of the FVCOM grid nodes
         fvcom_lat (np.ndarray): The array of the lat positions of the FVCOM grid nodes
         fvcom_tri (np.ndarray): Qx3 python indexed triangulation array for the FVCOM grid
         lon (np.ndarray): The array of the longitudes to mask
         lat (np.ndarray): The array of the longitudes to mask
+        cache (GridCache): The grid cache of the FVCOM mesh, the result is reused for the same lon and lat
+        with_polygon (bool): Also return the fvcom domain polygon, see domain_polygon
+
+    Returns:
+        tuple: A boolean array (shape of lon) true for points outside the FVCOM domain and false for those within
+        and fvcom domain polygon (None unless with_polygon)
+
+    """
+    # 网格缓存已带有网格哈希，不必再次哈希整个网格
+    mesh_key = cache.mesh_id if cache is not None else key_hash(np.asarray(np.ma.getdata(fvcom_tri)),
+                                                                np.asarray(np.ma.getdata(fvcom_lon)),
+                                                                np.asarray(np.ma.getdata(fvcom_lat)))
+    key = key_hash(mesh_key, np.asarray(lon), np.asarray(lat))
+
+    def _build():
+        fvcom_ll = np.stack([np.ma.getdata(fvcom_lon), np.ma.getdata(fvcom_lat)], axis=-1).astype(np.float64)
+        grid_points = points(np.ravel(lon), np.ravel(lat))
+        tree = STRtree(polygons(fvcom_ll[np.asarray(np.ma.getdata(fvcom_tri))]))
+        point_id, _ = tree.query_bulk(grid_points, predicate='intersects')
+        out_of_domain_mask = np.ones(grid_points.size, dtype=bool)
+        out_of_domain_mask[point_id] = False
+        return {'mask': np.reshape(out_of_domain_mask, np.shape(lon))}
+
+    mask = _mask_cache.pop(key, None)
+    if mask is None:
+        if cache is None:
+            mask = _build()['mask']
+        else:
+            entry = cache.fetch('domain_mask', _build, key=(np.asarray(lon), np.asarray(lat)))
+            mask = np.array(entry['mask'])
+        while len(_mask_cache) >= MASK_CACHE_SIZE:
+            _mask_cache.popitem(last=False)
+    _mask_cache[key] = mask
+    mask = mask.copy()
+
+    polygon = None
+    if with_polygon:
+        if cache is None:
+            polygon = domain_polygon(fvcom_lon, fvcom_lat, fvcom_tri)
+        else:
+            entry = cache.fetch('domain_polygon', lambda: {
+                'polygon': np.array([to_wkb(domain_polygon(fvcom_lon, fvcom_lat, fvcom_tri))])})
+            polygon = from_wkb(entry['polygon'][0])
+    return mask, polygon
+
+
+def element_areas(lon: np.ndarray, lat: np.ndarray, tri: np.ndarray) -> np.ndarray:
+    """ The area of every element in m^2, each triangle projected on the plane tangent at its centre
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+
+    Returns:
+        np.ndarray: Array of shape (nelem,)
+
+    """
+    tri = np.asarray(np.ma.getdata(tri), dtype=np.int64)
+    lon_rad = np.deg2rad(np.asarray(np.ma.getdata(lon), dtype=np.float64))[tri]
+    lat_rad = np.deg2rad(np.asarray(np.ma.getdata(lat), dtype=np.float64))[tri]
+    x = EARTH_RADIUS * lon_rad * np.cos(lat_rad.mean(axis=1, keepdims=True))
+    y = EARTH_RADIUS * lat_rad
+    return 0.5 * np.abs((x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0]))
+
+
+def node2elem_operator(tri: np.ndarray, n_node: int = None, dtype=np.float64) -> sparse.csr_matrix:
+    """ Sparse matrix (nelem, nnode) averaging the three nodes of every element, built once per process
+
+    Args:
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+        n_node (int): The number of nodes, default tri.max() + 1
+        dtype: The dtype of the matrix, the same as the data it is applied to
+
+    Returns:
+        sparse.csr_matrix: The operator
+
+    """
+    tri = np.asarray(np.ma.getdata(tri), dtype=np.int64)
+    n_node = int(tri.max()) + 1 if n_node is None else int(n_node)
+    key = key_hash('node2elem', tri, n_node, np.dtype(dtype).str)
+    if key not in _operator_cache:
+        rows = np.repeat(np.arange(len(tri)), 3)
+        values = np.full(tri.size, 1 / 3, dtype=dtype)
+        _operator_cache[key] = sparse.csr_matrix((values, (rows, tri.ravel())), shape=(len(tri), n_node))
+    return _operator_cache[key]
+
+
+def elem2node_operator(lon: np.ndarray, lat: np.ndarray, tri: np.ndarray, dtype=np.float64) -> sparse.csr_matrix:
+    """ Sparse matrix (nnode, nelem) averaging the elements around every node weighted by their areas
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+        dtype: The dtype of the matrix, the same as the data it is applied to
+
+    Returns:
+        sparse.csr_matrix: The operator, rows of nodes belonging to no element are empty
+
+    """
+    tri = np.asarray(np.ma.getdata(tri), dtype=np.int64)
+    key = key_hash('elem2node', tri, np.asarray(np.ma.getdata(lon)), np.asarray(np.ma.getdata(lat)),
+                   np.dtype(dtype).str)
+    if key not in _operator_cache:
+        area = np.repeat(element_areas(lon, lat, tri), 3)
+        cols = np.repeat(np.arange(len(tri)), 3)
+        operator = sparse.csr_matrix((area, (tri.ravel(), cols)), shape=(np.size(lon), len(tri)))
+        total = np.asarray(operator.sum(axis=1)).ravel()
+        with np.errstate(divide='ignore'):
+            operator = sparse.diags(np.where(total > 0, 1 / total, 0)) @ operator
+        _operator_cache[key] = operator.tocsr().astype(dtype)
+    return _operator_cache[key]
+
+
+def apply_operator(operator: sparse.spmatrix, data: np.ndarray, out: np.ndarray = None,
+                   chunk_size: int = 2 ** 26) -> np.ndarray:
+    """ Apply a sparse operator to the last axis of data, chunk by chunk of the leading axes
+
+    Args:
+        operator (sparse.spmatrix): Matrix of shape (n_out, n_in)
+        data (np.ndarray): Array of shape (..., n_in), masked values are treated as NaN
+        out (np.ndarray): Optional output buffer of shape (..., n_out)
+        chunk_size (int): The maximum number of values of data handled at once
 
     Returns:
-        tuple: A 1d boolean array true for points outside the FVCOM domain and false for those within
-        and fvcom domain polygon
+        np.ndarray: Array of shape (..., n_out), float32 for float32 data and float64 otherwise
 
     """
-    fvcom_ll = np.concatenate([np.array(fvcom_lon).reshape(-1, 1), np.array(fvcom_lat).reshape(-1, 1)], axis=1)
-    grid_points = get_parts(multipoints(np.asarray([lon.flatten(), lat.flatten()]).T))
-    tri_ll = fvcom_ll[fvcom_tri]
-    tri_ll_shp = np.shape(tri_ll)
-    domain_polygon = coverage_union_all(
-        np.apply_along_axis(_arr2polygon, 1, np.reshape(tri_ll, [tri_ll_shp[0], np.multiply(*tri_ll_shp[1:])])))
-    out_of_domain_mask = np.full_like(grid_points, True, dtype=bool)
-    tree = STRtree(grid_points)
-    out_of_domain_mask[tree.query(domain_polygon, predicate='covers').tolist()] = False
-    out_of_domain_mask = np.reshape(out_of_domain_mask, np.shape(lon))
-    return out_of_domain_mask, domain_polygon
-
-
-def nodes2elems(nodes: np.ndarray, tri: np.ndarray) -> np.ndarray:
+    data = np.ma.filled(data, np.nan) if np.ma.isMaskedArray(data) else np.asarray(data)
+    dtype = np.float32 if data.dtype == np.float32 else np.float64
+    n_out, n_in = operator.shape
+    lead_shape = np.shape(data)[:-1]
+    if out is None:
+        out = np.empty(lead_shape + (n_out,), dtype=dtype)
+    elif out.shape != lead_shape + (n_out,):
+        raise ValueError('out has shape {0}, expected {1}'.format(out.shape, lead_shape + (n_out,)))
+    if operator.dtype != dtype:
+        operator = operator.astype(dtype)
+
+    flat = np.reshape(data, (-1, n_in))
+    flat_out = np.reshape(out, (-1, n_out))
+    step = max(1, chunk_size // max(n_in, 1))
+    for start in range(0, len(flat), step):
+        chunk = flat[start:start + step].astype(dtype, copy=False)
+        flat_out[start:start + step] = (operator @ chunk.T).T
+    if not np.shares_memory(flat_out, out):
+        out[...] = np.reshape(flat_out, out.shape)
+    return out
+
+
+def nodes2elems(nodes: np.ndarray, tri: np.ndarray, out: np.ndarray = None) -> np.ndarray:
     """ Calculate an element-centre value based on the average value for the nodes from which it is formed.
     This involves an average, so the conversion from nodes to elements cannot be reversed without smoothing.
 
     Args:
         nodes (np.ndarray): Array of unstructured grid node values to move to the element centres.
         tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element.
+        out (np.ndarray): Optional output buffer of shape (..., nelem).
+
+    Returns:
+        np.ndarray: Array of values at the element centres.
+
+    """
+    dtype = np.float32 if np.asarray(nodes).dtype == np.float32 else np.float64
+    return apply_operator(node2elem_operator(tri, np.shape(nodes)[-1], dtype), nodes, out)
+
+
+def elems2nodes(elems: np.ndarray, tri: np.ndarray, lon: np.ndarray, lat: np.ndarray,
+                out: np.ndarray = None) -> np.ndarray:
+    """ Calculate a node value as the area-weighted average of the elements sharing the node.
+
+    Args:
+        elems (np.ndarray): Array of unstructured grid element values to move to the nodes.
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element.
+        lon (np.ndarray): The longitude of the grid nodes.
+        lat (np.ndarray): The latitude of the grid nodes.
+        out (np.ndarray): Optional output buffer of shape (..., nnode).
 
     Returns:
         np.ndarray: Array of values at the grid nodes.
 
     """
-    if np.ndim(nodes) == 1:
-        elems = nodes[tri].mean(axis=-1)
-    else:
-        elems = nodes[..., tri].mean(axis=-1)
-    return elems
+    dtype = np.float32 if np.asarray(elems).dtype == np.float32 else np.float64
+    return apply_operator(elem2node_operator(lon, lat, tri, dtype), elems, out)
+
+
+def bbox_index(lon: np.ndarray, lat: np.ndarray, lon_rng, lat_rng, margin: float = 0.1,
+               cache: GridCache = None) -> np.ndarray:
+    """ Indices of the points lying in a longitude/latitude box extended by a margin
+
+    Args:
+        lon (np.ndarray): The longitude of the points, e.g. lonc of the FVCOM grid
+        lat (np.ndarray): The latitude of the points
+        lon_rng: (lon_min, ..., lon_max)
+        lat_rng: (lat_min, ..., lat_max)
+        margin (float): The margin added on each side of the box in degrees
+        cache (GridCache): The grid cache of the mesh which the points belong to
+
+    Returns:
+        np.ndarray: The sorted indices of the points in the box
+
+    """
+    def _build():
+        lon_arr, lat_arr = np.ma.getdata(lon), np.ma.getdata(lat)
+        in_box = np.logical_and(np.logical_and(lon_arr <= lon_rng[-1] + margin, lon_arr >= lon_rng[0] - margin),
+                                np.logical_and(lat_arr <= lat_rng[-1] + margin, lat_arr >= lat_rng[0] - margin))
+        return {'index': np.where(in_box)[0]}
+
+    if cache is None:
+        return _build()['index']
+    # 节点与单元中心个数可能相同，以坐标本身区分点集
+    key = (np.asarray(np.ma.getdata(lon)), np.asarray(np.ma.getdata(lat)), float(lon_rng[0]), float(lon_rng[-1]),
+           float(lat_rng[0]), float(lat_rng[-1]), float(margin))
+    return np.array(cache.fetch('bbox_index', _build, key=key)['index'])
+
+
+class TriangleLocator:
+    """ Locate points in the triangles of an unstructured grid
+
+    Points are first tested against the triangles of the k nearest element centres. The remaining points are tested
+    against every triangle whose centre is closer than its own circumscribing radius around the centre, which is
+    exact; triangles are grouped by that radius so each ball query stays small.
+
+    Args:
+        lon (np.ndarray): The longitude of the grid nodes
+        lat (np.ndarray): The latitude of the grid nodes
+        tri (np.ndarray): Array of shape (nelem, 3) comprising the list of connectivity for each element
+
+    """
+
+    def __init__(self, lon, lat, tri):
+        self.xy = np.stack([np.ma.getdata(lon), np.ma.getdata(lat)], axis=-1).astype(np.float64)
+        self.tri = np.asarray(np.ma.getdata(tri), dtype=np.int64)
+        corners = self.xy[self.tri]
+        self.centre = corners.mean(axis=1)
+        self.radius = np.linalg.norm(corners - self.centre[:, np.newaxis], axis=-1).max(axis=1)
+        self.tree = cKDTree(self.centre)
+
+        # 按外接半径分组，每组内以组内最大半径检索
+        group = np.floor(np.log2(np.maximum(self.radius, 1e-12))).astype(int)
+        self.groups = []
+        for grp in np.unique(group):
+            elem = np.flatnonzero(group == grp)
+            self.groups.append((elem, cKDTree(self.centre[elem]), self.radius[elem].max()))
+
+    @classmethod
+    def cached(cls, lon, lat, tri):
+        key = key_hash(np.asarray(np.ma.getdata(tri)), np.asarray(np.ma.getdata(lon)),
+                       np.asarray(np.ma.getdata(lat)))
+        if key not in _locator_cache:
+            _locator_cache[key] = cls(lon, lat, tri)
+        return _locator_cache[key]
+
+    def barycentric(self, elem, x, y) -> np.ndarray:
+        """Barycentric weights (n, 3) of the points (x, y) in the triangles elem"""
+        a, b, c = (self.xy[self.tri[elem, i]] for i in range(3))
+        v0, v1 = b - a, c - a
+        v2x, v2y = x - a[:, 0], y - a[:, 1]
+        den = v0[:, 0] * v1[:, 1] - v1[:, 0] * v0[:, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w1 = (v2x * v1[:, 1] - v1[:, 0] * v2y) / den
+            w2 = (v0[:, 0] * v2y - v2x * v0[:, 1]) / den
+        return np.stack([1 - w1 - w2, w1, w2], axis=-1)
+
+    def _test(self, pt_id, elem, x, y, found, weights, eps):
+        bary = self.barycentric(elem, x[pt_id], y[pt_id])
+        inside = np.all(bary >= -eps, axis=1)
+        pt_id, elem, bary = pt_id[inside], elem[inside], bary[inside]
+        # 同一点落在多个三角形(公共边)时取第一个
+        pt_id, first = np.unique(pt_id, return_index=True)
+        found[pt_id] = elem[first]
+        weights[pt_id] = bary[first]
+
+    def locate(self, x, y, k: int = 8, eps: float = 1e-10) -> tuple:
+        """ Find the triangle containing every point
+
+        Args:
+            x: The longitude of the points
+            y: The latitude of the points
+            k (int): The number of nearest element centres tested first
+            eps (float): Tolerance of the barycentric weights for points on the edges
+
+        Returns:
+            tuple: the element index of every point (-1 outside the grid) and the barycentric weights (n, 3) with
+            respect to the nodes tri[elem]
+
+        """
+        x = np.ravel(np.ma.getdata(x)).astype(np.float64)
+        y = np.ravel(np.ma.getdata(y)).astype(np.float64)
+        found = np.full(x.size, -1, dtype=np.int64)
+        weights = np.zeros((x.size, 3))
+        if not x.size:
+            return found, weights
+
+        k = min(k, len(self.tri))
+        _, near = self.tree.query(np.stack([x, y], axis=-1), k=k)
+        near = np.reshape(near, (x.size, k))
+        self._test(np.repeat(np.arange(x.size), k), near.ravel(), x, y, found, weights, eps)
+
+        left = np.flatnonzero(found < 0)
+        for elem, tree, radius in self.groups:
+            if not left.size:
+                break
+            candidates = tree.query_ball_point(np.stack([x[left], y[left]], axis=-1), radius)
+            counts = np.fromiter(map(len, candidates), dtype=np.int64, count=left.size)
+            if not counts.sum():
+                continue
+            cand = elem[np.fromiter(chain.from_iterable(candidates), dtype=np.int64, count=counts.sum())]
+            self._test(np.repeat(left, counts), cand, x, y, found, weights, eps)
+            left = left[found[left] < 0]
+        return found, weights
@@ -25,8 +25,11 @@ utility functions
 #   get_dims -- Fetches the dimensions of the object.                         #
 #   is_number -- Judge the string whether is a digital string.                #
 #   ls2slice -- Convert the sequence to a slice or itself.                    #
+#   idx2slices -- Group sorted indices into the fewest contiguous slices.     #
+#   file_signature -- Identify the content version of a file by its stat.     #
 #-----------------------------------------------------------------------------#
 """
+import os
 import re
 
 import numpy as np
@@ -133,3 +136,53 @@ def ls2slice(rng: tuple or list):
         return rng
     else:
         return rslt[0]
+
+
+def idx2slices(idx, max_gap: int = 0) -> list:
+    """Group sorted unique indices into the fewest contiguous slices.
+
+    Two neighbouring runs are merged into one slice when the number of
+    indices missing between them is not larger than max_gap, so the caller
+    trades a few unused items for fewer read requests.
+
+    :param idx: class:list, class:ndarray(one-dimension), Sorted unique
+    non-negative indices
+    :param max_gap: class:int, The largest gap that is bridged by a slice
+    :return: class:list, A list of slice objects with step 1
+    ------------------------------------------------------------------
+    Examples:
+
+    >>> idx2slices([1, 2, 3, 7, 8])
+    [slice(1, 4, None), slice(7, 9, None)]
+    >>> idx2slices([1, 2, 3, 7, 8], max_gap=3)
+    [slice(1, 9, None)]
+
+    """
+    idx = np.asarray(idx, dtype=np.int64)
+    if not idx.size:
+        return []
+    breaks = np.where(np.diff(idx) > max_gap + 1)[0]
+    starts = np.concatenate([[idx[0]], idx[breaks + 1]])
+    stops = np.concatenate([idx[breaks], [idx[-1]]]) + 1
+    return [slice(int(strt), int(stop)) for strt, stop in zip(starts, stops)]
+
+
+def file_signature(fp) -> tuple:
+    """Identify the content version of a file by its stat.
+
+    The signature changes whenever the file is rewritten, so it can be used
+    as the key of caches derived from the file.
+
+    :param fp: class:str, class:Path, The path of a file
+    :return: class:tuple, (absolute path, size, modification time in ns)
+    ------------------------------------------------------------------
+    Examples:
+
+    >>> path, size, mtime_ns = file_signature(__file__)
+    >>> path == os.path.abspath(__file__)
+    True
+
+    """
+    fp = os.path.abspath(os.fspath(fp))
+    stat = os.stat(fp)
+    return fp, stat.st_size, stat.st_mtime_ns
@@ -0,0 +1,203 @@
+# -*- coding:utf-8 -*-
+"""
+-------------------------------------------------------------------------------
+
+                 Project Name : ESEP
+
+                    File Name : vertical.py
+
+                   Start Date : 2022-04-18 09:45
+
+                  Contributor : D.CW
+
+                        Email : dengchuangwu@gmail.com
+
+-------------------------------------------------------------------------------
+Introduction:
+
+sigma 坐标到 z 坐标的垂向插值
+
+FVCOM 的 sigma 坐标在 0(水面)到 -1(床面)之间，某时刻的水柱厚度为 D = h + zeta，
+层中心的高程为 zeta + sigma * D。同一水柱内高程是 sigma 的线性函数，因而在 sigma
+空间内线性插值即等价于按深度线性插值：把目标深度换算为目标 sigma，逐层比较得到所在
+层号，再用 take_along_axis 一次取出上下两层数值，整个 (time, layer, n) 数据块一次完成。
+
+-------------------------------------------------------------------------------
+"""
+import numpy as np
+
+REFERENCES = ('surface', 'bottom')
+# 观测报表中的相对水深(自水面向下占水深的比例)，middle 与报表的中层列一致取 0.4H
+RELATIVE_DEPTHS = {'surface': 0.0, '0.2H': 0.2, '0.4H': 0.4, 'middle': 0.4, '0.6H': 0.6, '0.8H': 0.8, 'bottom': 1.0}
+
+
+def check_depth(z, reference):
+    """ Check a fixed depth below the surface or height above the bed, as z and z_ref of the extraction tools
+
+    Args:
+        z: The distance (m, positive)
+        reference (str): None (z selects layers, nothing is checked), 'surface' or 'bottom'
+
+    """
+    if reference is None:
+        return
+    if reference not in REFERENCES:
+        raise ValueError('z_ref must be one of {0}'.format(REFERENCES))
+    if isinstance(z, bool) or not isinstance(z, (int, float, np.integer, np.floating)):
+        raise ValueError('z must be a distance in meters when z_ref is {0!r}, got {1!r}'.format(reference, z))
+
+
+def layer_elevation(sigma, h, zeta) -> np.ndarray:
+    """ The elevation (m, positive up from the mean sea level) of the sigma layers
+
+    Args:
+        sigma (np.ndarray): siglay or siglev of shape (layer, n)
+        h (np.ndarray): The bathymetry of shape (n,), positive down
+        zeta (np.ndarray): The surface elevation of shape (time, n)
+
+    Returns:
+        np.ndarray: The elevation of shape (time, layer, n)
+
+    """
+    zeta = np.asarray(zeta)[:, np.newaxis]
+    return zeta + np.asarray(sigma)[np.newaxis] * (np.asarray(h) + zeta)
+
+
+def target_sigma(z_levels, h, zeta, reference: str = 'surface') -> np.ndarray:
+    """ The sigma of depths measured from the surface or heights measured from the bed
+
+    Args:
+        z_levels: The distances (m, positive) below the surface or above the bed
+        h (np.ndarray): The bathymetry of shape (n,)
+        zeta (np.ndarray): The surface elevation of shape (time, n)
+        reference (str): 'surface' or 'bottom'
+
+    Returns:
+        np.ndarray: The sigma of shape (time, level, n), NaN outside the water column or where it is dry
+
+    """
+    z_levels = np.asarray(z_levels, dtype=np.float64).reshape(1, -1, 1)
+    return _depth_sigma(z_levels, (np.asarray(h) + np.asarray(zeta))[:, np.newaxis], reference)
+
+
+def _depth_sigma(z_levels, total, reference) -> np.ndarray:
+    if reference not in REFERENCES:
+        raise ValueError('reference must be one of {0}'.format(REFERENCES))
+    z_levels, total = np.broadcast_arrays(np.asarray(z_levels, dtype=np.float64), np.asarray(total, dtype=np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sigma = -z_levels / total if reference == 'surface' else z_levels / total - 1
+    # 床面以下、水面以上与干单元均无值
+    sigma[(sigma < -1) | (sigma > 0) | ~(total > 0)] = np.nan
+    return sigma
+
+
+def sigma_to_z(data, sigma, h, zeta, z_levels, reference: str = 'surface') -> np.ndarray:
+    """ Interpolate sigma-layer data to depths below the surface or heights above the bed
+
+    Between two layers the value is linear in depth; above the first layer and below the last one the nearest layer
+    is used, and levels below the bed (or above the surface) are NaN.
+
+    Args:
+        data (np.ndarray): The data of shape (time, layer, n)
+        sigma (np.ndarray): The sigma of the layers of data, shape (layer, n) or (layer,), decreasing along the
+            layers
+        h (np.ndarray): The bathymetry of shape (n,)
+        zeta (np.ndarray): The surface elevation of shape (time, n)
+        z_levels: The distances (m, positive) below the surface or above the bed
+        reference (str): 'surface' or 'bottom'
+
+    Returns:
+        np.ndarray: The data of shape (time, level, n)
+
+    """
+    return _interp_sigma(data, sigma, target_sigma(z_levels, h, zeta, reference))
+
+
+def sigma_to_z_points(data, sigma, h, zeta, z, reference: str = 'surface') -> np.ndarray:
+    """ Interpolate the sigma profiles of points, each to its own depth below the surface or height above the bed
+
+    Args:
+        data (np.ndarray): The profiles of shape (layer, n)
+        sigma (np.ndarray): The sigma of the layers, shape (layer, n) or (layer,)
+        h (np.ndarray): The bathymetry of the points, shape (n,)
+        zeta (np.ndarray): The surface elevation of the points, shape (n,)
+        z (np.ndarray): The distance (m, positive) of every point below the surface or above the bed, shape (n,)
+        reference (str): 'surface' or 'bottom'
+
+    Returns:
+        np.ndarray: The values of shape (n,), NaN below the bed
+
+    """
+    target = _depth_sigma(np.reshape(z, (1, 1, -1)), np.reshape(np.asarray(h) + np.asarray(zeta), (1, 1, -1)),
+                          reference)
+    return _interp_sigma(np.asarray(data)[np.newaxis], sigma, target)[0, 0]
+
+
+def relative_depth(data, sigma, fractions) -> np.ndarray:
+    """ Interpolate sigma-layer data to relative depths, the fractions of the water depth below the surface
+
+    The relative depth of a sigma layer is -sigma whatever the water level, so neither h nor zeta is needed.
+
+    Args:
+        data (np.ndarray): The data of shape (time, layer, n)
+        sigma (np.ndarray): The sigma of the layers of data, shape (layer, n) or (layer,)
+        fractions: The relative depths, 0 at the surface and 1 at the bed, or names of RELATIVE_DEPTHS
+
+    Returns:
+        np.ndarray: The data of shape (time, level, n)
+
+    """
+    # 名称与数值混合时逐个换算，转为数组会把数值也变成字符串
+    fractions = [fractions] if isinstance(fractions, str) or np.ndim(fractions) == 0 else list(fractions)
+    fractions = [RELATIVE_DEPTHS[f] if isinstance(f, str) else f for f in fractions]
+    target = -np.asarray(fractions, dtype=np.float64).reshape(1, -1, 1)
+    return _interp_sigma(data, sigma, target)
+
+
+def vertical_mean(data, siglev) -> np.ndarray:
+    """ The thickness-weighted vertical mean of sigma-layer data, NaN layers are left out
+
+    Args:
+        data (np.ndarray): The data of shape (time, layer, n)
+        siglev (np.ndarray): The sigma of the layer interfaces, shape (layer + 1, n) or (layer + 1,)
+
+    Returns:
+        np.ndarray: The mean of shape (time, n)
+
+    """
+    data = np.ma.filled(data, np.nan) if np.ma.isMaskedArray(data) else np.asarray(data)
+    siglev = np.asarray(siglev, dtype=np.float64)
+    if siglev.ndim == 1:
+        siglev = siglev[:, np.newaxis]
+    thickness = -np.diff(siglev, axis=0)[np.newaxis]
+    valid = ~np.isnan(data)
+    weight = np.sum(np.where(valid, thickness, 0), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(weight > 0, np.sum(np.where(valid, data * thickness, 0), axis=1) / weight, np.nan)
+
+
+def _interp_sigma(data, sigma, target) -> np.ndarray:
+    """Linear interpolation of (time, layer, n) data at the sigma target of shape (time or 1, level, n)"""
+    data = np.ma.filled(data, np.nan) if np.ma.isMaskedArray(data) else np.asarray(data)
+    sigma = np.asarray(sigma, dtype=np.float64)
+    if sigma.ndim == 1:
+        sigma = sigma[:, np.newaxis]
+    n_layer = sigma.shape[0]
+    target = np.broadcast_to(target, (data.shape[0],) + target.shape[1:-1] + (data.shape[-1],))
+
+    # 逐层累加得到目标所在层号 k：sigma[k-1] >= target > sigma[k]，只占用 (time, level, n) 的内存
+    below = np.zeros(target.shape, dtype=np.intp)
+    for layer in range(n_layer):
+        below += sigma[layer] >= target
+    upper = np.clip(below - 1, 0, n_layer - 1)
+    lower = np.clip(below, 0, n_layer - 1)
+
+    sigma_upper = np.take_along_axis(sigma[np.newaxis], upper, axis=1)
+    sigma_lower = np.take_along_axis(sigma[np.newaxis], lower, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(upper == lower, 0, (sigma_upper - target) / (sigma_upper - sigma_lower))
+    value_upper = np.take_along_axis(data, upper, axis=1)
+    value_lower = np.take_along_axis(data, lower, axis=1)
+    out = value_upper + weight * (value_lower - value_upper)
+    out[np.isnan(target)] = np.nan
+    return out
@@ -12,3 +12,89 @@ def test_data():
 def show_plot(pytestconfig):
     return pytestconfig.getoption('show_plot')
 
+
+
+def write_fvcom(path, nt=48, t0=None, seed=0, nx=13, ny=11, kb=6, fmt='NETCDF4', uniform=False):
+    """A small FVCOM output on a regular triangulated grid over 121-122.5E, 30-31N, hourly from t0 (UTC)
+
+    With uniform, u = cos(2 pi t / 12.42 h), v = 0, zeta = 0.5 sin(2 pi t / 12.42 h), h = 10 and ssc0 = 2;
+    otherwise the fields are random.
+    """
+    from datetime import datetime, timedelta
+
+    import netCDF4 as nc
+    import numpy as np
+
+    t0 = datetime(2021, 1, 1) if t0 is None else t0
+    rng = np.random.default_rng(seed)
+    xs, ys = np.meshgrid(np.linspace(121, 122.5, nx), np.linspace(30, 31, ny))
+    lon, lat = xs.ravel(), ys.ravel()
+    tri = []
+    for j in range(ny - 1):
+        for i in range(nx - 1):
+            a = j * nx + i
+            tri += [[a, a + nx, a + 1], [a + 1, a + nx, a + nx + 1]]
+    tri = np.array(tri)
+    n_elem, n_node = len(tri), lon.size
+
+    with nc.Dataset(path, 'w', format=fmt) as ds:
+        for dim, size in [('node', n_node), ('nele', n_elem), ('three', 3), ('siglay', kb - 1), ('siglev', kb),
+                          ('time', None), ('DateStrLen', 26)]:
+            ds.createDimension(dim, size)
+        ds.createVariable('lon', 'f4', ('node',))[:] = lon
+        ds.createVariable('lat', 'f4', ('node',))[:] = lat
+        ds.createVariable('lonc', 'f4', ('nele',))[:] = lon[tri].mean(axis=1)
+        ds.createVariable('latc', 'f4', ('nele',))[:] = lat[tri].mean(axis=1)
+        ds.createVariable('nv', 'i4', ('three', 'nele'))[:] = tri.T + 1
+        siglev = -np.linspace(0, 1, kb)
+        ds.createVariable('siglev', 'f4', ('siglev', 'node'))[:] = np.repeat(siglev[:, None], n_node, axis=1)
+        ds.createVariable('siglay', 'f4', ('siglay', 'node'))[:] = np.repeat(
+            ((siglev[1:] + siglev[:-1]) / 2)[:, None], n_node, axis=1)
+        ds.createVariable('h', 'f4', ('node',))[:] = np.full(n_node, 10.0) if uniform else 5 + 10 * rng.random(n_node)
+        times = [t0 + timedelta(hours=i) for i in range(nt)]
+        ds.createVariable('Times', 'S1', ('time', 'DateStrLen'))[:] = np.array(
+            [t.strftime('%Y-%m-%dT%H:%M:%S.000000') for t in times], 'S26').view('S1').reshape(nt, 26)
+        ds.createVariable('time', 'f4', ('time',))[:] = np.arange(nt) / 24
+
+        phase = 2 * np.pi * np.arange(nt) / 12.42
+        fields = {
+            'u': (('time', 'siglay', 'nele'), np.broadcast_to(np.cos(phase)[:, None, None], (nt, kb - 1, n_elem))),
+            'v': (('time', 'siglay', 'nele'), np.zeros((nt, kb - 1, n_elem))),
+            'zeta': (('time', 'node'), np.broadcast_to(0.5 * np.sin(phase)[:, None], (nt, n_node))),
+            'ssc0': (('time', 'siglay', 'node'), np.full((nt, kb - 1, n_node), 2.0)),
+            'bot_dthck': (('time', 'nele'), np.zeros((nt, n_elem))),
+        }
+        for name, (dims, data) in fields.items():
+            var = ds.createVariable(name, 'f4', dims, zlib=fmt == 'NETCDF4')
+            var.long_name = name
+            var.units = 'm'
+            var[:] = data if uniform else rng.standard_normal(data.shape)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def esep_cache(tmp_path, monkeypatch):
+    from ESEP.esep.utils.cache import CACHE_DIR_ENV
+
+    cache_dir = tmp_path / 'esep-cache'
+    monkeypatch.setenv(CACHE_DIR_ENV, str(cache_dir))
+    return cache_dir
+
+
+@pytest.fixture(scope='session')
+def fvcom_file(tmp_path_factory):
+    return str(write_fvcom(tmp_path_factory.mktemp('fvcom') / 'case.nc'))
+
+
+@pytest.fixture(scope='session')
+def fvcom_parts(tmp_path_factory):
+    from datetime import datetime, timedelta
+
+    root = tmp_path_factory.mktemp('parts')
+    return [str(write_fvcom(root / 'part_{0}.nc'.format(i), nt=24, t0=datetime(2021, 1, 1) + timedelta(days=i),
+                            seed=i)) for i in range(3)]
+
+
+@pytest.fixture(scope='session')
+def uniform_fvcom_file(tmp_path_factory):
+    return str(write_fvcom(tmp_path_factory.mktemp('uniform') / 'uniform.nc', uniform=True))
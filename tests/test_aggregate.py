@@ -0,0 +1,39 @@
+import numpy as np
+
+from ESEP.esep.reader.aggregate import TemporalAggregates
+from ESEP.esep.reader.unstructured import FvcomReader
+
+
+def test_time_mean_matches_raw(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    aggregates = TemporalAggregates(fvcom)
+    aggregates.build(['u', 'zeta'], levels=('daily', 'tidal', 'monthly'))
+    u, zeta = fvcom.read('u'), fvcom.read('zeta')
+    for time_idx in (np.arange(48), np.arange(16, 48), np.arange(2, 45), np.arange(10, 14)):
+        np.testing.assert_allclose(aggregates.time_mean('u', time_idx, layer=1), u[time_idx, 1].mean(axis=0),
+                                   atol=1e-5)
+        np.testing.assert_allclose(aggregates.time_mean('zeta', time_idx, nodes=[3, 1]),
+                                   zeta[time_idx][:, [3, 1]].mean(axis=0), atol=1e-5)
+    aggregates.close()
+
+
+def test_daily_extremes(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    aggregates = TemporalAggregates(fvcom)
+    aggregates.build(['zeta'], levels=('daily',))
+    daily = aggregates.dataset('daily')
+    zeta = fvcom.read('zeta')
+    # 北京时间 2021-01-02 为第 16-39 个时刻
+    np.testing.assert_array_equal(daily['count'][:], [16, 24, 8])
+    np.testing.assert_allclose(daily['zeta_max'][1], zeta[16:40].max(axis=0))
+    np.testing.assert_allclose(daily['zeta'][1], zeta[16:40].mean(axis=0), atol=1e-6)
+    aggregates.close()
+
+
+def test_plan_prefers_the_level_covering_more(fvcom_file):
+    aggregates = TemporalAggregates(FvcomReader(fvcom_file))
+    aggregates.build(['u'], levels=('daily', 'tidal'))
+    plan = dict(aggregates.plan('u', np.arange(16, 48)))
+    np.testing.assert_array_equal(plan['daily'], [1, 2])
+    assert 'tidal' not in plan and not plan[None].size
+    aggregates.close()
@@ -0,0 +1,37 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from ESEP.esep.reader.unstructured import CaseSet, FvcomReader
+from .fixtures import write_fvcom
+
+
+def test_read_all_cases(fvcom_parts):
+    cases = CaseSet({'a': fvcom_parts[0], 'b': fvcom_parts[1], 'c': fvcom_parts[2]})
+    try:
+        expected = np.stack([FvcomReader(fp).read('u', time=[5, 2], layer=1, cells=[7, 3]) for fp in fvcom_parts])
+        np.testing.assert_array_equal(cases.read('u', time=[5, 2], layer=1, cells=[7, 3]), expected)
+        assert cases['b'].fp == fvcom_parts[1] and len(cases) == 3
+    finally:
+        cases.close()
+
+
+def test_read_time_period(fvcom_file, tmp_path):
+    other = str(write_fvcom(tmp_path / 'other.nc', seed=5))
+    cases = CaseSet({'a': fvcom_file, 'b': other})
+    try:
+        # 北京时间 10-12 时为第 2-4 个时刻
+        rslt = cases.read('zeta', nodes=[0, 9], time_period=[datetime(2021, 1, 1, 10), datetime(2021, 1, 1, 12)])
+        np.testing.assert_array_equal(rslt, [FvcomReader(fp).read('zeta', time=slice(2, 5), nodes=[0, 9])
+                                             for fp in (fvcom_file, other)])
+    finally:
+        cases.close()
+
+
+def test_cases_must_share_the_mesh(fvcom_file, tmp_path):
+    other = write_fvcom(tmp_path / 'other.nc', nt=2, nx=12)
+    with pytest.raises(ValueError):
+        CaseSet({'a': fvcom_file, 'b': str(other)})
+    with pytest.raises(ValueError):
+        CaseSet({})
@@ -0,0 +1,60 @@
+import netCDF4 as nc
+import numpy as np
+
+from ESEP.esep.reader.chunking import _copy_variable, benchmark, inspect_chunking, rechunk
+from .fixtures import write_fvcom
+
+
+def test_rechunk_keeps_the_data(fvcom_file, tmp_path):
+    dst = rechunk(fvcom_file, tmp_path / 'station.nc', pattern='station')
+    with nc.Dataset(fvcom_file) as src, nc.Dataset(dst) as out:
+        for name in ('u', 'zeta', 'Times', 'nv'):
+            np.testing.assert_array_equal(out[name][:], src[name][:])
+    info = inspect_chunking(dst, ['u', 'zeta'])
+    # 站点分块：整个时间维在一个分块内
+    assert info['u']['chunking'][0] == 48
+    assert info['zeta']['station_chunks'] == 1
+    assert info['u']['map_chunks'] >= 1
+
+
+def test_netcdf3(tmp_path):
+    fp = write_fvcom(tmp_path / 'classic.nc', nt=6, fmt='NETCDF3_64BIT_OFFSET')
+    info = inspect_chunking(fp)
+    assert info['u']['chunking'] == 'contiguous'
+    assert info['u']['station_chunks'] == info['u']['map_chunks'] == 1
+    assert set(benchmark(fp, 'u', n_read=2)) == {'station', 'map'}
+    dst = rechunk(fp, pattern='map')
+    assert inspect_chunking(dst, ['zeta'])['zeta']['chunking'][0] == 1
+
+
+def test_copy_reads_every_source_chunk_once(tmp_path):
+    # 按时刻分块的源文件重写为按站点分块，两种布局互为转置
+    src_fp = tmp_path / 'map.nc'
+    with nc.Dataset(src_fp, 'w') as ds:
+        ds.createDimension('time', 40)
+        ds.createDimension('node', 300)
+        ds.createVariable('zeta', 'f4', ('time', 'node'), zlib=True, chunksizes=(1, 300))[:] = \
+            np.arange(12000, dtype=np.float32).reshape(40, 300)
+
+    class Recorder:
+        def __init__(self, var):
+            self.var, self.keys = var, []
+            self.shape, self.dtype = var.shape, var.dtype
+
+        def chunking(self):
+            return self.var.chunking()
+
+        def __getitem__(self, key):
+            self.keys.append(key)
+            return self.var[key]
+
+    with nc.Dataset(src_fp) as src, nc.Dataset(tmp_path / 'station.nc', 'w') as dst:
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, len(dim))
+        out = dst.createVariable('zeta', 'f4', ('time', 'node'), zlib=True, chunksizes=(40, 10))
+        recorder = Recorder(src['zeta'])
+        _copy_variable(recorder, out, memory_bytes=7 * 300 * 4)
+        np.testing.assert_array_equal(out[:], src['zeta'][:])
+    # 每块是整数个源分块(7 个时刻)，每个源分块只读取一次
+    assert [(key[0].start, key[0].stop) for key in recorder.keys] == [(i, min(i + 7, 40)) for i in range(0, 40, 7)]
+    assert all(key[1] == slice(0, 300) for key in recorder.keys)
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from ESEP.esep.physics.flux import SectionFlux, transport
+from ESEP.esep.reader.unstructured import FvcomReader
+
+
+def test_discharge_matches_velocity_times_area(uniform_fvcom_file):
+    fvcom = FvcomReader(uniform_fvcom_file)
+    # 自南向北的断面，法向(右侧)朝东
+    section = SectionFlux(fvcom, [[121.75, 30.1], [121.75, 30.9]])
+    rslt = section.series(time_chunk=7, sediment=['ssc0'])
+
+    phase = 2 * np.pi * np.arange(48) / 12.42
+    length = 6370997 * np.deg2rad(0.8)
+    area = (10 + 0.5 * np.sin(phase)) * length
+    np.testing.assert_allclose(section.dl.sum(), length, rtol=1e-3)
+    np.testing.assert_allclose(rslt['area'], area, rtol=1e-3)
+    np.testing.assert_allclose(rslt['discharge'], np.cos(phase) * area, rtol=1e-3, atol=1e-3 * area.max())
+    np.testing.assert_allclose(rslt['ssc0'], 2 * rslt['discharge'], rtol=1e-5)
+    assert rslt['time'].size == 48
+
+
+def test_section_selection(uniform_fvcom_file):
+    section = SectionFlux(FvcomReader(uniform_fvcom_file), [[121.75, 30.1], [121.75, 30.9]])
+    full = section.series()
+    np.testing.assert_allclose(section.series(time=[5, 2, 40])['discharge'], full['discharge'][[5, 2, 40]])
+    with pytest.raises(ValueError):
+        section.series(time=slice(10, 10))
+
+
+def test_transport():
+    time = np.datetime64('2021-01-01T00') + np.arange(5) * np.timedelta64(1, 'h')
+    rslt = transport([1.0, 1.0, -1.0, -1.0, 1.0], time)
+    # 首末时刻各占半个时间步
+    assert rslt['net'][0] == pytest.approx(0)
+    assert rslt['positive'][0] == pytest.approx(3600 * 2.0)
+    assert rslt['negative'][0] == pytest.approx(-3600 * 2.0)
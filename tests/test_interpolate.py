@@ -0,0 +1,35 @@
+import numpy as np
+
+from ESEP.esep.reader.unstructured import FvcomReader
+from ESEP.esep.utils.interpolate import GridInterpolator, TriangleRegridder, station2grid
+
+LOC_RANGE = [120.9, 122.6, 29.9, 31.1]
+
+
+def test_grid_interpolator_matches_griddata():
+    rng = np.random.default_rng(0)
+    lon, lat = rng.uniform(121, 122.5, 200), rng.uniform(30, 31, 200)
+    data = rng.standard_normal((3, 200))
+    interpolator = GridInterpolator(lon, lat, LOC_RANGE, 0.05)
+    grid_data = interpolator(data)
+    assert grid_data.shape == (3,) + interpolator.shape
+    for t in range(3):
+        lon_grid, lat_grid, expected = station2grid(data[t], lon, lat, LOC_RANGE, 0.05)
+        np.testing.assert_allclose(grid_data[t], expected, atol=1e-10)
+    np.testing.assert_array_equal(lon_grid, interpolator.lon_grid)
+    assert GridInterpolator.cached(lon, lat, LOC_RANGE, 0.05) is GridInterpolator.cached(lon, lat, LOC_RANGE, 0.05)
+
+
+def test_triangle_regridder_is_exact_for_linear_fields(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    lon, lat = np.asarray(fvcom.lon, dtype=np.float64), np.asarray(fvcom.lat, dtype=np.float64)
+    data = np.stack([2 + 3 * lon - lat, lon * 0 + 1.5])
+    for cache in (None, fvcom.grid_cache, fvcom.grid_cache):
+        regridder = TriangleRegridder(fvcom.lon, fvcom.lat, fvcom.tri, [120.93, 122.6, 29.93, 31.1], 0.05, cache)
+        lon_grid, lat_grid = regridder.lon_grid, regridder.lat_grid
+        inside = (lon_grid > 121) & (lon_grid < 122.5) & (lat_grid > 30) & (lat_grid < 31)
+        np.testing.assert_array_equal(regridder.mask, ~inside)
+        for grid_data in (regridder(data), regridder(data[:, regridder.nodes])):
+            np.testing.assert_allclose(grid_data[0][inside], (2 + 3 * lon_grid - lat_grid)[inside], atol=1e-5)
+            np.testing.assert_allclose(grid_data[1][inside], 1.5)
+            assert np.isnan(grid_data[:, ~inside]).all()
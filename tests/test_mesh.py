@@ -0,0 +1,65 @@
+import numpy as np
+
+from ESEP.esep.reader.unstructured import FvcomReader
+from ESEP.esep.utils.mesh import MeshTopology
+from ESEP.esep.utils.spatial import EARTH_RADIUS
+from ESEP.esep.utils.unstructured import element_areas
+
+
+def test_topology_of_a_regular_mesh(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    tri = np.asarray(fvcom.tri)
+    topology = fvcom.topology
+    # 13 x 11 个节点的规则网格
+    assert topology.n_node == 143 and topology.n_elem == 240
+    assert topology.n_edge == 12 * 11 + 13 * 10 + 12 * 10
+    assert len(topology.boundary_edges) == 2 * (12 + 10)
+    assert topology.boundary_nodes.size == 2 * (12 + 10)
+    for node in range(topology.n_node):
+        expected = np.flatnonzero(np.any(tri == node, axis=1))
+        np.testing.assert_array_equal(np.sort(topology.elems_of_node(node)), expected)
+    # 相邻单元共用第 i 个节点的对边
+    for elem in range(topology.n_elem):
+        for i, other in enumerate(topology.elem_neighbours[elem]):
+            if other >= 0:
+                assert set(tri[other]) & set(tri[elem]) == set(tri[elem]) - {tri[elem, i]}
+        assert sorted(topology.elems_of_elem(elem)) == sorted(n for n in topology.elem_neighbours[elem] if n >= 0)
+    np.testing.assert_allclose(topology.elem_area, element_areas(fvcom.lon, fvcom.lat, tri))
+    np.testing.assert_allclose(topology.node_area.sum(), topology.elem_area.sum())
+
+
+def test_topology_from_the_grid_cache(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    built = MeshTopology.from_mesh(fvcom.lon, fvcom.lat, fvcom.tri)
+    for _ in range(2):
+        cached = MeshTopology.from_mesh(fvcom.lon, fvcom.lat, fvcom.tri, fvcom.grid_cache)
+        for name in ('node_elem_ptr', 'node_elem', 'elem_neighbours', 'edges', 'edge_elems', 'node_area'):
+            np.testing.assert_array_equal(getattr(cached, name), getattr(built, name))
+
+
+def test_gradients_of_linear_fields(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    tri = np.asarray(fvcom.tri)
+    lon, lat = np.asarray(fvcom.lon, dtype=np.float64), np.asarray(fvcom.lat, dtype=np.float64)
+    lon_c, lat_c = lon[tri].mean(axis=1), lat[tri].mean(axis=1)
+    # 各单元切平面上 1 度经度与纬度的长度(m)
+    metre_lon = EARTH_RADIUS * np.deg2rad(1) * np.cos(np.deg2rad(lat_c))
+    metre_lat = EARTH_RADIUS * np.deg2rad(1)
+    gradient = fvcom.gradient
+
+    ddx, ddy = gradient.node_gradient(np.stack([lon, 2 * lat]))
+    np.testing.assert_allclose(ddx[0], 1 / metre_lon, rtol=1e-6)
+    np.testing.assert_allclose(ddy[0], 0, atol=1e-12)
+    np.testing.assert_allclose(ddy[1], 2 / metre_lat, rtol=1e-6)
+
+    # 纬向流随纬度线性变化：涡度为 -du/dy，散度为 0
+    u, v = 3 * lat_c, np.zeros_like(lat_c)
+    np.testing.assert_allclose(gradient.vorticity(u, v), -3 / metre_lat, rtol=1e-6)
+    np.testing.assert_allclose(gradient.divergence(u, v), 0, atol=1e-12)
+    np.testing.assert_allclose(gradient.divergence(lon_c, v), 1 / metre_lon, rtol=1e-6)
+
+    # 只取部分单元的算子与整体算子一致
+    elems = [100, 3, 57]
+    operator, columns = gradient.stencil(elems)
+    ddx, ddy = gradient.apply(operator, lon_c[columns])
+    np.testing.assert_allclose(ddx, gradient.element_gradient(lon_c)[0][elems])
@@ -0,0 +1,121 @@
+import netCDF4 as nc
+import numpy as np
+import pytest
+
+from ESEP.esep.reader.base import hyperslab_read, time_blocks
+from ESEP.esep.reader.unstructured import FvcomReader
+
+
+def test_hyperslab_read_keeps_order_and_duplicates(fvcom_file):
+    with nc.Dataset(fvcom_file) as ds:
+        var = ds['u']
+        full = var[:].filled(np.nan)
+        cells = [40, 3, 3, 17, 0, 41]
+        layers = [4, 0]
+        out = hyperslab_read(var, [slice(5, 9), layers, cells], max_gap=2)
+        np.testing.assert_array_equal(out, full[5:9][:, layers][:, :, cells])
+        # 整数选择去掉该维
+        np.testing.assert_array_equal(hyperslab_read(var, [7, None, cells]), full[7][:, cells])
+        mask = np.zeros(var.shape[-1], dtype=bool)
+        mask[[2, 9, 10]] = True
+        np.testing.assert_array_equal(hyperslab_read(var, [None, 1, mask]), full[:, 1][:, mask])
+
+
+def test_read_selection(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    full = fvcom.read('ssc0')
+    nodes = [30, 2, 2, 100]
+    np.testing.assert_array_equal(fvcom.read('ssc0', time=[3, 1], layer=2, nodes=nodes), full[[3, 1]][:, 2][:, nodes])
+    assert fvcom.read('h').shape == (fvcom.lon.size,)
+
+
+def test_read_multiple_files(fvcom_parts):
+    parts = [FvcomReader(fp) for fp in fvcom_parts]
+    fvcom = FvcomReader(fvcom_parts)
+    cells = [5, 1, 1, 60]
+    expected = np.concatenate([part.read('u', layer=0, cells=cells) for part in parts])
+    np.testing.assert_array_equal(fvcom.read('u', layer=0, cells=cells), expected)
+    # 跨文件的时间选择
+    np.testing.assert_array_equal(fvcom.read('u', time=[23, 24, 50], layer=0, cells=cells), expected[[23, 24, 50]])
+    time_bj = np.concatenate([np.asarray(part.time_bj) for part in parts])
+    np.testing.assert_array_equal(np.asarray(fvcom.time_bj), time_bj)
+
+
+def test_mesh_arrays_are_ndarrays(fvcom_file):
+    for _ in range(2):
+        # 第二次打开由网格缓存读取
+        fvcom = FvcomReader(fvcom_file)
+        for name in ('lon', 'lat', 'tri', 'lonc', 'latc'):
+            assert type(getattr(fvcom, name)) is np.ndarray
+
+
+def test_iter_chunks(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    full = fvcom.read('zeta')
+    for time in (None, slice(3, 20), [1, 4, 5, 9, 30]):
+        blocks = [block for _, block in fvcom.iter_chunks('zeta', 4, time=time)]
+        expected = full[np.arange(48)[slice(None) if time is None else time]]
+        np.testing.assert_array_equal(np.concatenate(blocks), expected)
+    assert list(time_blocks(10, [1, 2, 5], 2))[0].tolist() == [1, 2]
+
+
+def test_subset_read(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    region = fvcom.subset([121.4, 121.9, 30.3, 30.7])
+    np.testing.assert_array_equal(region.read('zeta', time=0), fvcom.read('zeta', time=0)[region.node_idx])
+    with pytest.raises(ValueError):
+        fvcom.subset([125, 126, 40, 41])
+
+
+def test_station_profiles(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    # 5 个等厚度的层，层中心位于 0.1H, 0.3H, ..., 0.9H
+    for var_name, selection in (('ssc0', {'nodes': [40, 5]}), ('u', {'cells': [7, 100, 7]})):
+        data = fvcom.read(var_name, time=slice(3, 9), **selection)
+        profiles = fvcom.station_profiles([var_name], levels=['surface', '0.2H', '0.4H', 0.8, 'bottom'],
+                                          time=slice(3, 9), **selection)[var_name]
+        np.testing.assert_allclose(profiles['surface'], data[:, 0])
+        np.testing.assert_allclose(profiles['0.2H'], (data[:, 0] + data[:, 1]) / 2, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(profiles['0.4H'], (data[:, 1] + data[:, 2]) / 2, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(profiles[0.8], (data[:, 3] + data[:, 4]) / 2, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(profiles['bottom'], data[:, 4])
+        np.testing.assert_allclose(profiles['verticalMean'], data.mean(axis=1), rtol=1e-5, atol=1e-6)
+
+
+def test_extract_points(fvcom_file):
+    from matplotlib.tri import LinearTriInterpolator, Triangulation
+
+    from ESEP.esep.utils.unstructured import elems2nodes
+
+    fvcom = FvcomReader(fvcom_file)
+    rng = np.random.default_rng(1)
+    lon, lat = rng.uniform(121.1, 122.4, 6), rng.uniform(30.1, 30.9, 6)
+    lon[-1] = 120.5
+    steps = np.asarray(fvcom.time_bj, dtype='datetime64[ms]')
+    offset = rng.uniform(0, 46, 6)
+    time = steps[0] + (offset * 3600 * 1000).astype('timedelta64[ms]')
+    z = rng.uniform(0.5, 4, 6)
+    triangulation = Triangulation(np.asarray(fvcom.lon, np.float64), np.asarray(fvcom.lat, np.float64), fvcom.tri)
+
+    def _expected(values):
+        # 先在空间上重心插值，再在时间上线性插值
+        at_steps = np.stack([LinearTriInterpolator(triangulation, step)(lon, lat).filled(np.nan) for step in values])
+        return np.array([np.interp(offset[p], np.arange(len(values)), at_steps[:, p]) for p in range(lon.size)])
+
+    np.testing.assert_allclose(fvcom.extract_points('zeta', time, lon, lat), _expected(fvcom.read('zeta')),
+                               rtol=1e-5, atol=1e-6, equal_nan=True)
+    u = elems2nodes(fvcom.read('u', layer=0).astype(np.float64), fvcom.tri, fvcom.lon, fvcom.lat)
+    np.testing.assert_allclose(fvcom.extract_points('u', time, lon, lat, z=0), _expected(u), rtol=1e-5, atol=1e-6,
+                               equal_nan=True)
+
+    # 分层变量：各层插值到点上后按深度线性插值
+    ssc = fvcom.read('ssc0')
+    layers = np.stack([_expected(ssc[:, k]) for k in range(ssc.shape[1])])
+    depth = _expected(fvcom.read('zeta')) + _expected(np.broadcast_to(fvcom.read('h'), (48, fvcom.lon.size)))
+    siglay = fvcom.read('siglay', nodes=0)
+    expected = [np.interp(z[p], -siglay * depth[p], layers[:, p]) for p in range(lon.size)]
+    np.testing.assert_allclose(fvcom.extract_points('ssc0', time, lon, lat, z=z, time_chunk=4), expected, rtol=1e-5,
+                               atol=1e-6, equal_nan=True)
+    assert np.isnan(fvcom.extract_points('zeta', steps[0] - np.timedelta64(1, 'h'), lon[0], lat[0])).all()
+    with pytest.raises(ValueError):
+        fvcom.extract_points('ssc0', time, lon, lat)
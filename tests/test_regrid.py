@@ -0,0 +1,52 @@
+from datetime import datetime
+
+import netCDF4 as nc
+import numpy as np
+import pytest
+
+from ESEP.esep.app.regrid import main, regrid
+from ESEP.esep.reader.unstructured import FvcomReader
+from ESEP.esep.utils.interpolate import GridInterpolator, TriangleRegridder
+
+LOC_RANGE = [121.23, 122.03, 30.23, 30.83]
+
+
+def _check(fp, fvcom_file, time_idx):
+    fvcom = FvcomReader(fvcom_file)
+    regridder = TriangleRegridder(fvcom.lon, fvcom.lat, fvcom.tri, LOC_RANGE, 0.05)
+    region = fvcom.subset(LOC_RANGE, 0.1)
+    interpolator = GridInterpolator(region.lonc, region.latc, LOC_RANGE, 0.05)
+    with nc.Dataset(fp) as ds:
+        np.testing.assert_array_equal(ds['lon'][:], regridder.lon_grid[0])
+        np.testing.assert_array_equal(ds['time'][:], fvcom.time_bj[time_idx].astype('datetime64[ms]').astype(np.int64))
+        np.testing.assert_array_equal(ds['siglay_index'][:], [0, 2])
+        np.testing.assert_allclose(ds['zeta'][:], regridder(fvcom.read('zeta', time=time_idx)), rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(ds['h'][:], regridder(fvcom.read('h')), rtol=1e-6)
+        expected = interpolator(region.read('u', time=time_idx, layer=[0, 2]))
+        np.testing.assert_allclose(ds['u'][:], expected, rtol=1e-5, atol=1e-6)
+        assert ds['u'].chunking() == [1, 1] + list(regridder.shape)
+
+
+def test_regrid_netcdf(fvcom_file, tmp_path):
+    fp = regrid(fvcom_file, tmp_path / 'grid.nc', ['zeta', 'u', 'h'], LOC_RANGE, 0.05, layers=[0, 2],
+                time_period=[datetime(2021, 1, 1, 10), datetime(2021, 1, 2, 20)], time_chunk=5, workers=3)
+    _check(fp, fvcom_file, np.arange(2, 37))
+    # 临时文件已替换为产品
+    assert [p.name for p in tmp_path.glob('*.nc')] == ['grid.nc']
+
+
+def test_regrid_command_line(fvcom_file, tmp_path, capsys):
+    dst = tmp_path / 'grid.nc'
+    main([fvcom_file, '-o', str(dst), '--var', 'zeta', 'u', 'h', '--range'] + [str(x) for x in LOC_RANGE] +
+         ['--space', '0.05', '--layers', '0', '2', '--workers', '2'])
+    assert capsys.readouterr().out.strip() == str(dst)
+    _check(dst, fvcom_file, np.arange(48))
+
+
+def test_regrid_zarr(fvcom_file, tmp_path):
+    zarr = pytest.importorskip('zarr')
+    fp = regrid(fvcom_file, tmp_path / 'grid.zarr', ['zeta'], LOC_RANGE, 0.05, time_chunk=7)
+    group = zarr.open_group(str(fp), mode='r')
+    fvcom = FvcomReader(fvcom_file)
+    regridder = TriangleRegridder(fvcom.lon, fvcom.lat, fvcom.tri, LOC_RANGE, 0.05)
+    np.testing.assert_allclose(group['zeta'][:], regridder(fvcom.read('zeta')), rtol=1e-5, atol=1e-6)
@@ -0,0 +1,87 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import netCDF4 as nc
+import numpy as np
+import pytest
+
+from ESEP.esep.app.server import ExtractionClient, ExtractionService, _HEADER, make_server, recv_message
+from ESEP.esep.reader.unstructured import FvcomReader
+from .fixtures import write_fvcom
+
+
+@pytest.fixture
+def address():
+    # Unix socket 路径长度有限，不使用 pytest 的临时目录
+    root = tempfile.mkdtemp()
+    yield os.path.join(root, 'esep.sock')
+    shutil.rmtree(root, ignore_errors=True)
+
+
+@pytest.fixture
+def server(address):
+    server = make_server(address)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_station_round_trip(fvcom_file, address, server):
+    fvcom = FvcomReader(fvcom_file)
+    with ExtractionClient(address) as client:
+        assert client.request('ping') == {}
+        rslt = client.station(fvcom_file, 'zeta', [121.25, 122.0], [30.2, 30.8])
+    lon, lat = np.asarray(fvcom.lon), np.asarray(fvcom.lat)
+    nearest = [np.argmin((lon - x) ** 2 + (lat - y) ** 2) for x, y in ((121.25, 30.2), (122.0, 30.8))]
+    np.testing.assert_array_equal(rslt['index'], nearest)
+    np.testing.assert_array_equal(rslt['data'], fvcom.read('zeta', nodes=nearest))
+    assert rslt['time'].size == 48
+
+
+def test_malformed_header(fvcom_file, address, server):
+    with ExtractionClient(address) as client:
+        raw = json.dumps([1, 2]).encode('utf-8')
+        client.sock.sendall(_HEADER.pack(len(raw)) + raw)
+        header, _ = recv_message(client.sock)
+        assert not header['ok']
+        # 回复错误后服务端关闭连接
+        with pytest.raises(ConnectionError):
+            recv_message(client.sock)
+    with ExtractionClient(address) as client:
+        with pytest.raises(RuntimeError):
+            client.request('unknown')
+        assert client.request('ping') == {}
+
+
+def test_refuses_to_remove_a_regular_file(address):
+    with open(address, 'w') as f:
+        f.write('keep')
+    with pytest.raises(FileExistsError):
+        make_server(address)
+    assert os.path.isfile(address)
+
+
+def test_replaces_a_stale_socket(address):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(address)
+    sock.close()
+    make_server(address).server_close()
+
+
+@pytest.mark.filterwarnings('error')
+def test_regional_mean_without_valid_values(tmp_path):
+    fp = write_fvcom(tmp_path / 'dry.nc', nt=4)
+    with nc.Dataset(fp, 'a') as ds:
+        ds['zeta'][2] = np.ma.masked
+    fvcom = FvcomReader(str(fp))
+    rslt = ExtractionService().regional_mean(str(fp), 'zeta', [121.2, 121.6], [30.2, 30.6])
+    assert np.isnan(rslt['data'][2])
+    zeta = fvcom.read('zeta', time=0)
+    inside = (fvcom.lon >= 121.2) & (fvcom.lon <= 121.6) & (fvcom.lat >= 30.2) & (fvcom.lat <= 30.6)
+    assert np.nanmin(zeta[inside]) <= rslt['data'][0] <= np.nanmax(zeta[inside])
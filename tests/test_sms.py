@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from ESEP.esep.reader.sms import read_sms_mesh
+
+MESH = """MESH2D
+MESHNAME "test"
+E3T 1 10 30 20 1
+E3T 2 20 30 40 2
+ND 40 1.0 1.0 -4.0
+ND 10 0.0 0.0 -1.0
+ND 30 0.0 1.0 -3.0
+ND 20 1.0 0.0 -2.0
+NS 10 20 30
+NS -40 open
+NS 30 -10
+BEGPARAMDEF
+"""
+
+
+@pytest.mark.filterwarnings('error')
+def test_read_sms_mesh(tmp_path):
+    fp = tmp_path / 'mesh.2dm'
+    fp.write_text(MESH)
+    for _ in range(2):
+        # 第二次由缓存读取
+        tri, nodes, x, y, z, types, nodestrings = read_sms_mesh(fp, nodestrings=True)
+        np.testing.assert_array_equal(nodes, [10, 20, 30, 40])
+        np.testing.assert_array_equal(tri, [[0, 2, 1], [1, 2, 3]])
+        np.testing.assert_array_equal(x, [0, 1, 0, 1])
+        np.testing.assert_array_equal(z, [-1, -2, -3, -4])
+        np.testing.assert_array_equal(types, [1, 2])
+        assert [ns.tolist() for ns in nodestrings] == [[0, 1, 2, 3], [2, 0]]
+
+
+def test_read_sms_mesh_without_nodestrings(tmp_path):
+    fp = tmp_path / 'mesh.2dm'
+    fp.write_text(''.join(line + '\n' for line in MESH.splitlines() if not line.startswith('NS')))
+    assert read_sms_mesh(fp, nodestrings=True)[-1] == []
+    assert len(read_sms_mesh(fp, cache=False)) == 6
@@ -0,0 +1,35 @@
+import numpy as np
+
+from ESEP.esep.reader.unstructured import FvcomReader
+from ESEP.esep.utils.spatial import EARTH_RADIUS, find_nearest
+
+STATIONS = {'A': (121.33, 30.41), 'B': (122.02, 30.87), 'C': (121.0, 30.0)}
+
+
+def _distance(lon, lat, lon0, lat0):
+    lon, lat, lon0, lat0 = [np.deg2rad(np.asarray(x, dtype=np.float64)) for x in (lon, lat, lon0, lat0)]
+    a = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat) * np.cos(lat0) * np.sin((lon - lon0) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def test_find_nearest_matches_brute_force(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    for cache in (None, fvcom.grid_cache, fvcom.grid_cache):
+        for k in (1, 3):
+            rslt = find_nearest(STATIONS, (fvcom.lonc, fvcom.latc), (fvcom.lon, fvcom.lat), cache=cache, k=k)
+            for name, (lon, lat) in STATIONS.items():
+                dist = _distance(fvcom.lon, fvcom.lat, lon, lat)
+                np.testing.assert_array_equal(np.ravel(rslt[name]['node_id']), np.argsort(dist)[:k])
+                np.testing.assert_allclose(np.ravel(rslt[name]['node_distance']), np.sort(dist)[:k], rtol=1e-6)
+                dist = _distance(fvcom.lonc, fvcom.latc, lon, lat)
+                np.testing.assert_array_equal(np.ravel(rslt[name]['cell_id']), np.argsort(dist)[:k])
+
+
+def test_find_nearest_radius(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    for cache in (None, fvcom.grid_cache, fvcom.grid_cache):
+        rslt = find_nearest(STATIONS, node_lonlat=(fvcom.lon, fvcom.lat), radius=8000, cache=cache)
+        for name, (lon, lat) in STATIONS.items():
+            dist = _distance(fvcom.lon, fvcom.lat, lon, lat)
+            np.testing.assert_array_equal(rslt[name]['node_id'], np.flatnonzero(dist < 8000))
+            assert 'cell_id' not in rslt[name]
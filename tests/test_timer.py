@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from ESEP.esep.utils import timer
+from ESEP.esep.utils.timer import TimeUtil
+from .fixtures import write_fvcom
+
+
+def test_char_time_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(timer, 'CHAR_TIME_CACHE_SIZE', 2)
+    monkeypatch.setattr(timer, '_char_time_cache', timer.OrderedDict())
+    files = [write_fvcom(tmp_path / 'case_{0}.nc'.format(i), nt=3) for i in range(3)]
+    for fp in files + files[-1:]:
+        time = TimeUtil.char_time(fp)
+    np.testing.assert_array_equal(time, np.datetime64('2021-01-01T00') + np.arange(3) * np.timedelta64(1, 'h'))
+    # 只保留最近使用的两个文件
+    assert [key[0][0] for key in timer._char_time_cache] == [str(files[1]), str(files[2])]
+
+
+def test_common_time_idx_with_datetime_and_datetime64():
+    model_time = np.datetime64('2021-01-01T08') + np.arange(24) * np.timedelta64(1, 'h')
+    obs_time = [datetime(2021, 1, 1, 6) + timedelta(minutes=30 * i) for i in range(20)]
+    obs_idx, model_idx = TimeUtil().extract_common_time_idx(obs_time, model_time)
+    np.testing.assert_array_equal(obs_idx, np.arange(4, 19))
+    np.testing.assert_array_equal(model_idx, np.arange(0, 8))
+    obs_idx, model_idx = TimeUtil().extract_common_time_idx(obs_time, model_time, datetime(2021, 1, 1, 10),
+                                                            datetime(2021, 1, 1, 12))
+    np.testing.assert_array_equal(obs_idx, [8, 9, 10, 11, 12])
+    np.testing.assert_array_equal(model_idx, [2, 3, 4])
+
+
+def test_time_series_with_datetime_and_datetime64(tmp_path):
+    import matplotlib
+    matplotlib.use('Agg')
+    from ESEP.esep.plot.time_series import TimeSeries
+
+    model_time = np.datetime64('2021-01-01T08') + np.arange(60) * np.timedelta64(10, 'm')
+    obs_time = np.array([datetime(2021, 1, 1, 8) + timedelta(minutes=20 * i) for i in range(30)])
+    TimeSeries('A').depth(obs_time, model_time, np.sin(np.arange(30)), np.sin(np.arange(60)), tmp_path / 'a.png')
+    assert (tmp_path / 'a.png').is_file()
@@ -0,0 +1,45 @@
+import numpy as np
+
+from ESEP.esep.reader.unstructured import FvcomReader
+from ESEP.esep.utils.unstructured import elems2nodes
+
+POLYLINE = [[120.9, 30.5], [121.6, 30.2], [122.2, 30.8]]
+
+
+def _interp(fvcom, values, lon, lat):
+    from matplotlib.tri import LinearTriInterpolator, Triangulation
+
+    triangulation = Triangulation(np.asarray(fvcom.lon, np.float64), np.asarray(fvcom.lat, np.float64), fvcom.tri)
+    values = np.reshape(values, (-1, np.shape(values)[-1]))
+    out = [LinearTriInterpolator(triangulation, row)(lon, lat).filled(np.nan) for row in values]
+    return np.reshape(out, np.shape(values)[:-1] + (lon.size,))
+
+
+def test_transect(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    section = fvcom.transect(POLYLINE, 2000)
+    assert fvcom.transect(np.array(POLYLINE), 2000) is section
+    assert np.all(np.diff(section.distance) > 0) and np.all(np.diff(section.distance)[:-1] == 2000)
+    np.testing.assert_allclose([section.lon[-1], section.lat[-1]], POLYLINE[-1])
+    # 第一个顶点在网格外
+    assert section.outside[0] and not section.outside[-1]
+    np.testing.assert_array_equal(section.outside, section.lon < 121)
+
+    zeta = section.read('zeta', time=slice(4, 30), time_chunk=7)
+    np.testing.assert_allclose(zeta, _interp(fvcom, fvcom.read('zeta', time=slice(4, 30)), section.lon, section.lat),
+                               rtol=1e-5, atol=1e-6, equal_nan=True)
+    u = elems2nodes(fvcom.read('u', time=[2, 9], layer=1).astype(np.float64), fvcom.tri, fvcom.lon, fvcom.lat)
+    np.testing.assert_allclose(section.read('u', time=[2, 9], layer=1), _interp(fvcom, u, section.lon, section.lat),
+                               rtol=1e-5, atol=1e-6, equal_nan=True)
+    np.testing.assert_allclose(section.read('h'), _interp(fvcom, fvcom.read('h'), section.lon, section.lat)[0],
+                               rtol=1e-5, equal_nan=True)
+    assert section.elevation(time=slice(0, 2)).shape == (2, 5, section.lon.size)
+
+
+def test_transect_from_the_grid_cache(fvcom_file):
+    first = FvcomReader(fvcom_file).transect(POLYLINE, 5000)
+    # 新的读取器由网格缓存得到相同的断面点
+    second = FvcomReader(fvcom_file).transect(POLYLINE, 5000)
+    assert second is not first
+    np.testing.assert_array_equal(second.elem, first.elem)
+    np.testing.assert_array_equal(second.weights, first.weights)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from ESEP.esep.reader.unstructured import FvcomReader
+from ESEP.esep.utils import unstructured
+from ESEP.esep.utils.unstructured import apply_operator, boundary_edges, construct_mask, domain_polygon
+from ESEP.esep.utils.unstructured import elem2node_operator, element_areas, elems2nodes, nodes2elems
+
+
+def test_construct_mask_cache(fvcom_file, monkeypatch):
+    monkeypatch.setattr(unstructured, 'MASK_CACHE_SIZE', 2)
+    monkeypatch.setattr(unstructured, '_mask_cache', unstructured.OrderedDict())
+    fvcom = FvcomReader(fvcom_file)
+    for step in (0.1, 0.2, 0.25, 0.1):
+        lon, lat = np.meshgrid(np.arange(120.83, 122.8, step), np.arange(29.83, 31.2, step))
+        mask, _ = construct_mask(fvcom.lon, fvcom.lat, fvcom.tri, lon, lat, fvcom.grid_cache)
+        inside = (lon >= 121) & (lon <= 122.5) & (lat >= 30) & (lat <= 31)
+        np.testing.assert_array_equal(mask, ~inside)
+        # 返回副本，修改不影响缓存
+        mask[...] = False
+    assert len(unstructured._mask_cache) == 2
+
+
+def _mesh_with_island(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    lon, lat = np.asarray(fvcom.lon, dtype=np.float64), np.asarray(fvcom.lat, dtype=np.float64)
+    tri = np.asarray(fvcom.tri)
+    # 去掉一个内部节点周围的单元，形成岛屿
+    island = np.any(tri == 5 * 13 + 6, axis=1)
+    return lon, lat, tri[~island], tri[island]
+
+
+def test_domain_polygon_and_mask_with_an_island(fvcom_file):
+    from matplotlib.tri import Triangulation
+    from pygeos import area, get_num_interior_rings
+
+    lon, lat, tri, removed = _mesh_with_island(fvcom_file)
+    assert len(boundary_edges(tri)) == 2 * (12 + 10) + 6
+    polygon = domain_polygon(lon, lat, tri)
+    assert get_num_interior_rings(polygon) == 1
+    x, y = lon[removed], lat[removed]
+    hole = 0.5 * np.abs((x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])).sum()
+    assert area(polygon) == pytest.approx(1.5 * 1.0 - hole)
+
+    grid_lon, grid_lat = np.meshgrid(np.arange(120.93, 122.6, 0.02), np.arange(29.93, 31.1, 0.02))
+    mask, with_polygon = construct_mask(lon, lat, tri, grid_lon, grid_lat, with_polygon=True)
+    expected = Triangulation(lon, lat, tri).get_trifinder()(grid_lon, grid_lat) < 0
+    np.testing.assert_array_equal(mask, expected)
+    assert area(with_polygon) == pytest.approx(area(polygon))
+
+
+def test_node_element_conversion(fvcom_file):
+    fvcom = FvcomReader(fvcom_file)
+    tri = np.asarray(fvcom.tri)
+    nodes = fvcom.read('ssc0', time=slice(0, 3))
+    np.testing.assert_allclose(nodes2elems(nodes, tri), nodes[..., tri].mean(axis=-1), atol=1e-6)
+    assert nodes2elems(nodes, tri).dtype == np.float32
+
+    elems = fvcom.read('u', time=slice(0, 3)).astype(np.float64)
+    area = element_areas(fvcom.lon, fvcom.lat, tri)
+    expected = np.zeros(elems.shape[:-1] + (fvcom.lon.size,))
+    weight = np.zeros(fvcom.lon.size)
+    for corner in range(3):
+        np.add.at(np.moveaxis(expected, -1, 0), tri[:, corner], np.moveaxis(elems * area, -1, 0))
+        np.add.at(weight, tri[:, corner], area)
+    out = np.empty_like(expected)
+    rslt = elems2nodes(elems, tri, fvcom.lon, fvcom.lat, out=out)
+    assert rslt is out
+    np.testing.assert_allclose(rslt, expected / weight, rtol=1e-10)
+    # 分块计算与整体计算一致
+    operator = elem2node_operator(fvcom.lon, fvcom.lat, tri)
+    np.testing.assert_allclose(apply_operator(operator, elems, chunk_size=500), rslt, rtol=1e-12)
+    with pytest.raises(ValueError):
+        apply_operator(operator, elems, out=np.empty(3))
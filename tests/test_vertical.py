@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from ESEP.esep.utils.vertical import check_depth, relative_depth, sigma_to_z, vertical_mean
+
+
+def _columns():
+    rng = np.random.default_rng(0)
+    siglev = -np.linspace(0, 1, 6)
+    siglay = (siglev[1:] + siglev[:-1]) / 2
+    data = rng.standard_normal((3, 5, 4))
+    h = np.array([10.0, 5.0, 20.0, 8.0])
+    zeta = rng.uniform(-1, 1, (3, 4))
+    return siglev, siglay, data, h, zeta
+
+
+def test_sigma_to_z_matches_column_interpolation():
+    siglev, siglay, data, h, zeta = _columns()
+    z_levels = [0.5, 2.0, 6.0, 30.0]
+    out = sigma_to_z(data, siglay, h, zeta, z_levels)
+    assert out.shape == (3, 4, 4)
+    for t in range(3):
+        for n in range(4):
+            depth = -siglay * (h[n] + zeta[t, n])
+            for k, z in enumerate(z_levels):
+                if z > h[n] + zeta[t, n]:
+                    assert np.isnan(out[t, k, n])
+                else:
+                    assert out[t, k, n] == pytest.approx(np.interp(z, depth, data[t, :, n]))
+
+
+def test_sigma_to_z_from_the_bottom():
+    siglev, siglay, data, h, zeta = _columns()
+    above_bed = sigma_to_z(data, siglay, h, zeta, [1.0], reference='bottom')
+    for t in range(3):
+        for n in range(4):
+            # 床面以上 1 m 即水面以下 D - 1 m
+            depth = -siglay * (h[n] + zeta[t, n])
+            assert above_bed[t, 0, n] == pytest.approx(np.interp(h[n] + zeta[t, n] - 1.0, depth, data[t, :, n]))
+
+
+def test_relative_depth_and_vertical_mean():
+    siglev, siglay, data, _, _ = _columns()
+    out = relative_depth(data, siglay, ['surface', '0.4H', 1.0])
+    np.testing.assert_allclose(out[:, 0], data[:, 0])
+    np.testing.assert_allclose(out[:, 2], data[:, -1])
+    np.testing.assert_allclose(out[:, 1], (data[:, 1] + data[:, 2]) / 2)
+    # 等厚度的层，厚度加权平均即算术平均
+    np.testing.assert_allclose(vertical_mean(data, siglev), data.mean(axis=1))
+
+
+def test_check_depth():
+    check_depth(None, None)
+    check_depth(2.5, 'surface')
+    for z, reference in ((None, 'surface'), ([1, 2], 'bottom'), (1.0, 'top')):
+        with pytest.raises(ValueError):
+            check_depth(z, reference)